@@ -0,0 +1,202 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import ctgov_async
+import parse
+import parse_trial
+from data_parsers.result_cache import format_cache_stats
+
+# ParserContext of the matching workers, inherited through fork (never pickled)
+_match_context = None
+
+
+def _init_match_worker(context):
+    global _match_context
+    _match_context = context
+
+
+def _match(nct_id, trial):
+    try:
+        return {'nct_id': nct_id, 'trial_data': parse_trial.match_trial(trial, _match_context)}
+    except Exception as e:
+        traceback.print_exc()
+        return {'nct_id': nct_id, 'stage': 'match', 'error': str(e)}
+
+
+class BatchParser:
+    """
+    Parses many trials as a three stage pipeline, each stage with its own pool: fetching from ClinicalTrials.gov
+    (threads, network bound), MedEx + criteria2query (threads driving the JVM subprocesses) and matching against the
+    `load_tools` ParserContext (forked processes, CPU bound). A trial moves to the next stage as soon as it leaves the
+    previous one, so the stages overlap across trials and results come out in completion order.
+    """
+
+    def __init__(self, context, fetch_workers=8, jvm_workers=2, match_workers=None, max_in_flight=None):
+        if match_workers is None:
+            match_workers = os.cpu_count() or 1
+        self.context = context
+        self.fetch_workers = fetch_workers
+        self.jvm_workers = jvm_workers
+        self.match_workers = match_workers
+        # bounds the trials held between stages when one stage is much faster than the next
+        self.max_in_flight = max_in_flight or 4 * (fetch_workers + jvm_workers + max(1, match_workers))
+
+    def parse(self, nct_ids):
+        """Yield one result dict per NCT id ({'nct_id', 'trial_data'} or {'nct_id', 'stage', 'error'})."""
+        nct_ids = list(nct_ids)
+        results = queue.Queue()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        stop = threading.Event()
+
+        match_pool = None
+        if self.match_workers > 0:
+            # fork before any pipeline thread exists, the workers share the loaded context copy-on-write
+            mp_context = multiprocessing.get_context('fork')
+            match_pool = mp_context.Pool(self.match_workers, initializer=_init_match_worker, initargs=(self.context,))
+        else:
+            _init_match_worker(self.context)
+        fetch_pool = ThreadPoolExecutor(self.fetch_workers, thread_name_prefix='fetch')
+        jvm_pool = ThreadPoolExecutor(self.jvm_workers, thread_name_prefix='jvm')
+
+        def fail(nct_id, stage, e):
+            traceback.print_exc()
+            results.put({'nct_id': nct_id, 'stage': stage, 'error': str(e)})
+
+        def matched(nct_id, trial):
+            if match_pool is None:
+                results.put(_match(nct_id, trial))
+            else:
+                match_pool.apply_async(_match, (nct_id, trial), callback=results.put,
+                                       error_callback=lambda e: fail(nct_id, 'match', e))
+
+        def run_jvm(nct_id, trial):
+            try:
+                trial = parse_trial.run_jvm_tools(trial)
+            except Exception as e:
+                fail(nct_id, 'jvm', e)
+                return
+            matched(nct_id, trial)
+
+        def fetch(nct_id):
+            try:
+                trial = parse_trial.fetch_trial(nct_id)
+            except Exception as e:
+                fail(nct_id, 'fetch', e)
+                return
+            jvm_pool.submit(run_jvm, nct_id, trial)
+
+        def feed():
+            for nct_id in nct_ids:
+                while not in_flight.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                fetch_pool.submit(fetch, nct_id)
+
+        feeder = threading.Thread(target=feed, name='feed', daemon=True)
+        feeder.start()
+        done = 0
+        try:
+            for _ in range(len(nct_ids)):
+                result = results.get()
+                in_flight.release()
+                done += 1
+                yield result
+        finally:
+            # also reached when the caller stops iterating early, then the queued work is dropped
+            stop.set()
+            feeder.join()
+            finished = done == len(nct_ids)
+            fetch_pool.shutdown(wait=True, cancel_futures=not finished)
+            jvm_pool.shutdown(wait=True, cancel_futures=not finished)
+            if match_pool is not None:
+                if finished:
+                    match_pool.close()
+                else:
+                    match_pool.terminate()
+                match_pool.join()
+
+
+def read_nct_ids(nct_ids, id_file):
+    nct_ids = list(nct_ids or [])
+    if id_file is not None:
+        with open(id_file) as f:
+            nct_ids.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    # keep the first occurrence of repeated ids
+    return list(dict.fromkeys(nct_ids))
+
+
+def add_pipeline_arguments(parser):
+    """Options of the parsing pipeline and its tools, shared by the batch command lines (see setup_pipeline)."""
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--jvm-workers', type=int, default=2)
+    parser.add_argument('--match-workers', type=int, default=None, help='0 matches in the main process')
+    parser.add_argument('--medex-workers', type=int, default=0, help='warm MedEx JVMs (0 runs java per trial)')
+    parser.add_argument('--crit2query-workers', type=int, default=0,
+                        help='warm criteria2query JVMs (0 runs java per trial)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='cache stage results (MedEx, criteria2query, '
+                        'UMLS concepts, drug matching) in this directory')
+    parser.add_argument('--cache-size-mb', type=int, default=2048)
+    parser.add_argument('--study-store', type=str, default=None,
+                        help='read studies from this store (see study_store.py) before requesting them')
+    parser.add_argument('--offline', action='store_true', help='only read studies from --study-store')
+    parser.add_argument('--requests-per-second', type=float, default=10, help='ClinicalTrials.gov request rate')
+
+
+def setup_pipeline(parser, args):
+    """Load the ParserContext and start the tools configured by the `add_pipeline_arguments` options."""
+    if args.offline and args.study_store is None:
+        parser.error('--offline needs --study-store')
+    context = parse_trial.load_tools()
+    if args.medex_workers > 0:
+        parse_trial.start_medex_pool(num_workers=args.medex_workers)
+    if args.crit2query_workers > 0:
+        parse_trial.start_crit2query_pool(num_workers=args.crit2query_workers)
+    if args.cache_dir is not None:
+        parse_trial.open_result_cache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 ** 2)
+    if args.study_store is not None:
+        parse.open_study_store(args.study_store)
+    if args.offline:
+        parse.OFFLINE = True
+    else:
+        parse.start_study_fetcher(max_per_second=args.requests_per_second, pool_size=args.fetch_workers)
+    return context
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse many clinical trials with a staged parallel pipeline.')
+    parser.add_argument('nctids', type=str, nargs='*', help='NCT IDs of the clinical trials')
+    parser.add_argument('--file', type=str, default=None, help='file with one NCT ID per line')
+    parser.add_argument('--output', type=str, default='parsed_trials.jsonl', help='results, one JSON line per trial')
+    add_pipeline_arguments(parser)
+    parser.add_argument('--prefetch', action='store_true', help='download all studies missing from --study-store '
+                        'with the async paged fetcher before parsing')
+    args = parser.parse_args()
+    if args.prefetch and (args.study_store is None or args.offline):
+        parser.error('--prefetch needs --study-store and no --offline')
+
+    nct_ids = read_nct_ids(args.nctids, args.file)
+    context = setup_pipeline(parser, args)
+    if args.prefetch:
+        errors = ctgov_async.prefetch(nct_ids, parse.STUDY_STORE, max_per_second=args.requests_per_second)
+        print(f"Prefetched studies, {len(errors)} could not be downloaded")
+    batch_parser = BatchParser(context, fetch_workers=args.fetch_workers, jvm_workers=args.jvm_workers,
+                               match_workers=args.match_workers)
+    cache_stats = parse_trial.RESULT_CACHE.stats() if parse_trial.RESULT_CACHE is not None else None
+    failed = 0
+    with open(args.output, 'a') as f:
+        for result in batch_parser.parse(nct_ids):
+            failed += 'error' in result
+            f.write(json.dumps(result, default=parse_trial.json_default) + '\n')
+            f.flush()
+    context.close()
+    print(f"Parsed {len(nct_ids) - failed}/{len(nct_ids)} trials into {args.output}")
+    if cache_stats is not None:
+        print(format_cache_stats(parse_trial.RESULT_CACHE.stats(), since=cache_stats))
@@ -0,0 +1,366 @@
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import parse
+import parse_trial
+from study_store import StudyStore
+
+# the examples of the PlaNet app (1_Run PlaNet.py)
+EXAMPLE_NCT_IDS = ['NCT02702388', 'NCT01713946', 'NCT01584648', 'NCT01006252', 'NCT01586975']
+
+
+class ToolRecording:
+    """Outputs of an external tool recorded per input text, in one JSON file keyed by the sha256 of the text."""
+
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.outputs = json.load(f)
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        output = self.outputs.get(self.key(text))
+        if output is None:
+            raise RuntimeError(f"No recorded output in {self.path} for {text[:80]!r}, record it with --record")
+        return output
+
+    def put(self, text, output):
+        with self.lock:
+            self.outputs[self.key(text)] = output
+
+    def save(self):
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.outputs, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class MedexStandIn:
+    """Takes the place of parse_trial.MEDEX_POOL: replays recorded MedEx outputs, or records them with `record`."""
+
+    def __init__(self, recording, record=False):
+        self.recording = recording
+        self.record = record
+
+    def run(self, inputs):
+        if not self.record:
+            return {key: self.recording.get(text) for key, text in inputs.items()}
+        outputs = parse_trial.run_medex_subprocess(inputs)
+        for key, output in outputs.items():
+            self.recording.put(inputs[key], output)
+        return outputs
+
+
+class Crit2QueryStandIn:
+    """Takes the place of parse_trial.CRIT2QUERY_POOL, like MedexStandIn."""
+
+    def __init__(self, recording, record=False):
+        self.recording = recording
+        self.record = record
+
+    def run_json(self, criteria_text):
+        if not self.record:
+            return self.recording.get(criteria_text)
+        output = parse_trial.run_crit2query_subprocess(criteria_text)
+        self.recording.put(criteria_text, output)
+        return output
+
+
+def start_ctgov_stand_in(store):
+    """Serve the studies of `store` at http://127.0.0.1:<port>/api/v2/studies/<nct_id>, returns (server, base url)."""
+
+    class StudyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, with Nagle every keep-alive request would wait for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            study = store.get(self.path.rstrip('/').rsplit('/', 1)[-1])
+            body = json.dumps(study).encode('utf-8') if study is not None else b'{"error": "not found"}'
+            self.send_response(200 if study is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StudyHandler)
+    threading.Thread(target=server.serve_forever, name='ctgov-stand-in', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/api/v2/studies'
+
+
+def read_submissions(paths):
+    """
+    {name: trial data} of PlaNet submissions: request JSON files as saved by the app ({"trial_data": ...}), JSONL files
+    with one request per line, or directories of those.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.json')) + glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            files.append(path)
+    submissions = {}
+    for path in files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            if path.endswith('.jsonl'):
+                records = [json.loads(line) for line in f if line.strip()]
+            else:
+                records = [json.load(f)]
+        for idx, record in enumerate(records):
+            trial = record.get('trial_data', record)
+            key = name if len(records) == 1 else f'{name}-{idx}'
+            submissions[key] = trial
+    return submissions
+
+
+def canonical_output(output):
+    """The output as plain JSON types (sets, enums, numpy values converted) for comparisons and golden files."""
+    return json.loads(json.dumps(output, sort_keys=True, default=parse_trial.json_default))
+
+
+def first_difference(expected, actual, path=''):
+    """Path of the first difference between two JSON values, or None if equal."""
+    if type(expected) != type(actual):
+        return f'{path or "/"}: {type(expected).__name__} != {type(actual).__name__}'
+    if isinstance(expected, dict):
+        for key in sorted(set(expected) | set(actual)):
+            if key not in expected or key not in actual:
+                return f'{path}/{key}: only in {"golden" if key in expected else "output"}'
+            difference = first_difference(expected[key], actual[key], f'{path}/{key}')
+            if difference is not None:
+                return difference
+        return None
+    if isinstance(expected, list):
+        if len(expected) != len(actual):
+            return f'{path or "/"}: {len(expected)} != {len(actual)} items'
+        for idx, (expected_item, actual_item) in enumerate(zip(expected, actual)):
+            difference = first_difference(expected_item, actual_item, f'{path}/{idx}')
+            if difference is not None:
+                return difference
+        return None
+    return None if expected == actual else f'{path or "/"}: {expected!r} != {actual!r}'
+
+
+def compare_golden(golden_dir, name, output, update=False):
+    """'equal', 'different' (with the first difference) or 'new' if there is no golden file (written with `update`)."""
+    path = os.path.join(golden_dir, f'{name}.json')
+    output = canonical_output(output)
+    if not os.path.exists(path) or update:
+        os.makedirs(golden_dir, exist_ok=True)
+        existed = os.path.exists(path)
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+        return ('updated' if existed else 'new'), None
+    with open(path) as f:
+        golden = json.load(f)
+    difference = first_difference(golden, output)
+    return ('equal', None) if difference is None else ('different', difference)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_summary(seconds):
+    seconds = np.array(seconds)
+    return {
+        'count': len(seconds),
+        'mean': float(seconds.mean()),
+        'p50': float(np.percentile(seconds, 50)),
+        'p90': float(np.percentile(seconds, 90)),
+        'p99': float(np.percentile(seconds, 99)),
+        'max': float(seconds.max()),
+    }
+
+
+def replay_one(name, trial, context, stage_seconds):
+    """Parse one trial (an NCT id to fetch if `trial` is None) the way parse_trial does, timing every stage."""
+    timings = {}
+
+    def timed(stage, fn):
+        def run():
+            start = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                timings[stage] = time.perf_counter() - start
+        return run
+
+    start = time.perf_counter()
+    if trial is None:
+        trial = timed('fetch', lambda: parse_trial.fetch_trial(name))()
+    else:
+        # the stages fill in the trial, keep the submission as it was for the next repeat
+        trial = copy.deepcopy(trial)
+    stages = {stage: (timed(stage, fn), deps) for stage, (fn, deps) in parse_trial.trial_stages(trial, context).items()}
+    output = parse_trial.run_stages(stages)['arms']
+    timings['total'] = time.perf_counter() - start
+    for stage, seconds in timings.items():
+        stage_seconds.setdefault(stage, []).append(seconds)
+    return output, timings['total']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(context, nct_ids, submissions, golden_dir, repeats=1, concurrency=1, update_golden=False):
+    """
+    Replay the NCT ids and submissions `repeats` times through the parse_trial stages, `concurrency` trials at a time.
+    Returns the benchmark result: per stage latency percentiles, peak memory and the golden file comparison of the
+    first repeat of every trial.
+    """
+    items = [(nct_id, None) for nct_id in nct_ids] + list(submissions.items())
+    stage_seconds = {}
+    trials = {}
+    errors = {}
+
+    def replay(repeat, name, trial):
+        try:
+            output, seconds = replay_one(name, trial, context, stage_seconds)
+        except Exception as e:
+            errors[name] = repr(e)
+            return
+        trials.setdefault(name, {'seconds': []})['seconds'].append(seconds)
+        if repeat == 0:
+            status, difference = compare_golden(golden_dir, name, output, update=update_golden)
+            trials[name].update(golden=status, difference=difference)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for repeat in range(repeats):
+            # the repeats run one after the other, so the first one (golden files) finishes first
+            list(pool.map(lambda item: replay(repeat, *item), items))
+    wall_seconds = time.perf_counter() - start
+
+    return {
+        'stages': {stage: latency_summary(seconds) for stage, seconds in sorted(stage_seconds.items())},
+        'trials': trials,
+        'errors': errors,
+        'golden': {status: sum(trial.get('golden') == status for trial in trials.values())
+                   for status in ('equal', 'different', 'new', 'updated')},
+        'wall_seconds': wall_seconds,
+        'trials_per_second': sum(len(trial['seconds']) for trial in trials.values()) / wall_seconds,
+    }
+
+
+def format_comparison(result, previous):
+    """Per stage p50/p90 of `result` next to the ones of a `previous` result."""
+    lines = [f"{'stage':<12}{'p50':>10}{'prev p50':>10}{'p90':>10}{'prev p90':>10}"]
+    for stage, summary in result['stages'].items():
+        before = previous['stages'].get(stage, {})
+        lines.append(f"{stage:<12}{summary['p50']:>10.3f}{before.get('p50', float('nan')):>10.3f}"
+                     f"{summary['p90']:>10.3f}{before.get('p90', float('nan')):>10.3f}")
+    lines.append(f"peak RSS {result['peak_rss_mb']:.0f} MB (previous {previous.get('peak_rss_mb', float('nan')):.0f})")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay benchmark of parse_trial against recorded tool outputs.')
+    parser.add_argument('nctids', type=str, nargs='*', help='NCT IDs to replay (default: the app examples)')
+    parser.add_argument('--submissions', type=str, nargs='*', default=[],
+                        help='submission JSON/JSONL files or directories (the request files saved by the app)')
+    parser.add_argument('--fixtures', type=str, default='benchmark_fixtures',
+                        help='recorded studies, MedEx and criteria2query outputs and golden files')
+    parser.add_argument('--record', action='store_true',
+                        help='run the real ClinicalTrials.gov API, MedEx and criteria2query and record their outputs')
+    parser.add_argument('--update-golden', action='store_true', help='overwrite the golden files with the outputs')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=1, help='trials replayed at the same time')
+    parser.add_argument('--output', type=str, default=None, help='benchmark result JSON (default: in --fixtures)')
+    parser.add_argument('--compare', type=str, default=None, help='earlier benchmark result JSON to compare with')
+    parser.add_argument('--data-dir', type=str, default=None)
+    parser.add_argument('--base-dir', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        parse_trial.DATA_DIR = args.data_dir
+    if args.base_dir is not None:
+        parse_trial.BASE_DIR = args.base_dir
+    nct_ids = args.nctids or ([] if args.submissions else EXAMPLE_NCT_IDS)
+    submissions = read_submissions(args.submissions)
+    os.makedirs(args.fixtures, exist_ok=True)
+
+    medex_recording = ToolRecording(os.path.join(args.fixtures, 'medex_outputs.json'))
+    crit2query_recording = ToolRecording(os.path.join(args.fixtures, 'crit2query_outputs.json'))
+    parse_trial.MEDEX_POOL = MedexStandIn(medex_recording, record=args.record)
+    parse_trial.CRIT2QUERY_POOL = Crit2QueryStandIn(crit2query_recording, record=args.record)
+    study_store = StudyStore(os.path.join(args.fixtures, 'studies.sqlite'))
+    server = None
+    if args.record:
+        parse.STUDY_STORE = study_store
+        parse.start_study_fetcher()
+    else:
+        server, base_url = start_ctgov_stand_in(study_store)
+        parse.start_study_fetcher(base_url=base_url, max_per_second=0)
+
+    start = time.perf_counter()
+    context = parse_trial.load_tools()
+    load_seconds = time.perf_counter() - start
+    rss_after_load = peak_rss_mb()
+
+    result = run_benchmark(context, nct_ids, submissions, os.path.join(args.fixtures, 'golden'),
+                           repeats=1 if args.record else args.repeats, concurrency=args.concurrency,
+                           update_golden=args.update_golden or args.record)
+    result.update({
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'config': {'nct_ids': nct_ids, 'submissions': sorted(submissions), 'repeats': args.repeats,
+                   'concurrency': args.concurrency, 'record': args.record},
+        'load_seconds': load_seconds,
+        'peak_rss_after_load_mb': rss_after_load,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    context.close()
+    if server is not None:
+        server.shutdown()
+    if args.record:
+        medex_recording.save()
+        crit2query_recording.save()
+
+    output = args.output or os.path.join(args.fixtures, f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    for stage, summary in result['stages'].items():
+        print(f"{stage:<12} p50 {summary['p50']:.3f}s  p90 {summary['p90']:.3f}s  p99 {summary['p99']:.3f}s  "
+              f"max {summary['max']:.3f}s  (n={summary['count']})")
+    print(f"load {load_seconds:.1f}s, peak RSS {result['peak_rss_mb']:.0f} MB, "
+          f"{result['trials_per_second']:.2f} trials/s")
+    print('golden: ' + ', '.join(f'{count} {status}' for status, count in result['golden'].items() if count))
+    for name, trial in result['trials'].items():
+        if trial.get('golden') == 'different':
+            print(f"  {name}: {trial['difference']}")
+    for name, error in result['errors'].items():
+        print(f"  {name} failed: {error}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(format_comparison(result, json.load(f)))
+    print(f"Results written to {output}")
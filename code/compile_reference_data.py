@@ -0,0 +1,18 @@
+import argparse
+import time
+
+import parse_trial
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the drug, MeSH and UMLS lookup tables used by parse_trial '
+                                                 'into a memory-mapped reference data directory.')
+    parser.add_argument('--data-dir', type=str, default=None)
+    parser.add_argument('--out', type=str, default=None, help='defaults to <data dir>/reference_data')
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        parse_trial.DATA_DIR = args.data_dir
+    start = time.time()
+    manifest = parse_trial.compile_reference_data(args.out)
+    print(f"Compiled {len(manifest['tables'])} tables into {args.out or parse_trial.reference_dir()} "
+          f"in {time.time() - start:.0f}s")
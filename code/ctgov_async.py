@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from tqdm import tqdm
+
+from parse import parse_study
+from study_store import CTGOV_STUDIES_URL, StudyStore, study_nct_id
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Allows bursts of up to `capacity` requests and `rate` requests per second on average."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # waiters queue on the lock, so tokens are handed out in request order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _retry_after(headers):
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AsyncStudyFetcher:
+    """
+    Downloads many ClinicalTrials.gov v2 studies concurrently, for batch re-parsing. All requests go over one pooled
+    keep-alive aiohttp session with at most `max_concurrency` in flight and a token bucket of `max_per_second`.
+    Connection errors, timeouts, 429 and 5xx are retried `retries` times with full-jitter exponential backoff (or
+    after Retry-After if the server sends one).
+
+    Studies missing from `store` are requested `ids_per_page` at a time through the paged list endpoint. Stored ones
+    are read from the store, or with `revalidate` requested one by one with the stored ETag/Last-Modified so that
+    unchanged studies come back as a body-less 304. Use as `async with AsyncStudyFetcher(...) as fetcher`.
+    """
+
+    def __init__(self, store=None, base_url=CTGOV_STUDIES_URL, max_concurrency=16, max_per_second=10, burst=None,
+                 timeout=60, retries=4, backoff=0.5, max_backoff=30, ids_per_page=200):
+        self.store = store
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(max_per_second, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ids_per_page = ids_per_page
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                             raise_for_status=False)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def _get(self, url, params=None, headers=None):
+        """(status, headers, body) of a GET, retried on transient failures. Raises RuntimeError once out of retries."""
+        for attempt in range(self.retries + 1):
+            delay = None
+            await self.bucket.acquire()
+            try:
+                async with self.semaphore:
+                    async with self.session.get(url, params=params, headers=headers) as response:
+                        body = await response.read()
+                        if response.status not in RETRY_STATUSES or attempt == self.retries:
+                            return response.status, response.headers, body
+                        delay = _retry_after(response.headers)
+                        error = f"Status code: {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise RuntimeError(f"Failed to fetch {url}: {e!r}")
+                error = repr(e)
+            if delay is None:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            print(f"Retrying {url} in {delay:.1f}s ({error})")
+            await asyncio.sleep(delay)
+
+    async def fetch_study(self, nct_id, revalidate=True):
+        """The study JSON of `nct_id`. A stored copy is revalidated with a conditional request if `revalidate`."""
+        headers = {}
+        if revalidate and self.store is not None:
+            etag, last_modified = await asyncio.to_thread(self.store.validators, nct_id)
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        status, response_headers, body = await self._get(f'{self.base_url}/{nct_id}', headers=headers)
+        if status == 304:
+            return await asyncio.to_thread(self.store.get, nct_id)
+        if status != 200:
+            raise RuntimeError(f"Failed to fetch {nct_id}. Status code: {status}, Message: {body[:200]!r}")
+        study = json.loads(body)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.put, study, response_headers.get('ETag'),
+                                    response_headers.get('Last-Modified'))
+        return study
+
+    async def fetch_page(self, nct_ids):
+        """{nct_id: study} for `nct_ids` from the list endpoint, following nextPageToken. Unknown ids are left out."""
+        params = {'filter.ids': ','.join(nct_ids), 'pageSize': str(min(1000, len(nct_ids))), 'format': 'json'}
+        studies = {}
+        while True:
+            status, _, body = await self._get(self.base_url, params=params)
+            if status != 200:
+                raise RuntimeError(f"Failed to fetch a page of {len(nct_ids)} studies. Status code: {status}, "
+                                   f"Message: {body[:200]!r}")
+            page = json.loads(body)
+            for study in page.get('studies', []):
+                studies[study_nct_id(study)] = study
+            if not page.get('nextPageToken'):
+                break
+            params['pageToken'] = page['nextPageToken']
+        if self.store is not None and studies:
+            await asyncio.to_thread(self.store.put_many, list(studies.values()))
+        return studies
+
+    async def _page_results(self, nct_ids):
+        try:
+            studies = await self.fetch_page(nct_ids)
+        except RuntimeError as e:
+            return [(nct_id, None, str(e)) for nct_id in nct_ids]
+        return [(nct_id, studies[nct_id], None) if nct_id in studies else (nct_id, None, f"{nct_id} was not found")
+                for nct_id in nct_ids]
+
+    async def _stored_result(self, nct_id, revalidate):
+        try:
+            if revalidate:
+                return [(nct_id, await self.fetch_study(nct_id), None)]
+            return [(nct_id, await asyncio.to_thread(self.store.get, nct_id), None)]
+        except RuntimeError as e:
+            return [(nct_id, None, str(e))]
+
+    async def iter_studies(self, nct_ids, revalidate=False, load_stored=True):
+        """
+        Yield (nct_id, study, None) or (nct_id, None, error) for each of `nct_ids`, in the order they arrive. Without
+        `load_stored` (and `revalidate`) studies already in the store are not read, they are yielded as
+        (nct_id, None, None).
+        """
+        nct_ids = list(dict.fromkeys(nct_ids))
+        stored = await asyncio.to_thread(self.store.stored_ids, nct_ids) if self.store is not None else set()
+        missing = [nct_id for nct_id in nct_ids if nct_id not in stored]
+        stored = [nct_id for nct_id in nct_ids if nct_id in stored]
+        if not (load_stored or revalidate):
+            for nct_id in stored:
+                yield nct_id, None, None
+            stored = []
+        jobs = [self._page_results(missing[start:start + self.ids_per_page])
+                for start in range(0, len(missing), self.ids_per_page)]
+        jobs.extend(self._stored_result(nct_id, revalidate) for nct_id in stored)
+        for job in asyncio.as_completed(jobs):
+            for result in await job:
+                yield result
+
+    async def parse_studies(self, nct_ids, revalidate=False):
+        """Like `iter_studies`, but yields (nct_id, parse.parse result, error)."""
+        async for nct_id, study, error in self.iter_studies(nct_ids, revalidate=revalidate):
+            if error is not None:
+                yield nct_id, None, error
+                continue
+            try:
+                yield nct_id, parse_study(study), None
+            except (ValueError, KeyError, TypeError) as e:
+                yield nct_id, None, f"{nct_id}: {e!r}"
+
+
+def prefetch(nct_ids, store, revalidate=False, **kwargs):
+    """Bring the studies of `nct_ids` into `store` (see AsyncStudyFetcher), returns {nct_id: error} of failed ones."""
+    async def run():
+        errors = {}
+        async with AsyncStudyFetcher(store, **kwargs) as fetcher:
+            # only the fetches matter here, stored studies are not read unless they are revalidated
+            results = fetcher.iter_studies(nct_ids, revalidate=revalidate, load_stored=False)
+            with tqdm(total=len(set(nct_ids))) as progress:
+                async for nct_id, _, error in results:
+                    if error is not None:
+                        errors[nct_id] = error
+                    progress.update()
+        return errors
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download ClinicalTrials.gov studies into a study store.')
+    parser.add_argument('store', type=str, help='SQLite study store (see study_store.py)')
+    parser.add_argument('--file', type=str, required=True, help='file with one NCT ID per line')
+    parser.add_argument('--revalidate', action='store_true', help='also check stored studies for updates')
+    parser.add_argument('--base-url', type=str, default=CTGOV_STUDIES_URL)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests-per-second', type=float, default=10)
+    parser.add_argument('--ids-per-page', type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        nct_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    errors = prefetch(nct_ids, StudyStore(args.store), revalidate=args.revalidate, base_url=args.base_url,
+                      max_concurrency=args.concurrency, max_per_second=args.requests_per_second,
+                      ids_per_page=args.ids_per_page)
+    for nct_id, error in errors.items():
+        print(error)
+    print(f"{len(nct_ids) - len(errors)}/{len(nct_ids)} studies in {args.store}")
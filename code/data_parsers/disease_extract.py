@@ -1,11 +1,12 @@
 import os
 import re
+import threading
 
 from preprocessing.disease_data import MeshData
 
 
 class DiseaseExtract:
-    def __init__(self, data_dir: str, data_year: int):
+    def __init__(self, data_dir: str, data_year: int, reference=None):
         self.special_maps = {
             'HIV-1 Infection': 'HIV Infections',
             'HIV': 'HIV Infections',
@@ -24,17 +25,41 @@ class DiseaseExtract:
             'Solid Neoplasms': 'Neoplasms',
             'Various Neoplasm': 'Neoplasms',
         }
-        self.mesh_dis_data = self._get_disease_data(f'{data_dir}/disease_data/{data_year}',
-                                                    data_year)
+        self.mesh_dir = f'{data_dir}/disease_data/{data_year}'
+        self.data_year = data_year
+        self._mesh_dis_data = None
+        if reference is None:
+            self.mesh_names2id = self.mesh_dis_data.names2id
+        else:
+            # condition matching only needs the MeSH names, the full MeSH tree is parsed on first use (KG build)
+            self.mesh_names2id = reference['mesh/names2id']
+        # trials that needed the MeSH terms, counted under `lock` as concurrent trials share one DiseaseExtract
         self.cnt = 0
+        self.lock = threading.Lock()
+
+    @property
+    def mesh_dis_data(self):
+        if self._mesh_dis_data is None:
+            self._mesh_dis_data = self._get_disease_data(self.mesh_dir, self.data_year)
+        return self._mesh_dis_data
+
+    @staticmethod
+    def mesh_sources(root_dir, data_year):
+        return [os.path.join(root_dir, f'd{data_year}.bin'), os.path.join(root_dir, f"c{data_year}.bin"),
+                os.path.join(root_dir, 'disease_mappings.tsv')]
 
     @staticmethod
     def _get_disease_data(root_dir, data_year):
-        mesh_file = os.path.join(root_dir, f'd{data_year}.bin')
-        disgenet_file = os.path.join(root_dir, 'disease_mappings.tsv')
-        submesh_file = os.path.join(root_dir, f"c{data_year}.bin")
+        mesh_file, submesh_file, disgenet_file = DiseaseExtract.mesh_sources(root_dir, data_year)
         return MeshData(mesh_file, submesh_file, disgenet_file, filter_categ=["C", "F01", "F02", "F03"])
 
+    def reference_tables(self):
+        return {'mesh/names2id': self.mesh_names2id}
+
+    def get_meshID(self, disease_name):
+        """Same as MeshData.get_meshID."""
+        return self.mesh_names2id.get(disease_name.lower().strip())
+
     def _map_conditions(self, condition_entries, mesh_terms=(), ignore=False):
         """"
         condition_entries: original condition names and mesh terms
@@ -48,19 +73,19 @@ class DiseaseExtract:
         mesh_ids = set()
         healthy_pattern = re.compile(r"healthy\s*(human)?\s*(volunteer(s)?|subject(s)?)?|health|human volunteer")
         for condition in condition_entries:
-            mesh_id = self.mesh_dis_data.get_meshID(condition)
+            mesh_id = self.get_meshID(condition)
             if mesh_id is None and 'Cancer' in condition:
                 condition = condition.replace('Cancer', 'Neoplasm')
-                mesh_id = self.mesh_dis_data.get_meshID(condition)
+                mesh_id = self.get_meshID(condition)
             if mesh_id is None and 'Neoplasm' in condition and 'Advanced' in condition:
                 condition = condition.replace('Advanced', '').strip()
                 condition = re.sub(r'\s+', ' ', condition)
                 if condition[-1] in [',', '.']:
                     condition = condition[:-1]
-                mesh_id = self.mesh_dis_data.get_meshID(condition)
+                mesh_id = self.get_meshID(condition)
             if mesh_id is None:
                 if condition in self.special_maps:
-                    mesh_id = self.mesh_dis_data.get_meshID(self.special_maps[condition])
+                    mesh_id = self.get_meshID(self.special_maps[condition])
                     assert mesh_id is not None
                 elif healthy_pattern.search(condition.lower()):
                     mesh_id = 'HEALTHY'
@@ -72,7 +97,7 @@ class DiseaseExtract:
             mesh_ids.add(mesh_id)
 
         for condition in mesh_terms:
-            mesh_id = self.mesh_dis_data.get_meshID(condition)
+            mesh_id = self.get_meshID(condition)
             mesh_ids.add(mesh_id)
 
         return mesh_ids
@@ -87,7 +112,8 @@ class DiseaseExtract:
 
         mesh_ids = self._map_conditions(conditions)
         if not mesh_ids:
-            self.cnt += 1
+            with self.lock:
+                self.cnt += 1
             mesh_ids = self._map_conditions(conditions, mesh_terms=mesh_terms, ignore=True)
 
         return mesh_ids
\ No newline at end of file
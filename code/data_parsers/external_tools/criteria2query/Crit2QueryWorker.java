@@ -0,0 +1,89 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.security.Permission;
+
+/**
+ * Keeps one JVM (and the loaded criteria2query models) alive for many criteria2query runs. The first argument is the
+ * jar's main class. Reads one request per line from stdin, "<input txt>\t<output dir>", runs the main class with
+ * "--input <input txt> --outputDir <output dir>" and answers "OK" or "ERROR\t<message>" on stdout.
+ * criteria2query's own stdout output is redirected to stderr so that it does not interleave with the protocol.
+ *
+ * As in MedexWorker, a System.exit of the main class is trapped with a SecurityManager: exit status 0 counts as a
+ * finished run, any other status as an error.
+ */
+public class Crit2QueryWorker {
+    /** Thrown in place of System.exit while the worker runs. */
+    static class ExitTrapped extends SecurityException {
+        final int status;
+
+        ExitTrapped(int status) {
+            super("criteria2query called System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    static boolean trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkPermission(Permission perm) {
+                }
+
+                @Override
+                public void checkPermission(Permission perm, Object context) {
+                }
+
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitTrapped(status);
+                }
+            });
+            return true;
+        } catch (UnsupportedOperationException | SecurityException e) {
+            // Java 18+ started without -Djava.security.manager=allow (medex_pool.py passes it)
+            System.err.println("Crit2QueryWorker: System.exit is not trapped: " + e);
+            return false;
+        }
+    }
+
+    static void run(Method main, String[] request) throws Throwable {
+        try {
+            main.invoke(null, (Object) new String[]{"--input", request[0], "--outputDir", request[1]});
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (!(cause instanceof ExitTrapped) || ((ExitTrapped) cause).status != 0) {
+                throw cause;
+            }
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        Method main = Class.forName(args[0]).getMethod("main", String[].class);
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream out = System.out;
+        System.setOut(System.err);
+        boolean trapped = trapExit();
+        out.println("READY");
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            try {
+                run(main, line.split("\t"));
+                out.println("OK");
+            } catch (Throwable t) {
+                t.printStackTrace();
+                out.println("ERROR\t" + String.valueOf(t).replace('\n', ' '));
+            }
+            out.flush();
+        }
+        if (trapped) {
+            System.setSecurityManager(null);
+        }
+        // criteria2query may leave non-daemon threads behind
+        System.exit(0);
+    }
+}
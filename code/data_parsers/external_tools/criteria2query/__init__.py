@@ -1 +1,2 @@
 from .criteria_input import create_nctids_file
+from .run_crit2query import Crit2QueryPool, read_outputs, read_shard, run_shards
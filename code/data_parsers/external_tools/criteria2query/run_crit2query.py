@@ -0,0 +1,228 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from ..medex.medex_pool import MedexWorker, compile_driver
+from ...population_extract import CriteriaOutputParser
+
+DRIVER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Crit2QueryWorker.java')
+
+
+def jar_main_class(jar_path):
+    with zipfile.ZipFile(jar_path) as jar:
+        manifest = jar.read('META-INF/MANIFEST.MF').decode('utf-8')
+    for line in manifest.splitlines():
+        if line.startswith('Main-Class:'):
+            return line.split(':', 1)[1].strip()
+    raise RuntimeError(f"{jar_path} has no Main-Class in its manifest")
+
+
+class Crit2QueryWorker(MedexWorker):
+    """One long-lived criteria2query JVM, restarted under the same conditions as a MedexWorker."""
+    driver = 'Crit2QueryWorker'
+
+    def __init__(self, jar_path, driver_dir, heap='4096m', max_rss_mb=None, max_runs=None):
+        super().__init__(jar_path, driver_dir, heap=heap, max_rss_mb=max_rss_mb, max_runs=max_runs)
+        self.main_class = jar_main_class(jar_path)
+
+    def _args(self):
+        return super()._args() + [self.main_class]
+
+    def run_to_file(self, criteria_text, output_path):
+        """Run criteria2query on one eligibility criteria text and atomically write its output.json to `output_path`."""
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path) or '.') as basedir:
+            input_path = os.path.join(basedir, 'crit_input.txt')
+            with open(input_path, 'w') as f:
+                f.write(criteria_text)
+            output_dir = os.path.join(basedir, 'outputs')
+            os.makedirs(output_dir)
+            self.request(input_path, output_dir)
+            result_path = os.path.join(output_dir, 'output.json')
+            if not os.path.exists(result_path):
+                raise RuntimeError(f"criteria2query wrote no output.json for {input_path}")
+            os.replace(result_path, output_path)
+
+    def run_json(self, criteria_text):
+        """Run criteria2query on one eligibility criteria text and return its loaded output.json."""
+        with tempfile.TemporaryDirectory() as basedir:
+            output_path = os.path.join(basedir, 'output.json')
+            self.run_to_file(criteria_text, output_path)
+            with open(output_path) as f:
+                return json.load(f)
+
+    def run(self, criteria_text):
+        """Run criteria2query on one eligibility criteria text and return the parsed criteria."""
+        return CriteriaOutputParser.parse_crit_output(self.run_json(criteria_text))
+
+
+class Crit2QueryPool:
+    """
+    Keeps `num_workers` criteria2query JVMs alive and serves `run` calls from any number of threads. The criteria of
+    concurrent trials queue up and go to whichever JVM is free. A failed run is retried once on a fresh JVM before the
+    error is handed to the caller.
+    """
+
+    def __init__(self, jar_path, num_workers=2, heap='4096m', max_rss_mb=None, max_runs=200):
+        self.jar_path = jar_path
+        self.num_workers = num_workers
+        self.heap = heap
+        self.max_rss_mb = max_rss_mb
+        self.max_runs = max_runs
+        self.requests = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # JVMs are started lazily by the first `run`, e.g. after the caller forked its own workers
+        with self.lock:
+            if self.threads:
+                return
+            driver_dir = compile_driver(self.jar_path, source=DRIVER_SOURCE)
+            for idx in range(self.num_workers):
+                worker = Crit2QueryWorker(self.jar_path, driver_dir, heap=self.heap, max_rss_mb=self.max_rss_mb,
+                                          max_runs=self.max_runs)
+                thread = threading.Thread(target=self._serve, args=(worker,), name=f'crit2query-{idx}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _serve(self, worker):
+        try:
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    return
+                criteria_text, future = request
+                try:
+                    try:
+                        result = worker.run_json(criteria_text)
+                    except RuntimeError:
+                        result = worker.run_json(criteria_text)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                future.set_result(result)
+        finally:
+            worker.stop()
+
+    def submit(self, criteria_text):
+        """Future of the raw criteria2query output (loaded output.json) for one eligibility criteria text."""
+        self._start()
+        future = Future()
+        self.requests.put((criteria_text, future))
+        return future
+
+    def run_json(self, criteria_text):
+        return self.submit(criteria_text).result()
+
+    def run(self, criteria_text):
+        return CriteriaOutputParser.parse_crit_output(self.run_json(criteria_text))
+
+    def close(self):
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def read_shard(shard_path):
+    with open(shard_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def read_outputs(output_dir, nct_ids):
+    """Yield (nct_id, parsed criteria) for the trials of `nct_ids` that have a criteria2query output in `output_dir`."""
+    for nct_id in nct_ids:
+        path = CriteriaOutputParser.output_path(output_dir, nct_id)
+        if os.path.exists(path):
+            yield nct_id, CriteriaOutputParser.parse_crit_output_from_file(path)
+
+
+# {nct_id: eligibility criteria} and the JVM of a shard process, the criteria are inherited through fork (never pickled)
+_shard_criteria = None
+_shard_worker = None
+
+
+def _init_shard_worker(criteria, jar_path, driver_dir, heap):
+    global _shard_criteria, _shard_worker
+    _shard_criteria = criteria
+    _shard_worker = Crit2QueryWorker(jar_path, driver_dir, heap=heap)
+
+
+def _run_shard(shard_path, output_dir):
+    stats = {'shard': os.path.basename(shard_path), 'done': 0, 'skipped': 0, 'missing': 0, 'failed': []}
+    for nct_id in read_shard(shard_path):
+        output_path = CriteriaOutputParser.output_path(output_dir, nct_id)
+        if os.path.exists(output_path):
+            stats['skipped'] += 1
+            continue
+        criteria_text = _shard_criteria.get(nct_id)
+        if not isinstance(criteria_text, str) or not criteria_text.strip():
+            stats['missing'] += 1
+            continue
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        try:
+            _shard_worker.run_to_file(criteria_text, output_path)
+        except (RuntimeError, OSError) as e:
+            # one bad trial must not end the shard, it is retried by the next run
+            print(f"{nct_id}: {e}")
+            stats['failed'].append(nct_id)
+            continue
+        stats['done'] += 1
+    return stats
+
+
+def run_shards(shards, criteria, jar_path, output_dir, num_workers=4, heap='4096m'):
+    """
+    Run criteria2query over the `criteria_to_parse_*.txt` shards written by `create_nctids_file` (a list of shard
+    files or the directory holding them). `criteria` maps NCT ids to eligibility criteria text (dict or pandas Series).
+    Each of the `num_workers` processes takes one shard at a time and runs it through its own warm JVM. Outputs are
+    written atomically to `output_dir/NCTxxxxxxxx/<nct_id>.json`, the layout of CriteriaOutputParser.parse_trial, so
+    calling it again after an interruption resumes: trials with an output are skipped and failed ones retried.
+    """
+    if isinstance(shards, str):
+        shards = sorted(glob.glob(os.path.join(shards, 'criteria_to_parse_*.txt')))
+    # compile once, before forking the shard processes
+    driver_dir = compile_driver(jar_path, source=DRIVER_SOURCE)
+    context = multiprocessing.get_context('fork')
+    results = []
+    with ProcessPoolExecutor(num_workers, mp_context=context, initializer=_init_shard_worker,
+                             initargs=(criteria, jar_path, driver_dir, heap)) as pool:
+        futures = [pool.submit(_run_shard, shard, output_dir) for shard in shards]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            results.append(future.result())
+    return results
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Run criteria2query over criteria_to_parse_*.txt shards.')
+    parser.add_argument('shard_dir', type=str, help='directory with the criteria_to_parse_*.txt shards')
+    parser.add_argument('--trials', type=str, required=True,
+                        help='pickled trial DataFrame with nct_id and eligibility_criteria columns')
+    parser.add_argument('--jar', type=str, required=True, help='criteria2query.jar')
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=4, help='shard processes, each with one JVM')
+    parser.add_argument('--heap', type=str, default='4096m')
+    args = parser.parse_args()
+
+    trials = pd.read_pickle(args.trials).drop_duplicates('nct_id')
+    criteria = trials.set_index('nct_id')['eligibility_criteria'].to_dict()
+    results = run_shards(args.shard_dir, criteria, args.jar, args.output_dir, num_workers=args.workers,
+                         heap=args.heap)
+    failed = [nct_id for stats in results for nct_id in stats['failed']]
+    print(f"done: {sum(stats['done'] for stats in results)}, "
+          f"already parsed: {sum(stats['skipped'] for stats in results)}, "
+          f"no criteria: {sum(stats['missing'] for stats in results)}, failed: {len(failed)}")
+    if failed:
+        print("failed (rerun to retry):", ' '.join(failed))
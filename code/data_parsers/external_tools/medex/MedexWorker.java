@@ -0,0 +1,120 @@
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.DirectoryStream;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.security.Permission;
+import java.util.Base64;
+import java.util.Comparator;
+import java.util.stream.Stream;
+
+/**
+ * Keeps one JVM (and the loaded MedEx classes) alive for many MedEx runs. Reads one request per line from stdin, the
+ * MedEx input JSON ({key: text}) on a single line, runs org.apache.medex.Main on it and answers on stdout with "OK"
+ * followed by one tab separated, base64 encoded field per MedEx output file, or with "ERROR\t<message>". Main only
+ * takes paths, so the input and output files live in a temporary directory of this process that is removed after
+ * every run. MedEx's own stdout output is redirected to stderr so that it does not interleave with the protocol.
+ *
+ * Main builds its tagger, and so reads the lexicons again, on every call and offers no way to keep it, which is why
+ * MedexPool merges queued requests into one run (up to batch_size inputs) to share that cost. The "medex" stage
+ * timings of benchmark.py show what one run costs.
+ *
+ * A System.exit in MedEx would end the worker, so it is trapped with a SecurityManager: exit status 0 counts as a
+ * finished run, any other status as an error.
+ */
+public class MedexWorker {
+    /** Thrown in place of System.exit while the worker runs. */
+    static class ExitTrapped extends SecurityException {
+        final int status;
+
+        ExitTrapped(int status) {
+            super("MedEx called System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    static boolean trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkPermission(Permission perm) {
+                }
+
+                @Override
+                public void checkPermission(Permission perm, Object context) {
+                }
+
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitTrapped(status);
+                }
+            });
+            return true;
+        } catch (UnsupportedOperationException | SecurityException e) {
+            // Java 18+ started without -Djava.security.manager=allow (medex_pool.py passes it)
+            System.err.println("MedexWorker: System.exit is not trapped: " + e);
+            return false;
+        }
+    }
+
+    static String run(String inputJson) throws Exception {
+        Path basedir = Files.createTempDirectory("medex_worker");
+        try {
+            Path input = basedir.resolve("medex_input.json");
+            Path outputDir = Files.createDirectory(basedir.resolve("outputs"));
+            Files.write(input, inputJson.getBytes(StandardCharsets.UTF_8));
+            try {
+                org.apache.medex.Main.main(new String[]{
+                        "-i", input.toString(), "-o", outputDir.toString(),
+                        "-b", "n", "-f", "y", "-d", "y", "-t", "n"});
+            } catch (ExitTrapped e) {
+                if (e.status != 0) {
+                    throw e;
+                }
+            }
+            StringBuilder response = new StringBuilder("OK");
+            try (DirectoryStream<Path> outputs = Files.newDirectoryStream(outputDir, "*.json")) {
+                for (Path output : outputs) {
+                    response.append('\t').append(Base64.getEncoder().encodeToString(Files.readAllBytes(output)));
+                }
+            }
+            return response.toString();
+        } finally {
+            delete(basedir);
+        }
+    }
+
+    static void delete(Path dir) throws IOException {
+        try (Stream<Path> paths = Files.walk(dir)) {
+            paths.sorted(Comparator.reverseOrder()).forEach(path -> path.toFile().delete());
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PrintStream out = System.out;
+        System.setOut(System.err);
+        boolean trapped = trapExit();
+        out.println("READY");
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            try {
+                out.println(run(line));
+            } catch (Throwable t) {
+                t.printStackTrace();
+                out.println("ERROR\t" + String.valueOf(t).replace('\n', ' '));
+            }
+            out.flush();
+        }
+        if (trapped) {
+            System.setSecurityManager(null);
+        }
+        // MedEx may leave non-daemon threads behind
+        System.exit(0);
+    }
+}
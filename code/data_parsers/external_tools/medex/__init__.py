@@ -1,2 +1,3 @@
 from .medex_input import MedexInputGenerator
 from .medex_output import MedexOutputParser, parseMedexOutput
+from .medex_pool import MedexPool
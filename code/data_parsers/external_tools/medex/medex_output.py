@@ -5,18 +5,24 @@ from collections import defaultdict
 
 
 class MedexOutputParser:
-    def __init__(self, base_paths):
-        self._load_output(base_paths=base_paths)
+    def __init__(self, base_paths=None, outputs=None):
+        """Parse MedEx output files found in `base_paths`, or `outputs` ({input key: output text}) already in memory."""
+        if outputs is None:
+            outputs = self._read_output(base_paths)
+        self._load_output(outputs)
         self.base_paths = base_paths
 
-    def _load_output(self, base_paths):
+    @staticmethod
+    def _read_output(base_paths):
         outputs = {}
         for base_path in base_paths:
             for out_file in glob.glob(os.path.join(base_path, "*.json")):
                 with open(out_file, 'r') as f:
                     out_chunk = json.load(f)
                 outputs.update(out_chunk)
+        return outputs
 
+    def _load_output(self, outputs):
         outputs_grouped = defaultdict(dict)
         for k, v in outputs.items():
             nct_id = k.split("_")[0]
@@ -0,0 +1,231 @@
+import base64
+import functools
+import hashlib
+import json
+import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future
+
+DRIVER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MedexWorker.java')
+
+
+def compile_driver(classpath, source=DRIVER_SOURCE, build_dir=None):
+    """Compile a worker driver (MedexWorker.java by default) against `classpath` once and return its class directory."""
+    name = os.path.splitext(os.path.basename(source))[0]
+    if build_dir is None:
+        with open(source, 'rb') as f:
+            digest = hashlib.sha1(f.read() + classpath.encode('utf-8')).hexdigest()[:12]
+        build_dir = os.path.join(tempfile.gettempdir(), f'{name.lower()}_{digest}')
+    if os.path.exists(os.path.join(build_dir, f'{name}.class')):
+        return build_dir
+    if shutil.which('javac') is None:
+        raise RuntimeError(f"javac is required to build the {name} driver")
+    os.makedirs(build_dir, exist_ok=True)
+    try:
+        subprocess.run(['javac', '-cp', classpath, '-d', build_dir, source], check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Compiling the {name} driver failed with error: {e}")
+    return build_dir
+
+
+@functools.lru_cache(maxsize=None)
+def java_version():
+    """Feature release of the `java` on PATH (8 for 1.8.0_292, 17 for 17.0.2), None if it cannot be told."""
+    try:
+        result = subprocess.run(['java', '-version'], capture_output=True, text=True)
+    except OSError:
+        return None
+    match = re.search(r'version "(\d+)(?:\.(\d+))?', result.stderr)
+    if match is None:
+        return None
+    major = int(match.group(1))
+    return int(match.group(2)) if major == 1 and match.group(2) else major
+
+
+class MedexWorker:
+    """One long-lived MedEx JVM, restarted when it dies, fails, grows past `max_rss_mb` or ran `max_runs` batches."""
+    driver = 'MedexWorker'
+
+    def __init__(self, classpath, driver_dir, heap='1024m', max_rss_mb=None, max_runs=None):
+        self.classpath = classpath
+        self.driver_dir = driver_dir
+        self.heap = heap
+        self.max_rss_mb = max_rss_mb
+        self.max_runs = max_runs
+        self.process = None
+        self.runs = 0
+
+    def _args(self):
+        args = ['java', f'-Xmx{self.heap}']
+        if (java_version() or 0) >= 12:
+            # lets the driver install the SecurityManager that traps System.exit, see MedexWorker.java
+            args.append('-Djava.security.manager=allow')
+        return args + ['-cp', os.pathsep.join([self.driver_dir, self.classpath]), self.driver]
+
+    def start(self):
+        args = self._args()
+        print(shlex.join(args))
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.runs = 0
+        if self.process.stdout.readline().strip() != 'READY':
+            self.stop()
+            raise RuntimeError(f"{self.driver} failed to start")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def rss_mb(self):
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+        return None
+
+    def _needs_restart(self):
+        if self.process is None or self.process.poll() is not None:
+            return True
+        if self.max_runs is not None and self.runs >= self.max_runs:
+            return True
+        rss = self.rss_mb() if self.max_rss_mb is not None else None
+        return rss is not None and rss > self.max_rss_mb
+
+    def request(self, *fields):
+        """Send one tab separated request line to the driver, returns the tab separated fields after its OK."""
+        if self._needs_restart():
+            self.stop()
+            self.start()
+        try:
+            self.process.stdin.write('\t'.join(fields) + '\n')
+            self.process.stdin.flush()
+            status = self.process.stdout.readline().rstrip('\n')
+        except OSError:
+            status = ''
+        self.runs += 1
+        fields = status.split('\t')
+        if fields[0] != 'OK':
+            # a dead or failed JVM is replaced before the next run
+            self.stop()
+            raise RuntimeError(f"{self.driver} failed: {status or 'worker exited'}")
+        return fields[1:]
+
+    def run(self, inputs):
+        """Run MedEx on {key: text} and return {key: output text}, both sent over the driver's pipes."""
+        outputs = {}
+        # json.dumps escapes tabs and newlines, so the inputs fit on one request line
+        for output in self.request(json.dumps(inputs)):
+            outputs.update(json.loads(base64.b64decode(output)))
+        return outputs
+
+
+class MedexPool:
+    """
+    Keeps `num_workers` MedEx JVMs alive and serves `run` calls from any number of threads. Requests waiting in the
+    queue are merged (up to `batch_size` inputs) into a single MedEx run, so concurrent trials share JVM and lexicon
+    start-up costs. A failed batch is retried once on a fresh JVM before the error is handed to its callers.
+    """
+
+    def __init__(self, classpath, num_workers=2, heap='1024m', max_rss_mb=None, max_runs=500, batch_size=256,
+                 batch_wait=0.05):
+        self.classpath = classpath
+        self.num_workers = num_workers
+        self.heap = heap
+        self.max_rss_mb = max_rss_mb
+        self.max_runs = max_runs
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # JVMs are started lazily by the first `run`, e.g. after the caller forked its own workers
+        with self.lock:
+            if self.threads:
+                return
+            driver_dir = compile_driver(self.classpath)
+            for idx in range(self.num_workers):
+                worker = MedexWorker(self.classpath, driver_dir, heap=self.heap, max_rss_mb=self.max_rss_mb,
+                                     max_runs=self.max_runs)
+                thread = threading.Thread(target=self._serve, args=(worker,), name=f'medex-{idx}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        keys = set(first[0])
+        size = len(first[0])
+        while size < self.batch_size:
+            try:
+                request = self.requests.get(timeout=self.batch_wait)
+            except queue.Empty:
+                break
+            if request is None or keys & set(request[0]):
+                # shutdown marker or a request with the same keys (same trial) goes to the next batch
+                self.requests.put(request)
+                break
+            batch.append(request)
+            keys.update(request[0])
+            size += len(request[0])
+        return batch
+
+    def _serve(self, worker):
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                inputs = {}
+                for request_inputs, _ in batch:
+                    inputs.update(request_inputs)
+                try:
+                    try:
+                        outputs = worker.run(inputs)
+                    except RuntimeError:
+                        outputs = worker.run(inputs)
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for request_inputs, future in batch:
+                    future.set_result({key: outputs[key] for key in request_inputs if key in outputs})
+        finally:
+            worker.stop()
+
+    def submit(self, inputs):
+        self._start()
+        future = Future()
+        if not inputs:
+            future.set_result({})
+            return future
+        self.requests.put((dict(inputs), future))
+        return future
+
+    def run(self, inputs):
+        return self.submit(inputs).result()
+
+    def close(self):
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
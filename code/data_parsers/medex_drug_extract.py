@@ -144,18 +144,39 @@ def get_name_medex_key_map(medex_out, full_name, skip_small_names=True):
 
 
 class DrugMatcher:
-    def __init__(self, data_paths):
+    # lookup tables built by _load_data, also stored in the compiled reference data (see load_reference)
+    REFERENCE_TABLES = ('drugid2name', 'unii2drugid', 'rxcui2drugid', 'atc2drugid', 'name2drug_id', 'pchem_synonym2id',
+                        'rxnorm2drugbank', 'rxcui2pref', 'rxnorm2drugbank_umls')
+
+    def __init__(self, data_paths, reference=None):
         """
         :param data_paths: Dictionary with keys
             drug_data, drugname2dbid, rxnorm2drugbank-umls, RXNCONSO
+        :param reference: optional ReferenceData to take the lookup tables from instead of the raw files
         """
         self.data_paths = data_paths
         self.pubchem_cache = {}
-        self._load_data()
+        self._drug_data = None
+        if reference is None:
+            self._load_data()
+        else:
+            self.load_reference(reference)
+
+    @property
+    def drug_data(self):
+        # the full DrugBank table is only needed to build the tables and the KG, it is read on first use
+        if self._drug_data is None:
+            self._drug_data = pd.read_pickle(self.data_paths['drug_data'])
+        return self._drug_data
+
+    def reference_tables(self):
+        return {f'drugs/{name}': getattr(self, name) for name in self.REFERENCE_TABLES}
+
+    def load_reference(self, reference):
+        for name in self.REFERENCE_TABLES:
+            setattr(self, name, reference[f'drugs/{name}'])
 
     def _load_data(self):
-        data_paths = self.data_paths
-        self.drug_data = pd.read_pickle(data_paths['drug_data'])
         self._load_pubchem_synonyms()
 
         self._load_drugbank_data()
@@ -221,16 +221,24 @@ class CriteriaOutputParser:
                         else:
                             crit_dict[category]['exclusion'].add(crit)
 
-    def parse_trial(self, nctid):
+    @staticmethod
+    def output_path(basedir, nctid):
         folder = nctid[:-4] + "x" * 4
-        filename = os.path.join(self.basedir, folder, nctid + '.json')
-        output = self.parse_crit_output_from_file(filename)
+        return os.path.join(basedir, folder, nctid + '.json')
+
+    def parse_trial(self, nctid):
+        output = self.parse_crit_output_from_file(self.output_path(self.basedir, nctid))
         self.pb.update()
+        return output
 
     @staticmethod
     def parse_crit_output_from_file(filename: str):
         with open(filename, 'r') as f:
-            criteria = json.load(f)['eligibility criteria']
+            return CriteriaOutputParser.parse_crit_output(json.load(f))
+
+    @staticmethod
+    def parse_crit_output(output: dict):
+        criteria = output['eligibility criteria']
         exclusion_criteria = criteria['exclusion_criteria']
         inclusion_criteria = criteria['inclusion_criteria']
         crit_dict = defaultdict(lambda: {'inclusion': set(), 'exclusion': set()})
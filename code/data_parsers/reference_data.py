@@ -0,0 +1,440 @@
+import json
+import os
+import pickle
+import shutil
+import time
+import zlib
+from collections import defaultdict
+from collections.abc import Mapping
+
+import numpy as np
+
+REFERENCE_VERSION = 2
+MANIFEST_FILE = 'manifest.json'
+
+
+def fingerprint_files(paths):
+    """Cheap identity (size, mtime) of the raw sources, used to detect a stale reference data directory."""
+    fingerprint = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        fingerprint[path] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def _encode(string):
+    return string.encode('utf-8', 'surrogatepass')
+
+
+class StringTable:
+    """Strings stored as one utf-8 blob plus offsets, `table[i]` decodes the i-th string."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def build(strings):
+        encoded = [_encode(string) for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return offsets, data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes()
+
+    def __getitem__(self, idx):
+        return self.raw(idx).decode('utf-8', 'surrogatepass')
+
+
+class StringIndex:
+    """
+    Open addressing hash index (crc32, linear probing) over a StringTable of unique keys. The slot array is a plain
+    int32 array, so the index is memory-mapped like the table instead of being rebuilt as a dict on every start.
+    """
+
+    def __init__(self, keys, slots):
+        self.keys = keys
+        self.slots = slots
+        self.mask = len(slots) - 1
+
+    @staticmethod
+    def build(keys):
+        size = 8
+        while size < 2 * len(keys):
+            size *= 2
+        slots = np.full(size, -1, dtype=np.int32)
+        mask = size - 1
+        for pos, key in enumerate(keys):
+            slot = zlib.crc32(_encode(key)) & mask
+            while slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            slots[slot] = pos
+        return slots
+
+    def find(self, key):
+        """Position of `key` in the table or -1."""
+        if not isinstance(key, str):
+            return -1
+        encoded = _encode(key)
+        slot = zlib.crc32(encoded) & self.mask
+        while True:
+            pos = int(self.slots[slot])
+            if pos < 0 or self.keys.raw(pos) == encoded:
+                return pos
+            slot = (slot + 1) & self.mask
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for pos in range(len(self.keys)):
+            yield self.keys[pos]
+
+
+class _IndexedMap(Mapping):
+    """Read-only mapping over a StringIndex, subclasses decode the value at a key position."""
+    default_empty = False
+
+    def __init__(self, index):
+        self.index = index
+
+    def _value(self, pos):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        pos = self.index.find(key)
+        if pos < 0:
+            if self.default_empty:
+                # defaultdict(set) semantics, without inserting the key
+                return set()
+            raise KeyError(key)
+        return self._value(pos)
+
+    def __contains__(self, key):
+        return self.index.find(key) >= 0
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class StrMap(_IndexedMap):
+    """{str: str}"""
+
+    def __init__(self, index, values):
+        super().__init__(index)
+        self.values_table = values
+
+    def _value(self, pos):
+        return self.values_table[pos]
+
+
+class SetMap(_IndexedMap):
+    """{str: set of str}, members in CSR form (indptr per key) as positions in a shared string table."""
+
+    def __init__(self, index, indptr, members, strings, default_empty=False):
+        super().__init__(index)
+        self.indptr = indptr
+        self.members = members
+        self.strings = strings
+        self.default_empty = default_empty
+
+    def _value(self, pos):
+        strings = self.strings
+        return {strings[member] for member in self.members[self.indptr[pos]:self.indptr[pos + 1]]}
+
+
+class TupleSetMap(SetMap):
+    """{str: set of equal length tuples of str}, `members` is a (rows, tuple length) matrix."""
+
+    def _value(self, pos):
+        strings = self.strings
+        rows = self.members[self.indptr[pos]:self.indptr[pos + 1]]
+        return {tuple(strings[field] for field in row) for row in rows}
+
+
+class NestedSetMap(Mapping):
+    """{str: {column: set of str}} with one SetMap per column, missing keys and columns read as empty."""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, key):
+        value = defaultdict(set)
+        for column, mapping in self.columns.items():
+            if key in mapping:
+                value[column] = mapping[key]
+        return value
+
+    def __contains__(self, key):
+        return any(key in mapping for mapping in self.columns.values())
+
+    def __iter__(self):
+        seen = set()
+        for mapping in self.columns.values():
+            for key in mapping:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class NestedPairMap(Mapping):
+    """
+    {str: {str: set of str}} view of a TupleSetMap of (column, member) pairs, e.g. {CUI: {vocabulary: codes}}. Values
+    are defaultdict(set), so missing keys and columns read as empty, like a nested defaultdict.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __getitem__(self, key):
+        value = defaultdict(set)
+        if key in self.pairs:
+            for column, member in self.pairs[key]:
+                value[column].add(member)
+        return value
+
+    def __contains__(self, key):
+        return key in self.pairs
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def __len__(self):
+        return len(self.pairs)
+
+
+def _is_string_set(value):
+    return isinstance(value, (set, frozenset)) and all(isinstance(member, str) for member in value)
+
+
+def _table_kind(mapping):
+    values = list(mapping.values())
+    if all(isinstance(value, str) for value in values):
+        return 'str'
+    if all(_is_string_set(value) for value in values):
+        return 'set'
+    if all(isinstance(value, (set, frozenset)) for value in values):
+        members = [member for value in values for member in value]
+        if all(isinstance(member, tuple) and len(member) == len(members[0])
+               and all(isinstance(field, str) for field in member) for member in members):
+            return 'tuple_set'
+    if all(isinstance(value, dict) and all(_is_string_set(member) for member in value.values()) for value in values):
+        return 'nested_set'
+    return 'pickle'
+
+
+class ReferenceWriter:
+    """
+    Writes named lookup tables into a new reference data directory. Tables are numpy arrays (string tables, hash
+    index slots, CSR offsets) in .npy files that `ReferenceData` memory-maps. The directory is written next to its
+    final location and swapped in by `finish`, so readers never see a partial one.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.tmp_dir = out_dir + '.tmp'
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self.tables = {}
+
+    def _save(self, name, array_name, array):
+        filename = f"{name.replace('/', '.')}.{array_name}.npy"
+        np.save(os.path.join(self.tmp_dir, filename), array)
+        return filename
+
+    def _save_strings(self, name, array_name, strings):
+        offsets, data = StringTable.build(strings)
+        return {'offsets': self._save(name, f'{array_name}_offsets', offsets),
+                'data': self._save(name, f'{array_name}_data', data)}
+
+    def _save_keys(self, name, keys):
+        return {'keys': self._save_strings(name, 'keys', keys),
+                'slots': self._save(name, 'slots', StringIndex.build(keys))}
+
+    def _copy_strings(self, name, array_name, strings):
+        return {'offsets': self._save(name, f'{array_name}_offsets', strings.offsets),
+                'data': self._save(name, f'{array_name}_data', strings.data)}
+
+    def _copy_table(self, name, mapping):
+        # a table of another ReferenceData is written array by array, its values are never decoded
+        table = {'size': len(mapping), 'default_empty': mapping.default_empty,
+                 'keys': self._copy_strings(name, 'keys', mapping.index.keys),
+                 'slots': self._save(name, 'slots', mapping.index.slots)}
+        if isinstance(mapping, StrMap):
+            table.update({'kind': 'str', 'values': self._copy_strings(name, 'values', mapping.values_table)})
+        else:
+            table.update({'kind': 'tuple_set' if isinstance(mapping, TupleSetMap) else 'set',
+                          'indptr': self._save(name, 'indptr', mapping.indptr),
+                          'members': self._save(name, 'members', mapping.members),
+                          'strings': self._copy_strings(name, 'strings', mapping.strings)})
+        self.tables[name] = table
+        return table
+
+    def add(self, name, mapping):
+        """Add {str: str | set of str | set of tuples | {column: set of str}}, other mappings are pickled."""
+        if isinstance(mapping, (StrMap, SetMap)):
+            return self._copy_table(name, mapping)
+        default_empty = isinstance(mapping, defaultdict) and mapping.default_factory is set
+        keys = [key for key in mapping if isinstance(key, str)]
+        if len(keys) < len(mapping):
+            # e.g. NaN identifiers from pandas, never hit by string lookups
+            print(f"{name}: skipping {len(mapping) - len(keys)} non-string keys")
+        mapping = {key: mapping[key] for key in keys}
+        kind = _table_kind(mapping)
+        table = {'kind': kind, 'size': len(keys)}
+        if kind == 'str':
+            table.update(self._save_keys(name, keys))
+            table['values'] = self._save_strings(name, 'values', [mapping[key] for key in keys])
+        elif kind in ('set', 'tuple_set'):
+            table.update(self._save_keys(name, keys))
+            table.update(self._save_members(name, kind, [mapping[key] for key in keys]))
+        elif kind == 'nested_set':
+            columns = sorted({column for value in mapping.values() for column in value})
+            table['columns'] = {}
+            for column in columns:
+                column_name = f'{name}/{column}'
+                self.add(column_name, {key: value[column] for key, value in mapping.items() if column in value})
+                table['columns'][column] = column_name
+        else:
+            table['pickle'] = f"{name.replace('/', '.')}.pkl"
+            with open(os.path.join(self.tmp_dir, table['pickle']), 'wb') as f:
+                pickle.dump(mapping, f, protocol=pickle.HIGHEST_PROTOCOL)
+        table['default_empty'] = default_empty
+        self.tables[name] = table
+        return table
+
+    def add_grouped(self, name, keys, groups, members, strings, default_empty=False, kind='tuple_set'):
+        """
+        Add {keys[group]: set of tuples of strings} given as arrays: row i of the int matrix `members` holds positions
+        in `strings` and belongs to the key at position `groups[i]`. Stored like `add` stores a mapping to sets of
+        tuples, without ever building the mapping as Python sets. Duplicate rows are dropped. With kind 'set'
+        `members` holds one position per row and the values are sets of strings.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        # (an empty table has no row width to infer)
+        members = np.asarray(members, dtype=np.int32).reshape(len(groups), -1 if len(groups) else 1)
+        # sorts the rows by group (then members) and removes duplicates
+        rows = np.unique(np.column_stack([groups, members]), axis=0)
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[:, 0], minlength=len(keys)), out=indptr[1:])
+        members = np.ascontiguousarray(rows[:, 1:], dtype=np.int32)
+        if kind == 'set':
+            members = members[:, 0]
+        table = {'kind': kind, 'size': len(keys), 'default_empty': default_empty}
+        table.update(self._save_keys(name, keys))
+        table.update({'indptr': self._save(name, 'indptr', indptr), 'members': self._save(name, 'members', members),
+                      'strings': self._save_strings(name, 'strings', strings)})
+        self.tables[name] = table
+        return table
+
+    def _save_members(self, name, kind, values):
+        string2pos = {}
+        indptr = np.zeros(len(values) + 1, dtype=np.int64)
+        rows = []
+        for idx, value in enumerate(values):
+            for member in sorted(value):
+                fields = member if kind == 'tuple_set' else (member,)
+                rows.append([string2pos.setdefault(field, len(string2pos)) for field in fields])
+            indptr[idx + 1] = len(rows)
+        width = len(rows[0]) if rows else 1
+        members = np.array(rows, dtype=np.int32).reshape(len(rows), width)
+        if kind == 'set':
+            members = members[:, 0]
+        return {'indptr': self._save(name, 'indptr', indptr), 'members': self._save(name, 'members', members),
+                'strings': self._save_strings(name, 'strings', list(string2pos))}
+
+    def finish(self, sources):
+        manifest = {
+            'version': REFERENCE_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'sources': fingerprint_files(sources),
+            'tables': self.tables,
+        }
+        with open(os.path.join(self.tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # readers that still map files of the old directory keep them until they exit
+        old_dir = self.out_dir + '.old'
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        if os.path.exists(self.out_dir):
+            os.replace(self.out_dir, old_dir)
+        os.replace(self.tmp_dir, self.out_dir)
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        return manifest
+
+
+def read_manifest(ref_dir):
+    manifest_path = os.path.join(ref_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def is_stale(ref_dir, sources):
+    manifest = read_manifest(ref_dir)
+    if manifest is None or manifest['version'] != REFERENCE_VERSION:
+        return True
+    return manifest['sources'] != fingerprint_files(sources)
+
+
+class ReferenceData:
+    """
+    Read-only view of a directory written by `ReferenceWriter`. `reference[name]` returns the table as a mapping whose
+    arrays are memory-mapped, so opening takes no parsing and forked or separate worker processes share the pages.
+    """
+
+    def __init__(self, ref_dir):
+        manifest = read_manifest(ref_dir)
+        if manifest is None:
+            raise RuntimeError(f"No reference data found in {ref_dir}")
+        if manifest['version'] != REFERENCE_VERSION:
+            raise RuntimeError(f"Reference data version {manifest['version']} is not supported "
+                               f"(expected {REFERENCE_VERSION})")
+        self.ref_dir = ref_dir
+        self.manifest = manifest
+        self.tables = {}
+
+    def _array(self, filename):
+        return np.load(os.path.join(self.ref_dir, filename), mmap_mode='r')
+
+    def _strings(self, files):
+        return StringTable(self._array(files['offsets']), self._array(files['data']))
+
+    def _open(self, name):
+        table = self.manifest['tables'][name]
+        kind = table['kind']
+        if kind == 'pickle':
+            with open(os.path.join(self.ref_dir, table['pickle']), 'rb') as f:
+                return pickle.load(f)
+        if kind == 'nested_set':
+            return NestedSetMap({column: self[column_name] for column, column_name in table['columns'].items()})
+        index = StringIndex(self._strings(table['keys']), self._array(table['slots']))
+        if kind == 'str':
+            return StrMap(index, self._strings(table['values']))
+        map_class = SetMap if kind == 'set' else TupleSetMap
+        return map_class(index, self._array(table['indptr']), self._array(table['members']),
+                         self._strings(table['strings']), default_empty=table['default_empty'])
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            self.tables[name] = self._open(name)
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.manifest['tables']
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+def _encode(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+
+def canonical_json(payload):
+    """Stable text form of a stage input: sorted keys, sets as sorted lists, anything else non-JSON as str."""
+    return json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=_encode)
+
+
+def stage_key(stage, version, payload):
+    return hashlib.sha256(f'{stage}\0{version}\0{canonical_json(payload)}'.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of parsing stage results in one SQLite file under `cache_dir`. An entry is keyed by the
+    hash of its stage name, the stage's tool/data version and its normalized input, so a changed tool or data file
+    simply stops matching old entries. Once the stored values exceed `max_bytes` the least recently used ones are
+    evicted. Hit and miss counts are kept per stage in the same file, so forked workers add to the same numbers.
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'results.sqlite')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        with self.lock:
+            self._connection()
+
+    def _connection(self):
+        # a connection must not cross a fork, children open their own
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(key TEXT PRIMARY KEY, stage TEXT, value BLOB, size INTEGER, last_used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (stage TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0)")
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, stage, version, payload):
+        """Cached result of `stage` for `payload`, or None."""
+        key = stage_key(stage, version, payload)
+        with self.lock:
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            conn.execute('INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(stage) DO UPDATE SET '
+                         'hits = hits + excluded.hits, misses = misses + excluded.misses',
+                         (stage, int(row is not None), int(row is None)))
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, stage, version, payload, value):
+        if value is None:
+            return
+        key = stage_key(stage, version, payload)
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+                conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                             (key, stage, blob, len(blob), time.time()))
+                total = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+                total += len(blob) - (row[0] if row is not None else 0)
+                if total > self.max_bytes:
+                    total = self._evict(conn, total)
+                conn.execute("UPDATE meta SET value = ? WHERE name = 'total_bytes'", (total,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _evict(self, conn, total):
+        # evict down to 90% of the budget, so that the next puts do not each evict again
+        target = int(self.max_bytes * 0.9)
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY last_used'):
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+        return total
+
+    def cached(self, stage, version, payload, compute):
+        """Cached result of `stage` for `payload`, computing and storing it with `compute()` on a miss."""
+        value = self.get(stage, version, payload)
+        if value is None:
+            value = compute()
+            self.put(stage, version, payload, value)
+        return value
+
+    def stats(self):
+        """{stage: {'hits', 'misses', 'entries', 'bytes'}} accumulated over the lifetime of the cache file."""
+        with self.lock:
+            conn = self._connection()
+            stats = {stage: {'hits': hits, 'misses': misses, 'entries': 0, 'bytes': 0}
+                     for stage, hits, misses in conn.execute('SELECT stage, hits, misses FROM stats')}
+            for stage, entries, size in conn.execute('SELECT stage, COUNT(*), SUM(size) FROM results GROUP BY stage'):
+                stats.setdefault(stage, {'hits': 0, 'misses': 0})
+                stats[stage].update(entries=entries, bytes=size)
+        return stats
+
+
+def format_cache_stats(stats, since=None):
+    """Hit rates per stage, counted from the `since` snapshot of `ResultCache.stats()` if given."""
+    lines = []
+    for stage in sorted(stats):
+        hits = stats[stage]['hits'] - (since or {}).get(stage, {}).get('hits', 0)
+        misses = stats[stage]['misses'] - (since or {}).get(stage, {}).get('misses', 0)
+        lookups = hits + misses
+        rate = f'{100 * hits / lookups:.1f}%' if lookups else '-'
+        lines.append(f"{stage:<12} hit rate {rate:>6} ({hits}/{lookups}), "
+                     f"{stats[stage]['entries']} entries, {stats[stage]['bytes'] / 1024 ** 2:.1f} MB")
+    return '\n'.join(lines)
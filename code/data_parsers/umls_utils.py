@@ -1,78 +1,197 @@
 import os
-from collections import defaultdict
+from array import array
 
 from tqdm import tqdm
 
+from . import reference_data
+from .reference_data import NestedPairMap, ReferenceData, ReferenceWriter
+
 
 class UMLSUtils:
-    def __init__(self, umls_dir: str):
+    # MRREL relation types read by _parents, the only ones loaded by load_relations
+    PARENT_RELATIONS = ('CHD', 'RN', 'RQ', 'RO')
+
+    def __init__(self, umls_dir: str, reference=None, index_dir=None, relations_dir=None, parents_dir=None):
         self.umls_dir = umls_dir
+        self.reference = reference
+        self.index_dir = index_dir or os.path.join(umls_dir, 'mrconso_index')
+        self.relations_dir = relations_dir or os.path.join(umls_dir, 'mrrel_index')
+        self.parents_dir = parents_dir or os.path.join(umls_dir, 'parent_index')
         self.cuid2parents = {}
-        self._load_cuid2concept()
+        # precomputed {CUI: parents} read by `parents` instead of the memo, loaded with the reference data
+        self.parent_table = None
+        self._mrconso_index = None
+        self._mrrel_index = None
+        self._parent_index = None
+        if reference is None:
+            self.cuid2concept = self.mrconso_index['cuid2concept']
+        else:
+            self.cuid2concept = reference['umls/cuid2concept']
         self._concept2vocab = None
 
-    def _load_cuid2concept(self):
+    def sources(self):
+        return [f'{self.umls_dir}/META/MRCONSO.RRF', f'{self.umls_dir}/META/MRREL.RRF']
+
+    def reference_tables(self):
+        """Needs load_relations() first."""
+        tables = {'umls/cuid2concept': self.cuid2concept}
+        for rel in self.PARENT_RELATIONS:
+            tables[f'umls/relations/{rel}'] = self.relations.get(rel, {})
+        tables['umls/parents'] = self.parent_index['parents']
+        return tables
+
+    @property
+    def mrconso_index(self):
+        """
+        The MRCONSO tables (cuid2concept and concept2vocab) as memory-mapped reference data in `index_dir`, built by
+        one pass over MRCONSO.RRF if missing or older than the file.
+        """
+        if self._mrconso_index is None:
+            sources = [f'{self.umls_dir}/META/MRCONSO.RRF']
+            if reference_data.is_stale(self.index_dir, sources):
+                self._build_mrconso_index(sources)
+            self._mrconso_index = ReferenceData(self.index_dir)
+        return self._mrconso_index
+
+    def _build_mrconso_index(self, sources):
+        # CUI | LAT | TS | LUI | STT | SUI | ISPREF | AUI | SAUI | SCUI | SDUI | SAB | TTY | CODE | STR | SRL | SUPPRESS
+        # 0   | 1   | 2  | 3   | 4   | 5   | 6      | 7   | 8    | 9    | 10   | 11  | 12  | 13   | 14  | 15  | 16
         cuid2concept = {}
-        with open(f'{self.umls_dir}/META/MRCONSO.RRF') as f:
-            for concept in tqdm(f):
-                details = concept.strip().split("|")
-                if details[1] == 'ENG' and details[2] == 'P':
-                    cuid2concept[details[0]] = details[14]
-        self.cuid2concept = cuid2concept
+        cui_ids = {}
+        strings = {}
+        # one (CUI, SAB, CODE) row per unsuppressed atom, CUIs and SAB/CODE strings interned to ints
+        groups = array('i')
+        members = array('i')
+        with open(sources[0]) as f:
+            for line in tqdm(f):
+                vals = line.rstrip('\n').split('|')
+                if vals[1] == 'ENG' and vals[2] == 'P':
+                    cuid2concept[vals[0]] = vals[14]
+                if vals[16] in ('', 'N'):
+                    groups.append(cui_ids.setdefault(vals[0], len(cui_ids)))
+                    members.append(strings.setdefault(vals[11], len(strings)))
+                    members.append(strings.setdefault(vals[13], len(strings)))
+
+        writer = ReferenceWriter(self.index_dir)
+        writer.add('cuid2concept', cuid2concept)
+        writer.add_grouped('concept2vocab', list(cui_ids), groups, members, list(strings), default_empty=True)
+        writer.finish(sources)
 
     @property
     def concept2vocab(self):
+        """{CUI: {SAB: set of codes}} of the unsuppressed atoms, missing CUIs and vocabularies read as empty."""
         if self._concept2vocab is None:
-            self._load_concept2vocab()
+            self._concept2vocab = NestedPairMap(self.mrconso_index['concept2vocab'])
         return self._concept2vocab
 
-    def _load_concept2vocab(self):
-        concept2vocab = defaultdict(lambda: defaultdict(set))
-        with open(f'{self.umls_dir}/META/MRCONSO.RRF') as f:
+    @property
+    def mrrel_index(self):
+        """
+        The PARENT_RELATIONS of MRREL as memory-mapped reference data in `relations_dir`, built by one pass over
+        MRREL.RRF if missing or older than the file.
+        """
+        if self._mrrel_index is None:
+            sources = [f'{self.umls_dir}/META/MRREL.RRF']
+            if reference_data.is_stale(self.relations_dir, sources):
+                self._build_mrrel_index(sources)
+            self._mrrel_index = ReferenceData(self.relations_dir)
+        return self._mrrel_index
+
+    def _build_mrrel_index(self, sources):
+        # CUI1 | AUI1 | STYPE1 | REL | CUI2 | AUI2 | STYPE2 | RELA | RUI | SRUI | SAB | SL | RG | DIR | SUPPRESS |CVF
+        # 0    | 1    | 2      | 3   | 4    | 5    | 6      | 7    | 8   | 9    | 10 | 11  | 12 | 13  | 14       | 15
+        # CUI2 has relation REL with CUI1
+        # per REL: CUI2 ids, strings, and one (CUI1, RELA, SAB, SL, SUPPRESS) row per relation, interned to ints
+        tables = {rel: ({}, {}, array('i'), array('i')) for rel in self.PARENT_RELATIONS}
+        with open(sources[0]) as f:
             for line in tqdm(f):
-                cols = ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB', 'TTY',
-                        'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']
-                vals = line.strip().split("|")[:-1]
-                # rint(vals, cols)
-                assert len(vals) == len(cols)
-                parsed = dict(zip(cols, vals))
-                if parsed['SUPPRESS'] in ['', "N"]:
-                    concept2vocab[parsed['CUI']][parsed['SAB']].add(parsed['CODE'])
-        self._concept2vocab = concept2vocab
+                vals = line.rstrip('\n').split('|')
+                table = tables.get(vals[3])
+                if table is None:
+                    continue
+                cui_ids, strings, groups, members = table
+                groups.append(cui_ids.setdefault(vals[4], len(cui_ids)))
+                for column in (0, 7, 10, 11, 14):
+                    members.append(strings.setdefault(vals[column], len(strings)))
+
+        writer = ReferenceWriter(self.relations_dir)
+        for rel, (cui_ids, strings, groups, members) in tables.items():
+            writer.add_grouped(f'relations/{rel}', list(cui_ids), groups, members, list(strings), default_empty=True)
+        writer.finish(sources)
 
     def load_relations(self):
-        relations_path = os.path.join(self.umls_dir, 'concept_relations.pkl')
-        if True or not os.path.exists(relations_path):
-            relations = defaultdict(lambda: defaultdict(set))
-            relations_flat = defaultdict(set)
-            # CUI1 | AUI1 | STYPE1 | REL | CUI2 | AUI2 | STYPE2 | RELA | RUI | SRUI | SAB | SL | RG | DIR | SUPPRESS |CVF
-            # 0    | 1    | 2      | 3   | 4    | 5    | 6      | 7    | 8   | 9    | 10 | 11  | 12 | 13  | 14       | 15
-            # CUI2 has relation REL with CUI1
-            with open(f'{self.umls_dir}/META/MRREL.RRF') as f:
-                for rel in tqdm(f):
-                    rel = rel.strip().split("|")
-                    relations[rel[3]][rel[4]].add((rel[0], rel[7], rel[10], rel[11], rel[14]))
-                    relations_flat[rel[4]].add((rel[0], rel[3], rel[7], rel[10], rel[11], rel[14]))
-            self.relations = {k: v for k, v in relations.items()}
-            self.relations_flat = {k: v for k, v in relations_flat.items()}
-        #     with open(relations_path, 'wb') as f:
-        #         pickle.dump(self.relations, f)
-        #     with open(os.path.join(self.umls_dir, 'concept_relations_flat.pkl'), 'wb') as f:
-        #         pickle.dump(self.relations_flat, f)
-        # else:
-        #     with open(relations_path, 'rb') as f:
-        #         gc.disable()
-        #         self.relations_flat = pickle.load(f)
-        #         gc.enable()
-        #     with open(os.path.join(self.umls_dir, 'concept_relations_flat.pkl'), 'rb') as f:
-        #         gc.disable()
-        #         self.relations = pickle.load(f)
-        #         gc.enable()
+        """
+        {REL: {CUI2: set of (CUI1, RELA, SAB, SL, SUPPRESS)}} of the PARENT_RELATIONS, the only ones _parents reads.
+        """
+        if self.reference is not None:
+            self.relations = {rel: self.reference[f'umls/relations/{rel}'] for rel in self.PARENT_RELATIONS}
+            self.parent_table = self.reference['umls/parents']
+        else:
+            self.relations = {rel: self.mrrel_index[f'relations/{rel}'] for rel in self.PARENT_RELATIONS}
+
+    @property
+    def parent_index(self):
+        """
+        The parents of every CUI (see compute_parents) as memory-mapped reference data in `parents_dir`, computed if
+        missing or older than MRCONSO.RRF and MRREL.RRF. Needs load_relations() first.
+        """
+        if self._parent_index is None:
+            sources = self.sources()
+            if reference_data.is_stale(self.parents_dir, sources):
+                self._build_parent_index(sources)
+            self._parent_index = ReferenceData(self.parents_dir)
+        return self._parent_index
+
+    def _build_parent_index(self, sources):
+        cuids = {cuid for rel in self.PARENT_RELATIONS for cuid in self.relations[rel]}
+        computed = self.compute_parents(sorted(cuids))
+        keys = [cuid for cuid, parents in computed.items() if parents]
+        strings = {}
+        groups = array('i')
+        members = array('i')
+        for group, cuid in enumerate(keys):
+            for parent in computed[cuid]:
+                groups.append(group)
+                members.append(strings.setdefault(parent, len(strings)))
+
+        writer = ReferenceWriter(self.parents_dir)
+        writer.add_grouped('parents', keys, groups, members, list(strings), default_empty=True, kind='set')
+        writer.finish(sources)
+
+    def compute_parents(self, cuids):
+        """
+        {CUI: parents} of `cuids` and of the representative terms they lead to, the same as `_parents` but without
+        recursion. A cycle of representative terms (on which `_parents` never returns) falls back to RO.
+        """
+        computed = {}
+        for cuid in tqdm(cuids):
+            # follow the representative terms until one that is computed, has none, or closes a cycle
+            chain = []
+            in_chain = set()
+            while cuid not in computed and cuid not in in_chain:
+                parents, representative = self._own_parents(cuid)
+                chain.append((cuid, parents, representative))
+                in_chain.add(cuid)
+                if representative is None:
+                    break
+                cuid = representative
+            for cuid, parents, representative in reversed(chain):
+                if representative is not None:
+                    parents = set(computed.get(representative, ()))
+                if len(parents) == 0:
+                    parents = self._mth_parents(cuid)
+                computed[cuid] = parents
+        return computed
 
     def parents(self, cuid):
-        if cuid not in self.cuid2parents:
-            self.cuid2parents[cuid] = self._parents(cuid)
-        return self.cuid2parents[cuid]
+        if self.parent_table is not None:
+            return self.parent_table[cuid]
+        # the memo is shared by the trials parsed concurrently against one ParserContext (see parse_trial)
+        parents = self.cuid2parents.get(cuid)
+        if parents is None:
+            parents = self._parents(cuid)
+            self.cuid2parents[cuid] = parents
+        return parents
 
     @staticmethod
     def _get_relation_attribute(rel, attribute):
@@ -88,6 +207,18 @@ class UMLSUtils:
             return rel[1]
 
     def _parents(self, cuid):
+        parents, representative = self._own_parents(cuid)
+        if representative is not None:
+            # replace the current term with a representative term
+            parents = set(self.parents(representative))
+        if len(parents) == 0:
+            parents = self._mth_parents(cuid)
+        # if len(parents) == 0:
+        #     parents.add(cuid)
+        return parents
+
+    def _own_parents(self, cuid):
+        """(parents, None) from CHD, RN or RQ isa, or (set(), CUI) if RQ names one MDR representative term."""
         relations = self.relations
         cuid2concept = self.cuid2concept
         parents = set()
@@ -112,21 +243,23 @@ class UMLSUtils:
             if len(rels) > 1:
                 pass
             elif len(rels) == 1:
-                # replace the current term with a representative term
                 # print(criterion.term, criterion.concept['name'], cuid2concept[rels[0][0]])
-                parents = self.parents(rels[0][0])
+                return parents, rels[0][0]
             else:
                 for rel in relations['RQ'][cuid]:
                     if self._get_relation_attribute(rel, 'RELA') == 'isa' and rel[0] in cuid2concept:
                         parents.add(rel[0])
                 if cuid in parents:
                     parents.remove(cuid)
-        if len(parents) == 0 and cuid in relations['RO']:
-            for rel in relations['RO'][cuid]:
-                if self._get_relation_attribute(rel, 'VOCAB') == 'MTH' and rel[0] in cuid2concept:
+        return parents, None
+
+    def _mth_parents(self, cuid):
+        """The RO fallback of _parents: related concepts of the MTH vocabulary."""
+        parents = set()
+        if cuid in self.relations['RO']:
+            for rel in self.relations['RO'][cuid]:
+                if self._get_relation_attribute(rel, 'VOCAB') == 'MTH' and rel[0] in self.cuid2concept:
                     parents.add(rel[0])
             if cuid in parents:
                 parents.remove(cuid)
-        # if len(parents) == 0:
-        #     parents.add(cuid)
         return parents
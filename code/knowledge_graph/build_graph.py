@@ -1,70 +1,215 @@
-import csv
+import copy
+import functools
+import math
+import multiprocessing
 import os
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple
 
 import networkx as nx
-import obonet
-from goatools import obo_parser
 from tqdm import tqdm
 
-from .kg import BioKG, Entity, EntityKey, EntityType, Source, Relation
+from .columnar import read_tsv_columns
+from .compact_kg import CompactBioKG
+from .instrumentation import BuildProfiler, write_build_report
+from .kg import BioKG, Entity, EntityKey, EntityType, Source, Relation, TrialOverlayKG
+from .mesh_closure import MeshClosure
+from .ontology_cache import load_ontology
 
 DATA_DIR = "data"
+
+
+class TrialUpdate(NamedTuple):
+    removed_arms: set  # arms of the previous graph that are gone
+    added_arms: set  # arms that did not exist in the previous graph
+    replaced_arms: set  # arms rebuilt under the same key
+    touched: set  # entities linked to any removed, added or replaced arm
+
+
+def arm_nct_id(arm_key):
+    return arm_key.id.split(':', 1)[0]
+
+
+def _profiled_stage(method):
+    """Run a `KnowledgeGraphBuilder` method as a profiled build stage, see `KnowledgeGraphBuilder._stage`."""
+    name = method.__name__.lstrip('_')
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._stage(name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _RecordingOverlayKG(TrialOverlayKG):
+    """Overlay that also logs every add call, so trials built in a worker can be replayed on the main KG in order."""
+
+    def __init__(self, base):
+        super().__init__(base)
+        self.ops = []
+
+    def add_entity(self, entity: Entity, allow_existing: bool = False):
+        super().add_entity(entity, allow_existing=allow_existing)
+        self.ops.append(('entity', (entity, allow_existing)))
+
+    def add_relation(self, e1: EntityKey, e2: EntityKey, relation: str, source: Source, attrs=None):
+        super().add_relation(e1, e2, relation, source, attrs=attrs)
+        self.ops.append(('relation', (e1, e2, relation, source, attrs)))
+
+    def add_entities_bulk(self, entities, allow_existing: bool = False):
+        entities = list(entities)
+        cnt = super().add_entities_bulk(entities, allow_existing=allow_existing)
+        self.ops.append(('entities_bulk', (entities, allow_existing)))
+        return cnt
+
+    def add_relations_bulk(self, relations):
+        relations = list(relations)
+        cnt = super().add_relations_bulk(relations)
+        self.ops.append(('relations_bulk', (relations,)))
+        return cnt
+
+
+# set in every worker by _init_trial_shard (inherited through fork, never pickled)
+_shard_state = None
+
+
+def _init_trial_shard(builder, trial_df, filter_fn):
+    global _shard_state
+    _shard_state = (builder, trial_df, filter_fn)
+
+
+def _build_trial_shard(positions):
+    builder, trial_df, filter_fn = _shard_state
+    shard_builder = copy.copy(builder)
+    shard_builder.biokg = _RecordingOverlayKG(builder.biokg)
+    cnt = 0
+    weird = 0
+    for pos in positions:
+        row = trial_df.iloc[pos]
+        if not filter_fn(row):
+            continue
+        trial_builder = TrialGraphBuilder(shard_builder, row)
+        trial_builder.build(use_population=True)
+        if trial_builder.weird:
+            weird += 1
+        if trial_builder.no_disease:
+            cnt += 1
+    return shard_builder.biokg.ops, cnt, weird
+
+
 class KnowledgeGraphBuilder:
     def __init__(self, mesh_dis_data, drug_data, ext_basepath, cuid2term, umls_utils,
                  umls_graph_clip_threshold=10, 
-                 build_ae=False):
+                 build_ae=False, load_external=True, compact=False, profiler=None, report_dir=None,
+                 report_tree=False):
         self.biokg = None
+        self.compact = compact
+        self.profiler = profiler if profiler is not None else BuildProfiler()
+        # a JSON build report (and a folded stage tree with report_tree) is written here after each build
+        self.report_dir = report_dir
+        self.report_tree = report_tree
         self.mesh_dis_data = mesh_dis_data
         self.drug_data = drug_data
         self.ext_basepath = ext_basepath
-        self._load_external_networks(ext_basepath)
+        if load_external:
+            with self._stage('load_external_networks'):
+                self._load_external_networks(ext_basepath)
         self.build_ae = build_ae
         self.umls_utils = umls_utils
         self.cuid2term = cuid2term
         self.umls_graph_clip_threshold = umls_graph_clip_threshold
+        self._init_keys()
+
+    def _init_keys(self):
+        self.mesh_dis_key = lambda _id: EntityKey(type=EntityType.DISEASE, id=_id, source=Source.MESH)
+        self.drug_ont_key = lambda _id: EntityKey(type=EntityType.DRUGONT, id=_id, source=Source.CLASSYFIRE)
+        self.drug_key = lambda _id: EntityKey(type=EntityType.DRUG, id=_id, source=Source.DRUGBANK)
+        self.protein_key = lambda _id: EntityKey(type=EntityType.PROTEIN, id=_id, source=Source.ENTREZ)
+        self.function_key = lambda _id: EntityKey(type=EntityType.FUNCTION, id=_id, source=Source.GO)
+        self.umls_key = lambda _id: EntityKey(type=EntityType.UMLS, id=_id, source=Source.UMLS)
+        self.pom_key = lambda _id: EntityKey(type=EntityType.PRIMARY_OUTCOME, id=_id, source=Source.CUSTOM_VOCAB)
+        self.ae_cat_key = lambda _idx: EntityKey(type=EntityType.SIDE_EFFECT_CAT, id=_idx, source=Source.CLINICAL_TRIAL)
 
-    def _load_external_networks(self, ext_basepath):
-        def read_tsv(filename):
-            data = []
-            with open(filename) as f:
-                reader = csv.DictReader(f, delimiter='\t')
-                for row in reader:
-                    data.append(row)
-            return data
+    @contextmanager
+    def _stage(self, name):
+        """Profile a build stage; while it runs the KG reports the nodes and edges it adds to the profiler."""
+        biokg = self.biokg
+        previous = biokg.counters if biokg is not None else None
+        if biokg is not None:
+            biokg.counters = self.profiler
+        try:
+            with self.profiler.stage(name):
+                yield
+        finally:
+            if biokg is not None:
+                biokg.counters = previous
+
+    def write_report(self):
+        if self.report_dir is None:
+            return None
+        return write_build_report(self.profiler, self.report_dir, tree=self.report_tree)
+
+    def attach_snapshot(self, snapshot):
+        """
+        Use a prebuilt external network snapshot (see `knowledge_graph.snapshot`) as the base KG instead of
+        building it with `build_external_networks`.
+        """
+        self.biokg = snapshot.biokg
+        self.mesh_closure = snapshot.mesh_closure
+
+    def trial_overlay(self):
+        """
+        Shallow copy of this builder whose KG is a writable overlay over the current (read-only) KG. Trial arms
+        built with the returned builder never touch the shared base graph.
+        """
+        builder = copy.copy(self)
+        builder.biokg = TrialOverlayKG(self.biokg)
+        return builder
 
+    def _load_external_networks(self, ext_basepath):
         # external datasets
+        # ontologies are parsed once and cached next to the OBO files, see ontology_cache.load_ontology
         # chemical ontology for drug-drug
         classyfire_path = f'{ext_basepath}/classyfire'
-
-        chemical_ontology = os.path.join(classyfire_path, 'ChemOnt_2_1.obo')
-        self.chemical_ont_graph = obonet.read_obo(chemical_ontology)
+        self.chemical_ontology = load_ontology(os.path.join(classyfire_path, 'ChemOnt_2_1.obo'), 'chemont')
 
         # function-function
-        go_obo_url = 'http://purl.obolibrary.org/obo/go-basic.obo'
         go_base_path = f'{ext_basepath}/go'
+        self.go_ontology = load_ontology(os.path.join(go_base_path, 'go-basic.obo'), 'go')
 
-        self.go_dag = obo_parser.GODag(os.path.join(go_base_path, 'go-basic.obo'), ['relationship', 'xref'])
-
+        # only the columns used by the stages below are kept, see read_tsv_columns for the on-disk cache
         # protein-function
-        self.protein_function = read_tsv(os.path.join(ext_basepath, 'protein-function.tsv'))
+        self.protein_function = read_tsv_columns(
+            os.path.join(ext_basepath, 'protein-function.tsv'),
+            ['protein_entrez_id', 'function_id', 'evidence_code', 'function_namespace'],
+            categorical=['evidence_code', 'function_namespace'])
 
         # drug-phenotype
-        self.drug_phenotype = read_tsv(os.path.join(ext_basepath, 'drug-phenotype.tsv'))
+        self.drug_phenotype = read_tsv_columns(os.path.join(ext_basepath, 'drug-phenotype.tsv'),
+                                               ['drug_id', 'phenotype_id', 'relation'], categorical=['relation'])
 
         # drug-protein
-        self.drug_protein = read_tsv(os.path.join(ext_basepath, 'drug-protein.tsv'))
+        self.drug_protein = read_tsv_columns(os.path.join(ext_basepath, 'drug-protein.tsv'),
+                                             ['drug_id', 'protein_entrez_id', 'action'], categorical=['action'])
 
         # protein-protein
-        self.protein_protein = read_tsv(os.path.join(ext_basepath, 'multiscale-interactome', 'protein_to_protein.tsv'))
+        self.protein_protein = read_tsv_columns(
+            os.path.join(ext_basepath, 'multiscale-interactome', 'protein_to_protein.tsv'),
+            ['node_1', 'node_2', 'node_1_name', 'node_2_name'])
 
         # disease-protein/gene - disgenet
-        self.disease_protein = read_tsv(os.path.join(ext_basepath, 'disgenet', 'curated_gene_disease_associations.tsv'))
+        self.disease_protein = read_tsv_columns(
+            os.path.join(ext_basepath, 'disgenet', 'curated_gene_disease_associations.tsv'), ['geneId', 'diseaseId'])
 
-        self.disease_mappings = read_tsv(os.path.join(ext_basepath, 'disgenet', 'disease_mappings.tsv'))
+        self.disease_mappings = read_tsv_columns(os.path.join(ext_basepath, 'disgenet', 'disease_mappings.tsv'),
+                                                 ['diseaseId', 'vocabulary', 'code'], categorical=['vocabulary'])
 
+    @_profiled_stage
     def build_external_networks(self):
-        self.biokg = BioKG()
+        # the compact engine keeps the large external networks in int32 CSR arrays, see CompactBioKG
+        self.biokg = CompactBioKG() if self.compact else BioKG()
         self._disease_disease()
         self._drug_drug()
         self._protein_protein()
@@ -82,46 +227,91 @@ class KnowledgeGraphBuilder:
 
         self._primary_outcomes(f'{DATA_DIR}/outcome_data/clusters-outcome-measures.txt')
 
-    def build_all(self, trial_df, filter_fn):
-        self.build_external_networks()
-        self._add_trial_graph(trial_df, filter_fn=filter_fn)
-        self._remove_incomplete_arms()
-        self._remove_incomplete_arms()
-
+    def build_all(self, trial_df, filter_fn, num_workers=1):
+        with self._stage('build_all'):
+            self.build_external_networks()
+            if self.compact:
+                with self._stage('compact'):
+                    self.biokg.compact()
+                self.biokg = TrialOverlayKG(self.biokg)
+            self._add_trial_graph(trial_df, filter_fn=filter_fn, num_workers=num_workers)
+            self._remove_incomplete_arms()
+            self._remove_incomplete_arms()
+        self.write_report()
+
+    def _trial_arms(self, nct_ids):
+        return {node for node in self.biokg.graph if node.type == EntityType.TRIAL_ARM and arm_nct_id(node) in nct_ids}
+
+    def _arm_neighbors(self, arms):
+        graph = self.biokg.graph
+        neighbors = set()
+        for arm in arms:
+            neighbors.update(graph.successors(arm))
+            neighbors.update(graph.predecessors(arm))
+        return neighbors
+
+    def update_trials(self, trial_df, nct_ids, filter_fn):
+        """
+        Incrementally add, replace or remove the arms of the trials `nct_ids` on an already built KG (e.g. one loaded
+        with `incremental.load_kg_state`). Existing arms of these trials are dropped and the trials are rebuilt from
+        their `trial_df` rows; trials without a row (or rejected by `filter_fn`) are just removed. Incomplete arms are
+        only checked among the rebuilt arms.
+        """
+        with self._stage('update_trials'):
+            update = self._update_trials(trial_df, set(nct_ids), filter_fn)
+        self.write_report()
+        return update
+
+    def _update_trials(self, trial_df, nct_ids, filter_fn):
+        old_arms = self._trial_arms(nct_ids)
+        touched = self._arm_neighbors(old_arms)
+        self.biokg.graph.remove_nodes_from(old_arms)
+
+        rows = trial_df[trial_df['nct_id'].isin(nct_ids)]
+        self._add_trial_graph(rows, filter_fn=filter_fn)
+        new_arms = self._trial_arms(nct_ids)
+        self._remove_incomplete_arms(arms=new_arms)
+        self._remove_incomplete_arms(arms=new_arms)
+        new_arms = {arm for arm in new_arms if arm in self.biokg.graph}
+        touched.update(self._arm_neighbors(new_arms))
+
+        return TrialUpdate(removed_arms=old_arms - new_arms, added_arms=new_arms - old_arms,
+                           replaced_arms=old_arms & new_arms, touched=touched - old_arms - new_arms)
+
+    @_profiled_stage
     def _disease_disease(self):
         biokg = self.biokg
         mesh_graph = nx.DiGraph()
-        mesh_dis_key = lambda _id: EntityKey(type=EntityType.DISEASE, id=_id, source=Source.MESH)
-        for key, value in tqdm(self.mesh_dis_data.items()):
-            disease = Entity(key=mesh_dis_key(key), name=value.name, attrs={})
-            biokg.add_entity(disease)
-            mesh_graph.add_node(mesh_dis_key(key), name=value.name)
-        biokg.add_entity(Entity(key=mesh_dis_key('HEALTHY'), name='HEALTHY', attrs={}))
-        mesh_graph.add_node(mesh_dis_key('HEALTHY'), name='HEALTHY')
-        for key, value in self.mesh_dis_data.items():
-            e1 = mesh_dis_key(key)
-            for parent in value.parents:
-                e2 = mesh_dis_key(parent.ID)
-                biokg.add_relation(e1, e2, relation='has_parent', source=Source.MESH)
-                mesh_graph.add_edge(e1, e2, relation='has_parent')
-        self.mesh_dis_key = mesh_dis_key
+        mesh_dis_key = self.mesh_dis_key
+        diseases = [Entity(key=mesh_dis_key(key), name=value.name, attrs={})
+                    for key, value in tqdm(self.mesh_dis_data.items())]
+        diseases.append(Entity(key=mesh_dis_key('HEALTHY'), name='HEALTHY', attrs={}))
+        biokg.add_entities_bulk(diseases)
+        mesh_graph.add_nodes_from((disease.key, {'name': disease.name}) for disease in diseases)
+
+        edges = [(mesh_dis_key(key), mesh_dis_key(parent.ID)) for key, value in self.mesh_dis_data.items()
+                 for parent in value.parents]
+        biokg.add_relations_bulk((e1, e2, 'has_parent', Source.MESH) for e1, e2 in edges)
+        mesh_graph.add_edges_from(edges, relation='has_parent')
         self.mesh_graph = mesh_graph
 
+    @_profiled_stage
     def _drug_drug(self):
         ontname2ontid = {}
         biokg = self.biokg
-        drug_ont_key = lambda _id: EntityKey(type=EntityType.DRUGONT, id=_id, source=Source.CLASSYFIRE)
-        for node, data in self.chemical_ont_graph.nodes(data=True):
-            ontname2ontid[data['name']] = node
-            biokg.add_entity(Entity(key=drug_ont_key(node), name=data['name'], attrs=data))
-
-        for node in self.chemical_ont_graph.nodes():
-            u = drug_ont_key(node)
-            for parent in self.chemical_ont_graph[node]:
-                v = drug_ont_key(parent)
-                biokg.add_relation(u, v, relation='is_a', source=Source.CLASSYFIRE)
-
-        drug_key = lambda _id: EntityKey(type=EntityType.DRUG, id=_id, source=Source.DRUGBANK)
+        drug_ont_key = self.drug_ont_key
+        drug_key = self.drug_key
+        ontology = self.chemical_ontology
+        for node, name in zip(ontology.ids, ontology.names):
+            ontname2ontid[name] = node
+        biokg.add_entities_bulk(Entity(key=drug_ont_key(node), name=name, attrs=data)
+                                for node, name, data in zip(ontology.ids, ontology.names, ontology.data))
+
+        biokg.add_relations_bulk((drug_ont_key(node), drug_ont_key(ontology.ids[parent]), 'is_a', Source.CLASSYFIRE)
+                                 for idx, node in enumerate(ontology.ids)
+                                 for _, parents in ontology.typed_parents(idx)
+                                 for parent in parents.tolist())
+
         for idx, row in tqdm(self.drug_data.iterrows()):
             drug_id = row['primary_id']
             name = row['name']
@@ -139,124 +329,154 @@ class KnowledgeGraphBuilder:
                                    source=Source.DRUGBANK)
 
         biokg.add_entity(Entity(drug_key('D#######'), name='placebo', attrs={}))
-        self.drug_key = drug_key
 
+    @_profiled_stage
     def _protein_protein(self):
-        protein_key = lambda _id: EntityKey(type=EntityType.PROTEIN, id=_id, source=Source.ENTREZ)
+        protein_key = self.protein_key
         biokg = self.biokg
-        for row in tqdm(self.protein_protein):
-            n1 = protein_key(row['node_1'])
-            n2 = protein_key(row['node_2'])
-            biokg.add_entity(Entity(key=n1, name=row['node_1_name'], attrs={}), allow_existing=True)
-            biokg.add_entity(Entity(key=n2, name=row['node_2_name'], attrs={}), allow_existing=True)
-            biokg.add_relation(n1, n2, relation='affects', source=Source.MULTISCALE_INTERACTOME)
-        self.protein_key = protein_key
-
+        df = self.protein_protein
+        entities = []
+        relations = []
+        for node_1, node_2, node_1_name, node_2_name in tqdm(zip(df['node_1'], df['node_2'], df['node_1_name'],
+                                                                 df['node_2_name']), total=len(df)):
+            n1 = protein_key(node_1)
+            n2 = protein_key(node_2)
+            entities.append(Entity(key=n1, name=node_1_name, attrs={}))
+            entities.append(Entity(key=n2, name=node_2_name, attrs={}))
+            relations.append((n1, n2, 'affects', Source.MULTISCALE_INTERACTOME))
+        biokg.add_entities_bulk(entities, allow_existing=True)
+        biokg.add_relations_bulk(relations)
+
+    @_profiled_stage
     def _function_function(self):
-        function_key = lambda _id: EntityKey(type=EntityType.FUNCTION, id=_id, source=Source.GO)
+        function_key = self.function_key
         biokg = self.biokg
-        for goterm in tqdm(self.go_dag.values()):
-            id = goterm.id
-            namespace = goterm.namespace
-            name = goterm.name
+        ontology = self.go_ontology
+        entities = []
+        relations = []
+        for idx in tqdm(range(len(ontology))):
+            id = ontology.ids[idx]
+            namespace = ontology.namespace(idx)
+            name = ontology.names[idx]
 
             # Avoid obsolete terms, reconsider if some drug/disease function edge does nt have corresponding go term
-            if goterm.is_obsolete:
+            if ontology.is_obsolete(idx):
                 continue
             if namespace != 'biological_process':
                 continue
 
             n1 = function_key(id)
-            biokg.add_entity(Entity(key=n1, name=name, attrs={}), allow_existing=True)
-
-            def add_edge(relation, term):
-                if term.namespace != 'biological_process':
-                    return
-                n2 = function_key(term.id)
-                biokg.add_entity(Entity(key=n2, name=term.name, attrs={}), allow_existing=True)
-                biokg.add_relation(n1, n2, relation=relation, source=Source.GO)
-
-            for relation in goterm.relationship:
-                for term in goterm.relationship[relation]:
-                    add_edge(relation, term)
-            for parent in goterm._parents:
-                add_edge('is_a', self.go_dag[parent])
-
-            for alt_id in goterm.alt_ids:
-                biokg.add_entity(Entity(key=function_key(alt_id), name=name, attrs={}), allow_existing=True)
-                biokg.add_mapping(n1, function_key(alt_id), source=Source.GO)
-        self.function_key = function_key
+            entities.append(Entity(key=n1, name=name, attrs={}))
+
+            for relation, parents in ontology.typed_parents(idx):
+                for parent in parents.tolist():
+                    if ontology.namespace(parent) != 'biological_process':
+                        continue
+                    n2 = function_key(ontology.ids[parent])
+                    entities.append(Entity(key=n2, name=ontology.names[parent], attrs={}))
+                    relations.append((n1, n2, relation, Source.GO))
 
+            for alt_id in ontology.alt_ids[idx]:
+                entities.append(Entity(key=function_key(alt_id), name=name, attrs={}))
+                relations.append((n1, function_key(alt_id), 'KG-MERGE-SAME', Source.GO))
+
+        biokg.add_entities_bulk(entities, allow_existing=True)
+        biokg.add_relations_bulk(relations)
+
+    @_profiled_stage
     def _protein_function(self):
         biokg = self.biokg
-        for row in tqdm(self.protein_function):
-            if row['function_namespace'] != 'BP':
-                continue
-            protein = self.protein_key(row['protein_entrez_id'])
-            if protein not in biokg.graph:
+        df = self.protein_function
+        df = df[df['function_namespace'] == 'BP']
+        relations = []
+        for entrez_id, function_id, evidence_code in tqdm(zip(df['protein_entrez_id'], df['function_id'],
+                                                              df['evidence_code']), total=len(df)):
+            protein = self.protein_key(entrez_id)
+            if protein not in biokg:
                 # print(protein)
+                self.profiler.count('missing_protein')
                 continue
-            biokg.add_relation(protein, self.function_key(row['function_id']),
-                               relation='affects', source=Source.GAF, attrs={'evidence_code': row['evidence_code']})
+            relations.append((protein, self.function_key(function_id), 'affects', Source.GAF,
+                              {'evidence_code': evidence_code}))
+        biokg.add_relations_bulk(relations)
 
+    @_profiled_stage
     def _drug_phenotype(self):
         cnt = 0
         biokg = self.biokg
-        for row in tqdm(self.drug_phenotype):
-            drugk = self.drug_key(row['drug_id'])
-            fkey = self.function_key(row['phenotype_id'])
-            if fkey not in biokg.graph:
+        df = self.drug_phenotype
+        relations = []
+        for drug_id, phenotype_id, relation in tqdm(zip(df['drug_id'], df['phenotype_id'], df['relation']),
+                                                    total=len(df)):
+            drugk = self.drug_key(drug_id)
+            fkey = self.function_key(phenotype_id)
+            if fkey not in biokg:
                 cnt += 1
                 continue
-            biokg.add_relation(drugk, fkey, relation=row['relation'], source=Source.CTD)
+            relations.append((drugk, fkey, relation, Source.CTD))
+        biokg.add_relations_bulk(relations)
+        self.profiler.count('missing_function', cnt)
         print(cnt)
 
+    @_profiled_stage
     def _drug_protein(self):
         cnt = 0
         biokg = self.biokg
-        for row in tqdm(self.drug_protein):
-            drugk = self.drug_key(row['drug_id'])
-            proteink = self.protein_key(row['protein_entrez_id'])
-            if proteink not in biokg.graph:
+        df = self.drug_protein
+        relations = []
+        for drug_id, entrez_id, action_str in tqdm(zip(df['drug_id'], df['protein_entrez_id'], df['action']),
+                                                   total=len(df)):
+            drugk = self.drug_key(drug_id)
+            proteink = self.protein_key(entrez_id)
+            if proteink not in biokg:
                 cnt += 1
                 continue
-            actions = row['action'].split(",")
-            if row['action'] == '':
+            actions = action_str.split(",")
+            if action_str == '':
                 actions = ['unspecified']
             for action in actions:
                 if action not in ['inhibitor', 'substrate', 'antagonist', 'agonist', 'inducer']:
                     action = 'other'
-                biokg.add_relation(drugk, proteink, relation=action, source=Source.DRUGBANK)
+                relations.append((drugk, proteink, action, Source.DRUGBANK))
+        biokg.add_relations_bulk(relations)
+        self.profiler.count('missing_protein', cnt)
         print(cnt)
 
+    @_profiled_stage
     def _disease_gene(self):
         biokg = self.biokg
         allowed_cuis = defaultdict(set)
-        for row in tqdm(self.disease_mappings):
-            cuid = row['diseaseId']
-            if row['vocabulary'] == 'MSH' and self.mesh_dis_key(row['code']) in biokg.graph:
-                allowed_cuis[cuid].add(('MSH', row['code']))
+        df = self.disease_mappings
+        df = df[df['vocabulary'] == 'MSH']
+        for cuid, code in tqdm(zip(df['diseaseId'], df['code']), total=len(df)):
+            if self.mesh_dis_key(code) in biokg:
+                allowed_cuis[cuid].add(('MSH', code))
 
         cnt = 0
         dis = set()
         cnt2 = 0
-        for row in tqdm(self.disease_protein):
-            proteink = self.protein_key(row['geneId'].strip())
-            disease_id = row['diseaseId']
+        df = self.disease_protein
+        relations = []
+        for gene_id, disease_id in tqdm(zip(df['geneId'], df['diseaseId']), total=len(df)):
+            proteink = self.protein_key(gene_id.strip())
             if disease_id not in allowed_cuis:
                 cnt += 1
                 dis.add(disease_id)
                 continue
-            if proteink not in biokg.graph:
+            if proteink not in biokg:
                 cnt2 += 1
                 continue
             codes = allowed_cuis[disease_id]
             for code in codes:
                 if code[0] == 'MSH':
-                    biokg.add_relation(self.mesh_dis_key(code[1]), proteink, relation='dis-gene',
-                                       source=Source.DISGENET)
+                    relations.append((self.mesh_dis_key(code[1]), proteink, 'dis-gene', Source.DISGENET))
+        biokg.add_relations_bulk(relations)
+        self.profiler.count('unmapped_disease_rows', cnt)
+        self.profiler.count('unmapped_diseases', len(dis))
+        self.profiler.count('missing_protein', cnt2)
         print(cnt, len(dis), cnt2)
 
+    @_profiled_stage
     def _umls(self):
         cuid2term = self.cuid2term
         biokg = self.biokg
@@ -264,24 +484,24 @@ class KnowledgeGraphBuilder:
         for cuid, parents in cuid2term[self.umls_graph_clip_threshold].items():
             umls_concepts.update(parents)
 
-        self.umls_key = lambda _id: EntityKey(type=EntityType.UMLS, id=_id, source=Source.UMLS)
-        for cuid in umls_concepts:
-            biokg.add_entity(
-                Entity(key=self.umls_key(cuid), name=self.umls_utils.cuid2concept.get(cuid, cuid), attrs={}),
-                allow_existing=True)
+        biokg.add_entities_bulk(
+            (Entity(key=self.umls_key(cuid), name=self.umls_utils.cuid2concept.get(cuid, cuid), attrs={})
+             for cuid in umls_concepts), allow_existing=True)
 
+        relations = []
         for cuid in umls_concepts:
             for vocab, vocab_key in [('MSH', self.mesh_dis_key), ('DRUGBANK', self.drug_key),
                                      ('GO', self.function_key)]:
                 for code in self.umls_utils.concept2vocab[cuid][vocab]:
                     vk = vocab_key(code)
-                    if not biokg.graph.has_node(vk):
+                    if vk not in biokg:
                         if vocab == 'MSH':
                             # get the relations from chemical ontology here
                             # print(vk, cuid2concept[cuid])
                             pass
                         continue
-                    biokg.add_mapping(self.umls_key(cuid), vk, source='UMLS')
+                    relations.append((self.umls_key(cuid), vk, 'KG-MERGE-SAME', 'UMLS'))
+        biokg.add_relations_bulk(relations)
 
     def _ae_ae(self):
         raise NotImplementedError
@@ -289,28 +509,27 @@ class KnowledgeGraphBuilder:
     def _ae_protein(self):
         raise NotImplementedError
 
+    @_profiled_stage
     def _primary_outcomes(self, cid2cluster_path):
         cid2cluster = {}
         with open(cid2cluster_path, 'r') as f:
             for idx, line in enumerate(f.readlines()):
                 cluster, count = line.strip().split("\t")
                 cid2cluster[idx] = cluster
-        self.pom_key = lambda _id: EntityKey(type=EntityType.PRIMARY_OUTCOME, id=_id, source=Source.CUSTOM_VOCAB)
         for idx, cluster_content in cid2cluster.items():
             self.biokg.add_entity(Entity(key=self.pom_key(idx), name=cluster_content, attrs={}))
 
     def _mesh_children(self):
-        mesh_shortest_paths = nx.shortest_path(self.mesh_graph)
-        mesh_id2children = {}
-        for source in mesh_shortest_paths:
-            children = set([target.id for target in mesh_shortest_paths[source]])
-            children.remove(source.id)
-            mesh_id2children[source.id] = children
-        self.mesh_id2children = mesh_id2children
-
-    def _add_trial_graph(self, trial_df, filter_fn):
+        self.mesh_closure = MeshClosure.from_mesh_data(self.mesh_dis_data)
+
+    @_profiled_stage
+    def _add_trial_graph(self, trial_df, filter_fn, num_workers=1):
         self._mesh_children()
-        self.ae_cat_key = lambda _idx: EntityKey(type=EntityType.SIDE_EFFECT_CAT, id=_idx, source=Source.CLINICAL_TRIAL)
+        if num_workers > 1:
+            cnt, weird = self._add_trial_graph_sharded(trial_df, filter_fn, num_workers)
+            self._count_trials(cnt, weird)
+            return
+
         cnt = 0
         weird = 0
         for idx, row in tqdm(trial_df.iterrows(), total=len(trial_df)):
@@ -324,12 +543,56 @@ class KnowledgeGraphBuilder:
             if builder.no_disease:
                 cnt += 1
 
+        self._count_trials(cnt, weird)
+
+    def _count_trials(self, cnt, weird):
+        self.profiler.count('no_disease', cnt)
+        self.profiler.count('weird', weird)
         print(cnt, weird)
 
-    def _remove_incomplete_arms(self):
+    def _add_trial_graph_sharded(self, trial_df, filter_fn, num_workers):
+        """
+        Build the trials in a fork-based process pool. Every worker builds a contiguous shard of `trial_df` on a
+        recording overlay of the (read-only) current KG; the recorded add calls are replayed here shard by shard in
+        `trial_df` order, which gives the same graph as the serial path. Arm dicts of `trial_df` are only updated in
+        the workers, not in the caller's `trial_df`.
+        """
+        positions = list(range(len(trial_df)))
+        shard_size = max(1, math.ceil(len(positions) / (num_workers * 4)))
+        shards = [positions[start:start + shard_size] for start in range(0, len(positions), shard_size)]
+
+        cnt = 0
+        weird = 0
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(num_workers, mp_context=context, initializer=_init_trial_shard,
+                                 initargs=(self, trial_df, filter_fn)) as pool:
+            # map yields the shards in submission order, so the merge does not depend on worker timing
+            for ops, shard_cnt, shard_weird in tqdm(pool.map(_build_trial_shard, shards), total=len(shards)):
+                self._replay(ops)
+                cnt += shard_cnt
+                weird += shard_weird
+        return cnt, weird
+
+    def _replay(self, ops):
+        biokg = self.biokg
+        replay = {
+            'entity': biokg.add_entity,
+            'relation': biokg.add_relation,
+            'entities_bulk': biokg.add_entities_bulk,
+            'relations_bulk': biokg.add_relations_bulk,
+        }
+        for op, args in ops:
+            replay[op](*args)
+
+    @_profiled_stage
+    def _remove_incomplete_arms(self, arms=None):
         cnt = [0, 0, 0, 0]
         biokg = self.biokg
-        for node, data in tqdm(list(biokg.graph.nodes(data=True))):
+        if arms is None:
+            nodes = list(biokg.graph.nodes(data=True))
+        else:
+            nodes = [(node, biokg.graph.nodes[node]) for node in arms if node in biokg.graph]
+        for node, data in tqdm(nodes):
             if node.type == EntityType.TRIAL_ARM:
                 cnt[3] += 1
                 attrs = data['attrs']
@@ -355,6 +618,8 @@ class KnowledgeGraphBuilder:
                 if not has_ae:
                     cnt[1] += 1
                     # biokg.graph.remove_node(node)
+        for name, value in zip(['removed_arms', 'arms_without_ae', 'placebo_added', 'arms'], cnt):
+            self.profiler.count(name, value)
         print(cnt)
 
     def print_graph_stats(self, biograph, ent2concept):
@@ -398,7 +663,7 @@ class TrialGraphBuilder:
         self.trial = trial
         self.graph_builder = graph_builder
         self.build_ae = graph_builder.build_ae
-        self.mesh_id2children = graph_builder.mesh_id2children
+        self.mesh_closure = graph_builder.mesh_closure
         self.no_disease = False
 
     def build(self, use_population):
@@ -440,10 +705,10 @@ class TrialGraphBuilder:
         if not isinstance(mesh_ids, set):
             mesh_ids = set()
         # We need to connect to only the child meshIDs and hence remove any meshId for which there is a childId
+        # (has_parent edges point from child to parent, so these are the ids reachable from mesh_id in the MeSH graph)
         filtered_ids = set()
         for mesh_id in mesh_ids:
-            children = self.mesh_id2children[mesh_id]
-            if not mesh_ids.intersection(children):
+            if not self.mesh_closure.has_ancestor_in(mesh_id, mesh_ids):
                 filtered_ids.add(mesh_id)
         self.weird = mesh_ids and not filtered_ids
         self.filtered_mesh_ids = filtered_ids
@@ -543,18 +808,20 @@ class TrialGraphBuilder:
     def _population(self):
         row = self.trial
         crit = row['ec_umls']
+        cuid2term = self.graph_builder.cuid2term[self.graph_builder.umls_graph_clip_threshold]
+        arm_keys = [self.arm_key(arm_id) for arm_id in self.arm_labels.values()]
+        relations = []
         for cat in crit:
             for inclusion in crit[cat]:
                 for term_crit in crit[cat][inclusion]:
                     if term_crit.concept:
                         cuid = term_crit.concept['ui']
-                        for p_cuid in self.graph_builder.cuid2term[self.graph_builder.umls_graph_clip_threshold].get(
-                                cuid, []):
-                            for arm_id in self.arm_labels.values():
-                                self.graph_builder.biokg.add_relation(self.arm_key(arm_id),
-                                                                      self.graph_builder.umls_key(p_cuid),
-                                                                      relation=f'eligibility-{inclusion}',
-                                                                      source=Source.CLINICAL_TRIAL)
+                        for p_cuid in cuid2term.get(cuid, []):
+                            umls_key = self.graph_builder.umls_key(p_cuid)
+                            for arm_key in arm_keys:
+                                relations.append((arm_key, umls_key, f'eligibility-{inclusion}',
+                                                  Source.CLINICAL_TRIAL))
+        self.graph_builder.biokg.add_relations_bulk(relations)
 
     def _results(self):
         for event_type in ['serious_events', 'other_events']:
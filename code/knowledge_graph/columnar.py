@@ -0,0 +1,40 @@
+import os
+import pickle
+
+import pandas as pd
+
+CACHE_SUFFIX = '.columns.pkl'
+
+
+def _file_identity(filename):
+    stat = os.stat(filename)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def read_tsv_columns(filename, columns, categorical=()):
+    """
+    Read only `columns` of a TSV file as string columns (`categorical` ones as pandas categoricals). The result is
+    cached in a binary file next to the TSV, keyed on the TSV size and mtime, so later builds skip parsing.
+    """
+    columns = list(columns)
+    categorical = sorted(categorical)
+    cache_path = filename + CACHE_SUFFIX
+    identity = _file_identity(filename)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['identity'] == identity and cached['categorical'] == categorical \
+                and set(columns) <= set(cached['df'].columns):
+            return cached['df'][columns]
+
+    df = pd.read_csv(filename, sep='\t', usecols=columns, dtype=str, keep_default_na=False, na_filter=False)
+    for column in categorical:
+        df[column] = df[column].astype('category')
+    df = df[columns]
+
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'identity': identity, 'categorical': categorical, 'df': df}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return df
@@ -0,0 +1,215 @@
+from array import array
+
+import networkx as nx
+import numpy as np
+
+from .kg import Entity, EntityKey, Relation, Source, relation_endpoints, unique_relations
+
+
+class _RelationEdges:
+    """Edges of a single relation: append-only int32 buffers that `compact` folds into a deduplicated CSR."""
+
+    def __init__(self):
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.attrs = {}  # CSR position -> attrs, only for edges with non-empty attrs
+        self.pending_src = array('i')
+        self.pending_dst = array('i')
+        self.pending_attrs = {}  # pending position -> attrs, only for edges with non-empty attrs
+
+    def __len__(self):
+        return len(self.indices) + len(self.pending_src)
+
+    def append(self, u, v, attrs):
+        if attrs:
+            self.pending_attrs[len(self.pending_src)] = attrs
+        self.pending_src.append(u)
+        self.pending_dst.append(v)
+
+    def compact(self, num_nodes):
+        if not self.pending_src:
+            return
+        old_src = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32), np.diff(self.indptr))
+        src = np.concatenate([old_src, np.frombuffer(self.pending_src, dtype=np.int32)])
+        dst = np.concatenate([self.indices, np.frombuffer(self.pending_dst, dtype=np.int32)])
+        edge_attrs = dict(self.attrs)
+        offset = len(self.indices)
+        for pos, attrs in self.pending_attrs.items():
+            edge_attrs[offset + pos] = attrs
+
+        # a multi-edge with the same relation between the same pair is a single edge (as in nx.MultiDiGraph with a
+        # fixed key): keep the position of the first insertion and the attrs of the last one
+        pair = (src.astype(np.int64) << 32) | dst.astype(np.int64)
+        order = np.argsort(pair, kind='stable')
+        sorted_pair = pair[order]
+        breaks = np.flatnonzero(np.diff(sorted_pair)) if len(pair) else np.zeros(0, dtype=np.int64)
+        starts = np.concatenate([[0], breaks + 1]) if len(pair) else breaks
+        ends = np.concatenate([breaks, [len(pair) - 1]]) if len(pair) else breaks
+        first, last = order[starts], order[ends]
+        by_first = np.argsort(first, kind='stable')
+        first, last = first[by_first], last[by_first]
+
+        src, dst = src[first], dst[first]
+        csr_order = np.argsort(src, kind='stable')
+        self.indices = dst[csr_order].astype(np.int32)
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=num_nodes), out=self.indptr[1:])
+
+        attrs = {}
+        if edge_attrs:
+            last_sorted = last[csr_order]
+            for pos, edge_idx in enumerate(last_sorted.tolist()):
+                value = edge_attrs.get(edge_idx)
+                if value:
+                    attrs[pos] = value
+        self.attrs = attrs
+        self.pending_src = array('i')
+        self.pending_dst = array('i')
+        self.pending_attrs = {}
+
+    def neighbors(self, u):
+        if u + 1 >= len(self.indptr):
+            return self.indices[0:0]
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    def edges(self):
+        for u in range(len(self.indptr) - 1):
+            start, end = self.indptr[u], self.indptr[u + 1]
+            for pos in range(start, end):
+                yield u, int(self.indices[pos]), self.attrs.get(pos, {})
+
+
+class CompactBioKG:
+    """
+    Memory-lean drop-in for `BioKG` when building the large external networks. Entity keys are interned to int32
+    ids, edges are kept per relation as int32 columns that `compact` turns into CSR arrays, and node/edge attributes
+    live in side tables holding only the non-empty ones. Call `to_networkx` to get the equivalent `BioKG.graph`.
+    """
+
+    # see BioKG.counters, edges are reported as inserted (repeated edges are only merged by `compact`)
+    counters = None
+
+    def __init__(self):
+        self.key2id = {}
+        self.keys = []
+        self.labels = []
+        self.node_attrs = {}  # entity id -> attrs, only for non-empty attrs
+        self.relation2id = {}
+        self.relations = []
+        self.relation_edges = []
+
+    def _intern(self, key: EntityKey):
+        eid = self.key2id.get(key)
+        if eid is None:
+            eid = len(self.keys)
+            self.key2id[key] = eid
+            self.keys.append(key)
+            self.labels.append(None)
+        return eid
+
+    def add_entity(self, entity: Entity, allow_existing: bool = False):
+        if entity.key in self.key2id and not allow_existing:
+            raise RuntimeError(f"Entity {entity.key} already in KG")
+        if self.counters is not None and entity.key not in self.key2id:
+            self.counters.node_added(entity.key.type)
+        eid = self._intern(entity.key)
+        self.labels[eid] = entity.name
+        if entity.attrs:
+            self.node_attrs[eid] = entity.attrs
+        else:
+            self.node_attrs.pop(eid, None)
+
+    def add_relation(self, e1: EntityKey, e2: EntityKey, relation: str, source: Source, attrs=None):
+        u = self.key2id.get(e1)
+        if u is None:
+            raise RuntimeError(f"Node {e1} not in in graph")
+        v = self.key2id.get(e2)
+        if v is None:
+            raise RuntimeError(f"Node {e2} not in in graph")
+        key = Relation(name=relation, source=source)
+        if self.counters is not None:
+            self.counters.edge_added(key)
+        self._edges(key).append(u, v, attrs)
+
+    def add_mapping(self, e1: EntityKey, e2: EntityKey, source: Source):
+        self.add_relation(e1, e2, 'KG-MERGE-SAME', source)
+
+    def add_entities_bulk(self, entities, allow_existing: bool = False):
+        entities = list(entities)
+        if not allow_existing:
+            seen = set()
+            for entity in entities:
+                if entity.key in seen or entity.key in self.key2id:
+                    raise RuntimeError(f"Entity {entity.key} already in KG")
+                seen.add(entity.key)
+        for entity in entities:
+            self.add_entity(entity, allow_existing=True)
+        return len(entities)
+
+    def add_relations_bulk(self, relations):
+        edges = unique_relations(relations)
+        key2id = self.key2id
+        for key in relation_endpoints(edges):
+            if key not in key2id:
+                raise RuntimeError(f"Node {key} not in in graph")
+        for (e1, e2, relation), attrs in edges.items():
+            if self.counters is not None:
+                self.counters.edge_added(relation)
+            self._edges(relation).append(key2id[e1], key2id[e2], attrs)
+        return len(edges)
+
+    def _edges(self, relation: Relation):
+        rid = self.relation2id.get(relation)
+        if rid is None:
+            rid = len(self.relations)
+            self.relation2id[relation] = rid
+            self.relations.append(relation)
+            self.relation_edges.append(_RelationEdges())
+        return self.relation_edges[rid]
+
+    def compact(self):
+        num_nodes = len(self.keys)
+        for edges in self.relation_edges:
+            edges.compact(num_nodes)
+
+    def __contains__(self, key: EntityKey):
+        return key in self.key2id
+
+    def get_entity(self, key: EntityKey):
+        eid = self.key2id[key]
+        return Entity(key=key, name=self.labels[eid], attrs=self.node_attrs.setdefault(eid, {}))
+
+    def neighbors(self, key: EntityKey, relation: Relation = None):
+        self.compact()
+        u = self.key2id[key]
+        rids = range(len(self.relations)) if relation is None else [self.relation2id[relation]]
+        result = []
+        for rid in rids:
+            result.extend(self.keys[v] for v in self.relation_edges[rid].neighbors(u).tolist())
+        return result
+
+    def mappings(self):
+        self.compact()
+        for rid, relation in enumerate(self.relations):
+            if relation.name != 'KG-MERGE-SAME':
+                continue
+            for u, v, _ in self.relation_edges[rid].edges():
+                yield self.keys[u], self.keys[v]
+
+    def number_of_nodes(self):
+        return len(self.keys)
+
+    def number_of_edges(self):
+        self.compact()
+        return sum(len(edges) for edges in self.relation_edges)
+
+    def to_networkx(self):
+        self.compact()
+        g = nx.MultiDiGraph()
+        for eid, key in enumerate(self.keys):
+            g.add_node(key, label=self.labels[eid], attrs=self.node_attrs.get(eid, {}))
+        for relation, edges in zip(self.relations, self.relation_edges):
+            for u, v, attrs in edges.edges():
+                g.add_edge(self.keys[u], self.keys[v], key=relation, relation=relation.name, source=relation.source,
+                           attrs=attrs)
+        return g
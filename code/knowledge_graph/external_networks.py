@@ -2,10 +2,11 @@ import csv
 import gzip
 import os
 
-from goatools import obo_parser
 from goatools.anno.gaf_reader import GafReader
 from tqdm import tqdm
 
+from .ontology_cache import load_ontology
+
 
 class ExternalNetworkGenerator:
     def __init__(self, external_data_root):
@@ -94,19 +95,23 @@ class ExternalNetworkGenerator:
         go_base_path = f'{self.external_data_root}/go'
 
         uniprot2entrez = self.uniprot2entrez
-        go_dag = obo_parser.GODag(go_base_path + '/go-basic.obo', ['relationship'])
+        go_ontology = load_ontology(os.path.join(go_base_path, 'go-basic.obo'), 'go')
 
         goa_human_path = os.path.join(go_base_path, 'goa_human.gaf')
 
-        ogaf = GafReader(goa_human_path, godag=go_dag)
+        # the reader only needs a dag for namespace helpers that are not used here
+        ogaf = GafReader(goa_human_path)
 
         protein_function = []
+        unknown_go_ids = set()
         evidence_subset = {'EXP', 'IDA', 'IMP', 'IGI', 'HTP', 'HDA', 'HMP', 'HGI'}
         for association in tqdm(ogaf.get_associations()):
             if association.Evidence_Code in evidence_subset:
                 if association.DB_ID not in uniprot2entrez:
                     print(association.DB_ID)
                     continue
+                if association.GO_ID not in go_ontology:
+                    unknown_go_ids.add(association.GO_ID)
                 protein_function.append({
                     "protein_id": association.DB_ID,
                     "protein_entrez_id": uniprot2entrez[association.DB_ID],
@@ -116,6 +121,7 @@ class ExternalNetworkGenerator:
                     "protein name": association.DB_Name,
                     "function_namespace": association.NS
                 })
+        print("GO ids not in go-basic.obo:", len(unknown_go_ids))
         self._save_edges(protein_function, name='protein-function',
                          keys=["protein_id", 'protein_entrez_id', "protein_symbol", "function_id", "evidence_code",
                                "protein name", "function_namespace"])
@@ -0,0 +1,82 @@
+import os
+import pickle
+from typing import NamedTuple
+
+from .kg import UnionFind, concept_number, to_networkx
+
+STATE_VERSION = 1
+
+
+class ConceptDelta(NamedTuple):
+    added: set  # concept ids that did not exist before the update
+    removed: set  # concept ids that no longer exist
+    changed: set  # surviving concept ids whose arms or edges changed
+
+
+def save_kg_state(path, biokg, entity2root, entity2concept, next_concept_id):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({
+            'version': STATE_VERSION,
+            'biokg': biokg,
+            'entity2root': entity2root,
+            'entity2concept': entity2concept,
+            'next_concept_id': next_concept_id,
+        }, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_kg_state(path):
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state['version'] != STATE_VERSION:
+        raise RuntimeError(f"KG state version {state['version']} is not supported (expected {STATE_VERSION})")
+    return state
+
+
+def _next_concept_id(entity2concept, next_concept_id=0):
+    return max(max(map(concept_number, entity2concept.values()), default=-1) + 1, next_concept_id)
+
+
+def build_kg_state(builder, trial_df, filter_fn, path):
+    """Full build (`build_all`) whose result is persisted at `path` as the starting point of `update_kg_state`."""
+    builder.build_all(trial_df, filter_fn)
+    uf = UnionFind()
+    uf.merge_all(builder.biokg.mappings())
+    entity2root = uf.root_map()
+    g, concept2merge, entity2concept = to_networkx(builder.biokg, entity2root=entity2root)
+    save_kg_state(path, builder.biokg, entity2root, entity2concept, _next_concept_id(entity2concept))
+    return g, concept2merge, entity2concept
+
+
+def concept_delta(prev_entity2concept, entity2concept, entity2root, update):
+    def concept_of(key, mapping):
+        return mapping.get(entity2root.get(key, key))
+
+    prev_cids = set(prev_entity2concept.values())
+    cids = set(entity2concept.values())
+    added = cids - prev_cids
+    changed = {concept_of(key, entity2concept) for key in update.touched | update.replaced_arms}
+    changed.discard(None)
+    return ConceptDelta(added=added, removed=prev_cids - cids, changed=changed - added)
+
+
+def update_kg_state(builder, path, trial_df, nct_ids, filter_fn):
+    """
+    Load the KG persisted at `path`, add/replace/remove the arms of `nct_ids` (see
+    `KnowledgeGraphBuilder.update_trials`) and save it back. Concept ids of unaffected entities are kept, so the
+    returned `ConceptDelta` is all that downstream embeddings need to patch.
+    """
+    state = load_kg_state(path)
+    builder.biokg = state['biokg']
+    update = builder.update_trials(trial_df, nct_ids, filter_fn)
+
+    # trial arms never add KG-MERGE-SAME edges, so the merge roots of the full build are still valid
+    entity2root = state['entity2root']
+    prev_entity2concept = state['entity2concept']
+    g, concept2merge, entity2concept = to_networkx(builder.biokg, prev_entity2concept=prev_entity2concept,
+                                                   entity2root=entity2root, next_concept_id=state['next_concept_id'])
+    delta = concept_delta(prev_entity2concept, entity2concept, entity2root, update)
+    save_kg_state(path, builder.biokg, entity2root, entity2concept,
+                  _next_concept_id(entity2concept, state['next_concept_id']))
+    return g, entity2concept, delta
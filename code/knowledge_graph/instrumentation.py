@@ -0,0 +1,136 @@
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.
+        self.peak_rss_mb = None
+        self.peak_rss_growth_mb = None
+        self.nodes = Counter()  # EntityType -> new nodes
+        self.edges = Counter()  # Relation -> new edges
+        self.counts = Counter()  # skip counters etc.
+        self.children = []
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'wall_s': round(self.wall, 6),
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_rss_growth_mb': self.peak_rss_growth_mb,
+            'nodes': {str(ntype): cnt for ntype, cnt in self.nodes.items()},
+            'edges': {f'{relation.name}/{relation.source}': cnt for relation, cnt in self.edges.items()},
+            'counts': dict(self.counts),
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class BuildProfiler:
+    """
+    Collects a tree of build stages with wall time, process peak RSS, the nodes/edges each stage added (per entity type
+    and relation, reported by the KG through its `counters` hook) and named counters such as skipped rows.
+    """
+
+    def __init__(self):
+        self.root = StageStats('build')
+        self.stack = [self.root]
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    @property
+    def current(self):
+        return self.stack[-1]
+
+    @contextmanager
+    def stage(self, name):
+        stats = StageStats(name)
+        self.current.children.append(stats)
+        self.stack.append(stats)
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.wall = time.perf_counter() - start
+            stats.peak_rss_mb = peak_rss_mb()
+            if rss_before is not None:
+                stats.peak_rss_growth_mb = stats.peak_rss_mb - rss_before
+            self.stack.pop()
+
+    def count(self, name, value=1):
+        self.current.counts[name] += value
+
+    # KG `counters` hook
+    def node_added(self, entity_type):
+        self.current.nodes[entity_type] += 1
+
+    def edge_added(self, relation, cnt=1):
+        self.current.edges[relation] += cnt
+
+    def report(self):
+        self.root.wall = sum(child.wall for child in self.root.children)
+        self.root.peak_rss_mb = peak_rss_mb()
+        return {'started': self.started, 'stages': self.root.to_dict()}
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def format_tree(self, width=40):
+        """Indented stage tree with a bar per stage proportional to its share of the total wall time."""
+        total = sum(child.wall for child in self.root.children) or 1.
+        lines = []
+
+        def visit(stats, depth):
+            bar = '#' * max(1, round(width * stats.wall / total))
+            rss = '' if stats.peak_rss_mb is None else f' {stats.peak_rss_mb:8.0f}MB'
+            lines.append(f'{"  " * depth}{stats.name:<{40 - 2 * depth}} {stats.wall:9.2f}s{rss} {bar}')
+            for child in stats.children:
+                visit(child, depth + 1)
+
+        for child in self.root.children:
+            visit(child, 0)
+        return '\n'.join(lines)
+
+    def write_folded(self, path):
+        """Stage self times in the folded-stack format read by flamegraph.pl / speedscope (microseconds)."""
+        lines = []
+
+        def visit(stats, prefix):
+            name = f'{prefix};{stats.name}' if prefix else stats.name
+            self_time = stats.wall - sum(child.wall for child in stats.children)
+            lines.append(f'{name} {max(0, round(self_time * 1e6))}')
+            for child in stats.children:
+                visit(child, name)
+
+        for child in self.root.children:
+            visit(child, '')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def write_build_report(profiler, report_dir, tree=False):
+    """Write `<report_dir>/build-report-<time>.json` (and a folded stage tree when `tree` is set)."""
+    os.makedirs(report_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(report_dir, f'build-report-{stamp}.json')
+    profiler.write_report(path)
+    if tree:
+        profiler.write_folded(os.path.join(report_dir, f'build-report-{stamp}.folded'))
+        print(profiler.format_tree())
+    return path
@@ -3,6 +3,7 @@ from enum import Enum
 from typing import NamedTuple, Set
 
 import networkx as nx
+import numpy as np
 from tqdm import tqdm
 
 
@@ -70,13 +71,37 @@ class Relation(NamedTuple):
     source: Source
 
 
+def unique_relations(relations):
+    """
+    (e1, e2, Relation) -> attrs for (e1, e2, relation, source[, attrs]) tuples. A repeated edge keeps its first
+    position and its last attrs, as repeated `add_relation` calls would.
+    """
+    edges = {}
+    for relation in relations:
+        e1, e2, name, source = relation[:4]
+        attrs = relation[4] if len(relation) > 4 else None
+        edges[e1, e2, Relation(name=name, source=source)] = {} if attrs is None else attrs
+    return edges
+
+
+def relation_endpoints(edges):
+    """Distinct endpoints of `unique_relations` output, in first-seen order."""
+    return list(dict.fromkeys(key for e1, e2, _ in edges for key in (e1, e2)))
+
+
 class BioKG:
+    # optional hook (e.g. instrumentation.BuildProfiler) told about every new node and edge
+    counters = None
+
     def __init__(self):
         self.graph = nx.MultiDiGraph()
 
     def add_entity(self, entity: Entity, allow_existing: bool = False):
-        if entity.key in self.graph and not allow_existing:
-            raise RuntimeError(f"Entity {entity.key} already in KG")
+        if entity.key in self.graph:
+            if not allow_existing:
+                raise RuntimeError(f"Entity {entity.key} already in KG")
+        elif self.counters is not None:
+            self.counters.node_added(entity.key.type)
 
         self.graph.add_node(entity.key, label=entity.name, attrs=entity.attrs)
 
@@ -87,55 +112,262 @@ class BioKG:
             raise RuntimeError(f"Node {e1} not in in graph")
         if e2 not in self.graph:
             raise RuntimeError(f"Node {e2} not in in graph")
-        self.graph.add_edge(e1, e2, key=Relation(name=relation, source=source), relation=relation, source=source,
-                            attrs=attrs)
+        key = Relation(name=relation, source=source)
+        if self.counters is not None and not self.graph.has_edge(e1, e2, key):
+            self.counters.edge_added(key)
+        self.graph.add_edge(e1, e2, key=key, relation=relation, source=source, attrs=attrs)
 
     def add_mapping(self, e1: EntityKey, e2: EntityKey, source: Source):
         self.add_relation(e1, e2, 'KG-MERGE-SAME', source)
 
+    def add_entities_bulk(self, entities, allow_existing: bool = False):
+        """Add many entities with a single graph update, same semantics as repeated `add_entity` calls."""
+        entities = list(entities)
+        if not allow_existing:
+            seen = set()
+            for entity in entities:
+                if entity.key in seen or entity.key in self:
+                    raise RuntimeError(f"Entity {entity.key} already in KG")
+                seen.add(entity.key)
+        if self.counters is not None:
+            new_keys = {entity.key for entity in entities if entity.key not in self.graph}
+            for key in new_keys:
+                self.counters.node_added(key.type)
+        self.graph.add_nodes_from((entity.key, {'label': entity.name, 'attrs': entity.attrs}) for entity in entities)
+        return len(entities)
+
+    def add_relations_bulk(self, relations):
+        """
+        Add many relations given as (e1, e2, relation, source[, attrs]) tuples. Multi-edges are collapsed first, every
+        distinct endpoint is checked once before anything is inserted and the edges go in with one `add_edges_from`.
+        Returns the number of distinct edges.
+        """
+        edges = unique_relations(relations)
+        for key in relation_endpoints(edges):
+            if key not in self.graph:
+                raise RuntimeError(f"Node {key} not in in graph")
+        self._add_edges(edges)
+        return len(edges)
+
+    def _add_edges(self, edges):
+        if self.counters is not None:
+            for e1, e2, relation in edges:
+                if not self.graph.has_edge(e1, e2, relation):
+                    self.counters.edge_added(relation)
+        self.graph.add_edges_from((e1, e2, relation, {'relation': relation.name, 'source': relation.source,
+                                                      'attrs': attrs})
+                                  for (e1, e2, relation), attrs in edges.items())
+
+    def __contains__(self, key: EntityKey):
+        return key in self.graph
+
+    def get_entity(self, key: EntityKey):
+        data = self.graph.nodes[key]
+        return Entity(key=key, name=data['label'], attrs=data['attrs'])
+
+    def mappings(self):
+        for u, v, data in self.graph.edges(data=True):
+            if data['relation'] == 'KG-MERGE-SAME':
+                yield u, v
+
+    def number_of_nodes(self):
+        return self.graph.number_of_nodes()
+
+    def number_of_edges(self):
+        return self.graph.number_of_edges()
+
+    def to_networkx(self):
+        return self.graph
+
+
+class TrialOverlayKG(BioKG):
+    """
+    Writable layer on top of a read-only base KG. New entities and relations go to the overlay graph, base
+    entities are pulled into the overlay (sharing their data) only when a new relation touches them.
+    """
+
+    def __init__(self, base: BioKG):
+        super().__init__()
+        self.base = base
+
+    def __contains__(self, key: EntityKey):
+        return key in self.graph or key in self.base
+
+    def add_entity(self, entity: Entity, allow_existing: bool = False):
+        if entity.key in self.base:
+            if not allow_existing:
+                raise RuntimeError(f"Entity {entity.key} already in KG")
+            return
+        super().add_entity(entity, allow_existing=allow_existing)
+
+    def add_entities_bulk(self, entities, allow_existing: bool = False):
+        new_entities = []
+        for entity in entities:
+            if entity.key in self.base:
+                if not allow_existing:
+                    raise RuntimeError(f"Entity {entity.key} already in KG")
+                continue
+            new_entities.append(entity)
+        return super().add_entities_bulk(new_entities, allow_existing=allow_existing)
+
+    def get_entity(self, key: EntityKey):
+        if key in self.graph:
+            return super().get_entity(key)
+        return self.base.get_entity(key)
+
+    def _pull(self, key: EntityKey):
+        if key in self.graph:
+            return
+        if key not in self.base:
+            raise RuntimeError(f"Node {key} not in in graph")
+        entity = self.base.get_entity(key)
+        self.graph.add_node(key, label=entity.name, attrs=entity.attrs)
+
+    def add_relation(self, e1: EntityKey, e2: EntityKey, relation: str, source: Source, attrs=None):
+        self._pull(e1)
+        self._pull(e2)
+        super().add_relation(e1, e2, relation, source, attrs=attrs)
+
+    def add_relations_bulk(self, relations):
+        edges = unique_relations(relations)
+        for key in relation_endpoints(edges):
+            self._pull(key)
+        self._add_edges(edges)
+        return len(edges)
+
+    def mappings(self):
+        yield from self.base.mappings()
+        yield from super().mappings()
+
+    def number_of_nodes(self):
+        return self.base.number_of_nodes() + sum(1 for node in self.graph if node not in self.base)
+
+    def number_of_edges(self):
+        return self.base.number_of_edges() + self.graph.number_of_edges()
+
+    def to_networkx(self):
+        """Materialize base + overlay as a single graph (copies the base graph)."""
+        g = self.base.to_networkx()
+        if isinstance(self.base, BioKG):
+            # do not modify the shared base graph
+            g = g.copy()
+        g.add_nodes_from(self.graph.nodes(data=True))
+        g.add_edges_from(self.graph.edges(keys=True, data=True))
+        return g
+
 
 class UnionFind:
+    """
+    Disjoint set over hashable items. Items are interned to integer ids and the forest is kept in flat arrays, with
+    union by rank and path halving, so long KG-MERGE-SAME chains stay shallow and no recursion is involved.
+    """
+
     def __init__(self):
-        self.parent = {}
+        self.item2id = {}
+        self.items = []
+        self.parent = []
+        self.rank = []
+
+    def _intern(self, item):
+        idx = self.item2id.get(item)
+        if idx is None:
+            idx = len(self.items)
+            self.item2id[item] = idx
+            self.items.append(item)
+            self.parent.append(idx)
+            self.rank.append(0)
+        return idx
+
+    def _find(self, idx):
+        parent = self.parent
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
 
-    # A utility function to find the subset of an element i
     def find_parent(self, i):
-        if i not in self.parent:
+        idx = self.item2id.get(i)
+        if idx is None:
             return i
-        return self.find_parent(self.parent[i])
-
-        # A utility function to do union of two subsets
+        return self.items[self._find(idx)]
+
+    def _union(self, x, y):
+        x_set = self._find(x)
+        y_set = self._find(y)
+        if x_set == y_set:
+            return
+        if self.rank[x_set] > self.rank[y_set]:
+            x_set, y_set = y_set, x_set
+        self.parent[x_set] = y_set
+        if self.rank[x_set] == self.rank[y_set]:
+            self.rank[y_set] += 1
 
     def union(self, x, y):
-        x_set = self.find_parent(x)
-        y_set = self.find_parent(y)
-        if x_set != y_set:
-            self.parent[x_set] = y_set
+        self._union(self._intern(x), self._intern(y))
 
-
-def to_networkx(biokg):
-    self = biokg
+    def merge_all(self, edges):
+        """Union every (x, y) pair of `edges`, returns the number of pairs seen."""
+        cnt = 0
+        for x, y in edges:
+            self._union(self._intern(x), self._intern(y))
+            cnt += 1
+        return cnt
+
+    def roots(self):
+        """Root id of every interned item (indexed by item id), resolved for all items at once."""
+        roots = np.asarray(self.parent, dtype=np.int64)
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+    def root_map(self):
+        """Item -> root item for every item that took part in a union."""
+        items = self.items
+        return {item: items[root] for item, root in zip(items, self.roots().tolist())}
+
+
+def concept_number(cid):
+    return int(cid[2:])
+
+
+def to_networkx(biokg, prev_entity2concept=None, entity2root=None, next_concept_id=None):
+    """
+    Merge the KG-MERGE-SAME components of `biokg` into concepts. When `prev_entity2concept` of an earlier conversion
+    is given, entities keep their concept id and only new concepts get fresh ids (from `next_concept_id`, by default
+    after the largest previous id). `entity2root` can be passed to skip the union-find pass.
+    """
+    graph = biokg.to_networkx()
     print("v.20")
 
     concept2merge = defaultdict(list)
-    current_concept_id = 0
-    cnt = 0
+    if prev_entity2concept is None:
+        prev_entity2concept = {}
+    if next_concept_id is None:
+        next_concept_id = max(map(concept_number, prev_entity2concept.values()), default=-1) + 1
+    current_concept_id = next_concept_id
+
+    if entity2root is None:
+        uf = UnionFind()
+        cnt = uf.merge_all(tqdm(biokg.mappings()))
+        print("Node pairs to merge: ", cnt)
+        entity2root = uf.root_map()
 
-    uf = UnionFind()
-    for u, v, data in tqdm(self.graph.edges(data=True)):
-        if data['relation'] == 'KG-MERGE-SAME':
-            cnt += 1
-            uf.union(u, v)
-    print("Node pairs to merge: ", cnt)
     g = nx.MultiDiGraph()
     entity2concept = {}
-    for node, data in tqdm(self.graph.nodes(data=True)):
-        nid = uf.find_parent(node)
+    node2concept = {}
+    for node, data in tqdm(graph.nodes(data=True)):
+        nid = entity2root.get(node, node)
         if nid not in entity2concept:
-            entity2concept[nid] = f'KG{current_concept_id:08}'
-            current_concept_id += 1
+            cid = prev_entity2concept.get(nid)
+            if cid is None:
+                cid = f'KG{current_concept_id:08}'
+                current_concept_id += 1
+            entity2concept[nid] = cid
 
         cid = entity2concept[nid]
+        node2concept[node] = cid
 
         e = Entity(key=node, name=data['label'], attrs=data['attrs'])
         if cid not in g:
@@ -144,11 +376,11 @@ def to_networkx(biokg):
             g.nodes[cid]['entities'][e.key] = e
             g.nodes[cid]['ntypes'].add(e.key.type)
 
-    for u, v, k, data in tqdm(self.graph.edges(data=True, keys=True)):
+    for u, v, k, data in tqdm(graph.edges(data=True, keys=True)):
         if data['relation'] == 'KG-MERGE-SAME':
             continue
-        cidu = entity2concept[uf.find_parent(u)]
-        cidv = entity2concept[uf.find_parent(v)]
+        cidu = node2concept[u]
+        cidv = node2concept[v]
         if not g.has_edge(cidu, cidv, k):
             g.add_edge(cidu, cidv, key=k, relation=data['relation'], source=data['source'], attrs=[data['attrs']],
                        extra_attrs={})
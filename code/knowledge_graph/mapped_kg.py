@@ -0,0 +1,267 @@
+import bisect
+import os
+import pickle
+from array import array
+from collections.abc import Mapping
+
+import networkx as nx
+import numpy as np
+
+from .compact_kg import CompactBioKG
+from .kg import Entity, EntityKey, EntityType, Relation, Source
+
+ENTITY_TYPES = list(EntityType)
+SOURCES = list(Source)
+TYPE_CODES = {entity_type: code for code, entity_type in enumerate(ENTITY_TYPES)}
+SOURCE_CODES = {source: code for code, source in enumerate(SOURCES)}
+# fixed, so that the pickled entity ids of a lookup compare equal to the stored ones
+ID_PROTOCOL = 4
+
+
+class _Blobs:
+    """Byte strings stored as one uint8 array plus offsets, `blobs[i]` is the i-th one."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes()
+
+
+def _blob_arrays(blobs):
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(blobs), dtype=np.uint8)
+
+
+def _id_bytes(entity_id):
+    return pickle.dumps(entity_id, protocol=ID_PROTOCOL)
+
+
+def _nodes_and_edges(biokg):
+    """[(key, label, attrs)] and [(key1, key2, Relation, attrs)] of a BioKG or CompactBioKG."""
+    if isinstance(biokg, CompactBioKG):
+        biokg.compact()
+        keys = biokg.keys
+        nodes = [(key, biokg.labels[eid], biokg.node_attrs.get(eid, {})) for eid, key in enumerate(keys)]
+        edges = [(keys[u], keys[v], relation, attrs)
+                 for relation, relation_edges in zip(biokg.relations, biokg.relation_edges)
+                 for u, v, attrs in relation_edges.edges()]
+        return nodes, edges
+    graph = biokg.graph
+    nodes = [(key, data.get('label'), data.get('attrs', {})) for key, data in graph.nodes(data=True)]
+    edges = [(u, v, relation, data.get('attrs', {})) for u, v, relation, data in graph.edges(keys=True, data=True)]
+    return nodes, edges
+
+
+def save_mapped_kg(biokg, entity2root, out_dir):
+    """
+    Write `biokg` (BioKG or CompactBioKG) and its `entity2root` map as the .npy arrays of a MappedBioKG into
+    `out_dir`. Returns the layout for the snapshot manifest.
+    """
+    nodes, edges = _nodes_and_edges(biokg)
+    # nodes are numbered in (type, source, id) order, so a key is found by bisection within its (type, source) run
+    sort_keys = [(TYPE_CODES[key.type], SOURCE_CODES[key.source], _id_bytes(key.id)) for key, _, _ in nodes]
+    order = sorted(range(len(nodes)), key=sort_keys.__getitem__)
+    key2eid = {nodes[old][0]: eid for eid, old in enumerate(order)}
+
+    files = {}
+
+    def save(name, values):
+        files[name] = f'{name}.npy'
+        np.save(os.path.join(out_dir, files[name]), values)
+
+    save('node_types', np.array([sort_keys[old][0] for old in order], dtype=np.int8))
+    save('node_sources', np.array([sort_keys[old][1] for old in order], dtype=np.int8))
+    for name, blobs in (('ids', [sort_keys[old][2] for old in order]),
+                        ('node_data', [pickle.dumps(nodes[old][1:], protocol=pickle.HIGHEST_PROTOCOL)
+                                       for old in order])):
+        offsets, data = _blob_arrays(blobs)
+        save(f'{name}_offsets', offsets)
+        save(f'{name}_data', data)
+    groups = {}
+    for eid, old in enumerate(order):
+        group = sort_keys[old][:2]
+        start, _ = groups.get(group, (eid, eid))
+        groups[group] = (start, eid + 1)
+
+    roots = np.full(len(nodes), -1, dtype=np.int32)
+    for key, root in entity2root.items():
+        roots[key2eid[key]] = key2eid[root]
+    save('roots', roots)
+
+    relation_rows = {}
+    for key1, key2, relation, attrs in edges:
+        rows = relation_rows.setdefault(relation, (array('i'), array('i'), {}))
+        if attrs:
+            rows[2][len(rows[0])] = attrs
+        rows[0].append(key2eid[key1])
+        rows[1].append(key2eid[key2])
+    relations = []
+    for rid, (relation, (src, dst, edge_attrs)) in enumerate(relation_rows.items()):
+        src = np.frombuffer(src, dtype=np.int32)
+        csr_order = np.argsort(src, kind='stable')
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(nodes)), out=indptr[1:])
+        save(f'relation{rid}_indptr', indptr)
+        save(f'relation{rid}_indices', np.frombuffer(dst, dtype=np.int32)[csr_order])
+        # only the edges with attrs get a pickled blob, found by CSR position
+        position = np.empty(len(src), dtype=np.int64)
+        position[csr_order] = np.arange(len(src))
+        attr_edges = sorted(edge_attrs, key=lambda edge: position[edge])
+        offsets, data = _blob_arrays([pickle.dumps(edge_attrs[edge], protocol=pickle.HIGHEST_PROTOCOL)
+                                      for edge in attr_edges])
+        save(f'relation{rid}_attr_positions', position[attr_edges] if attr_edges else np.zeros(0, dtype=np.int64))
+        save(f'relation{rid}_attr_offsets', offsets)
+        save(f'relation{rid}_attr_data', data)
+        relations.append([relation.name, relation.source.name])
+
+    return {
+        'files': files,
+        'num_nodes': len(nodes),
+        'groups': [[type_code, source_code, start, end] for (type_code, source_code), (start, end) in groups.items()],
+        'relations': relations,
+    }
+
+
+class MappedBioKG:
+    """
+    Read-only KG over the arrays written by `save_mapped_kg`, memory-mapped so that opening it parses nothing and all
+    processes share the pages. Entity keys are found by bisection, labels and attrs are unpickled per entity on
+    access. It implements what `TrialOverlayKG` reads from its base (membership, `get_entity`, `mappings`, counts)
+    plus `neighbors` and `to_networkx`.
+    """
+
+    # see BioKG.counters, nothing is ever added to a mapped KG
+    counters = None
+
+    def __init__(self, kg_dir, layout):
+        files = layout['files']
+
+        def load(name):
+            return np.load(os.path.join(kg_dir, files[name]), mmap_mode='r')
+
+        self.num_nodes = layout['num_nodes']
+        self.node_types = load('node_types')
+        self.node_sources = load('node_sources')
+        self.ids = _Blobs(load('ids_offsets'), load('ids_data'))
+        self.node_data = _Blobs(load('node_data_offsets'), load('node_data_data'))
+        self.roots = load('roots')
+        self.groups = {(type_code, source_code): (start, end)
+                       for type_code, source_code, start, end in layout['groups']}
+        self.relations = [Relation(name=name, source=Source[source]) for name, source in layout['relations']]
+        self.relation2id = {relation: rid for rid, relation in enumerate(self.relations)}
+        self.relation_edges = [(load(f'relation{rid}_indptr'), load(f'relation{rid}_indices'),
+                                load(f'relation{rid}_attr_positions'),
+                                _Blobs(load(f'relation{rid}_attr_offsets'), load(f'relation{rid}_attr_data')))
+                               for rid in range(len(self.relations))]
+
+    def _find(self, key: EntityKey):
+        """Entity id of `key` or -1."""
+        type_code = TYPE_CODES.get(getattr(key, 'type', None))
+        source_code = SOURCE_CODES.get(getattr(key, 'source', None))
+        start, end = self.groups.get((type_code, source_code), (0, 0))
+        if start == end:
+            return -1
+        target = _id_bytes(key.id)
+        eid = bisect.bisect_left(self.ids, target, start, end)
+        if eid < end and self.ids[eid] == target:
+            return eid
+        return -1
+
+    def _key(self, eid):
+        return EntityKey(type=ENTITY_TYPES[self.node_types[eid]], id=pickle.loads(self.ids[eid]),
+                         source=SOURCES[self.node_sources[eid]])
+
+    def __contains__(self, key: EntityKey):
+        return self._find(key) >= 0
+
+    def get_entity(self, key: EntityKey):
+        eid = self._find(key)
+        if eid < 0:
+            raise KeyError(key)
+        label, attrs = pickle.loads(self.node_data[eid])
+        return Entity(key=key, name=label, attrs=attrs)
+
+    def _edge_attrs(self, rid, position):
+        _, _, attr_positions, attr_blobs = self.relation_edges[rid]
+        idx = int(np.searchsorted(attr_positions, position))
+        if idx < len(attr_positions) and attr_positions[idx] == position:
+            return pickle.loads(attr_blobs[idx])
+        return {}
+
+    def _edges(self, rid):
+        indptr, indices, _, _ = self.relation_edges[rid]
+        for u in np.flatnonzero(np.diff(indptr)).tolist():
+            for position in range(indptr[u], indptr[u + 1]):
+                yield u, int(indices[position]), position
+
+    def neighbors(self, key: EntityKey, relation: Relation = None):
+        u = self._find(key)
+        if u < 0:
+            raise KeyError(key)
+        rids = range(len(self.relations)) if relation is None else [self.relation2id[relation]]
+        result = []
+        for rid in rids:
+            indptr, indices, _, _ = self.relation_edges[rid]
+            result.extend(self._key(v) for v in indices[indptr[u]:indptr[u + 1]].tolist())
+        return result
+
+    def mappings(self):
+        for rid, relation in enumerate(self.relations):
+            if relation.name != 'KG-MERGE-SAME':
+                continue
+            for u, v, _ in self._edges(rid):
+                yield self._key(u), self._key(v)
+
+    def root_map(self):
+        """entity2root of the snapshot as a read-only mapping."""
+        return _RootMap(self)
+
+    def number_of_nodes(self):
+        return self.num_nodes
+
+    def number_of_edges(self):
+        return sum(len(indices) for _, indices, _, _ in self.relation_edges)
+
+    def to_networkx(self):
+        g = nx.MultiDiGraph()
+        keys = [self._key(eid) for eid in range(self.num_nodes)]
+        for eid, key in enumerate(keys):
+            label, attrs = pickle.loads(self.node_data[eid])
+            g.add_node(key, label=label, attrs=attrs)
+        for rid, relation in enumerate(self.relations):
+            for u, v, position in self._edges(rid):
+                g.add_edge(keys[u], keys[v], key=relation, relation=relation.name, source=relation.source,
+                           attrs=self._edge_attrs(rid, position))
+        return g
+
+
+class _RootMap(Mapping):
+    """{entity key: representative key} of the merged entities of a MappedBioKG."""
+
+    def __init__(self, kg):
+        self.kg = kg
+
+    def __getitem__(self, key):
+        eid = self.kg._find(key)
+        root = int(self.kg.roots[eid]) if eid >= 0 else -1
+        if root < 0:
+            raise KeyError(key)
+        return self.kg._key(root)
+
+    def __iter__(self):
+        for eid in np.flatnonzero(np.asarray(self.kg.roots) >= 0).tolist():
+            yield self.kg._key(eid)
+
+    def __len__(self):
+        return int(np.count_nonzero(np.asarray(self.kg.roots) >= 0))
+
+    def items(self):
+        kg = self.kg
+        for eid in np.flatnonzero(np.asarray(kg.roots) >= 0).tolist():
+            yield kg._key(eid), kg._key(int(kg.roots[eid]))
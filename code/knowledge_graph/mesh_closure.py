@@ -0,0 +1,91 @@
+class MeshClosure:
+    """
+    Transitive closure of the MeSH `has_parent` hierarchy. Every MeSH id gets a bit position and stores the set of
+    all its ancestors and all its descendants as int bitsets, so ancestor/descendant checks are a single bit test and
+    the full closure of ~30k descriptors fits in a few tens of MB (instead of all-pairs shortest paths).
+    """
+
+    def __init__(self, id2parents):
+        self.ids = list(id2parents.keys())
+        self.id2idx = {mesh_id: idx for idx, mesh_id in enumerate(self.ids)}
+        self.ancestor_bits = [0] * len(self.ids)
+        self.descendant_bits = [0] * len(self.ids)
+        self._build(id2parents)
+
+    @classmethod
+    def from_mesh_data(cls, mesh_dis_data, extra_ids=('HEALTHY',)):
+        id2parents = {mesh_id: [parent.ID for parent in term.parents] for mesh_id, term in mesh_dis_data.items()}
+        for mesh_id in extra_ids:
+            id2parents.setdefault(mesh_id, [])
+        return cls(id2parents)
+
+    def _build(self, id2parents):
+        id2idx = self.id2idx
+        parents_idx = [[id2idx[parent] for parent in id2parents[mesh_id]] for mesh_id in self.ids]
+
+        # order nodes so that every parent comes before its children (iterative dfs, MeSH is a DAG)
+        order = []
+        state = [0] * len(self.ids)  # 0 = unseen, 1 = on stack, 2 = done
+        for root in range(len(self.ids)):
+            if state[root]:
+                continue
+            stack = [(root, iter(parents_idx[root]))]
+            state[root] = 1
+            while stack:
+                node, parents = stack[-1]
+                parent = next(parents, None)
+                if parent is None:
+                    stack.pop()
+                    state[node] = 2
+                    order.append(node)
+                elif state[parent] == 0:
+                    state[parent] = 1
+                    stack.append((parent, iter(parents_idx[parent])))
+                elif state[parent] == 1:
+                    raise RuntimeError(f"Cycle in MeSH hierarchy at {self.ids[parent]}")
+
+        ancestor_bits = self.ancestor_bits
+        for node in order:
+            bits = 0
+            for parent in parents_idx[node]:
+                bits |= ancestor_bits[parent] | (1 << parent)
+            ancestor_bits[node] = bits
+
+        descendant_bits = self.descendant_bits
+        for node in reversed(order):
+            child_bits = descendant_bits[node] | (1 << node)
+            for parent in parents_idx[node]:
+                descendant_bits[parent] |= child_bits
+
+    def __contains__(self, mesh_id):
+        return mesh_id in self.id2idx
+
+    def __len__(self):
+        return len(self.ids)
+
+    def is_ancestor(self, mesh_id, other_id):
+        """True if `other_id` is a (transitive) parent of `mesh_id`."""
+        return bool((self.ancestor_bits[self.id2idx[mesh_id]] >> self.id2idx[other_id]) & 1)
+
+    def is_descendant(self, mesh_id, other_id):
+        """True if `other_id` is a (transitive) child of `mesh_id`."""
+        return bool((self.descendant_bits[self.id2idx[mesh_id]] >> self.id2idx[other_id]) & 1)
+
+    def has_ancestor_in(self, mesh_id, mesh_ids):
+        bits = self.ancestor_bits[self.id2idx[mesh_id]]
+        return any(other in self.id2idx and (bits >> self.id2idx[other]) & 1 for other in mesh_ids)
+
+    def _ids_from_bits(self, bits):
+        ids = self.ids
+        result = set()
+        while bits:
+            low = bits & -bits
+            result.add(ids[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+    def ancestors(self, mesh_id):
+        return self._ids_from_bits(self.ancestor_bits[self.id2idx[mesh_id]])
+
+    def descendants(self, mesh_id):
+        return self._ids_from_bits(self.descendant_bits[self.id2idx[mesh_id]])
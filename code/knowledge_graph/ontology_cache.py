@@ -0,0 +1,175 @@
+import os
+import pickle
+
+import numpy as np
+
+from .columnar import _file_identity
+
+CACHE_SUFFIX = '.ontology.pkl'
+CACHE_VERSION = 1
+
+
+class Ontology:
+    """
+    Compact, picklable form of a parsed OBO ontology. Terms are numbered in file order and keep their id, name,
+    namespace, obsolete flag and alt_ids; parents are stored per relation type ('is_a' and every `relationship`
+    type) as int32 CSR arrays over the term numbers.
+    """
+
+    def __init__(self, ids, names, namespaces, obsolete, alt_ids, relation2parents, data=None):
+        self.ids = list(ids)
+        self.id2idx = {term_id: idx for idx, term_id in enumerate(self.ids)}
+        self.names = list(names)
+        self.namespace_names = sorted({ns for ns in namespaces if ns is not None})
+        ns2code = {ns: code for code, ns in enumerate(self.namespace_names)}
+        self.namespace_codes = np.array([ns2code.get(ns, -1) for ns in namespaces], dtype=np.int8)
+        self.obsolete = np.array(obsolete, dtype=bool)
+        self.alt_ids = [tuple(ids) for ids in alt_ids]
+        self.alt2idx = {alt_id: idx for idx, ids in enumerate(self.alt_ids) for alt_id in ids}
+        self.relations = {}
+        for relation, parents in relation2parents.items():
+            indptr = np.zeros(len(self.ids) + 1, dtype=np.int64)
+            np.cumsum([len(p) for p in parents], out=indptr[1:])
+            indices = np.fromiter((idx for p in parents for idx in p), dtype=np.int32, count=int(indptr[-1]))
+            self.relations[relation] = (indptr, indices)
+        # raw OBO node data, only kept when the builder stores it as entity attrs (ChemOnt)
+        self.data = data
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, term_id):
+        return term_id in self.id2idx or term_id in self.alt2idx
+
+    def index(self, term_id):
+        """Term number of `term_id`, alt ids resolve to their primary term."""
+        idx = self.id2idx.get(term_id)
+        if idx is None:
+            idx = self.alt2idx[term_id]
+        return idx
+
+    def namespace(self, idx):
+        code = self.namespace_codes[idx]
+        return self.namespace_names[code] if code >= 0 else None
+
+    def is_obsolete(self, idx):
+        return bool(self.obsolete[idx])
+
+    def parents(self, idx, relation='is_a'):
+        if relation not in self.relations:
+            return np.zeros(0, dtype=np.int32)
+        indptr, indices = self.relations[relation]
+        return indices[indptr[idx]:indptr[idx + 1]]
+
+    def typed_parents(self, idx):
+        """(relation, parent term numbers) for every relation type of term `idx`."""
+        for relation, (indptr, indices) in self.relations.items():
+            parents = indices[indptr[idx]:indptr[idx + 1]]
+            if len(parents):
+                yield relation, parents
+
+
+class _OntologyBuilder:
+    def __init__(self):
+        self.ids = []
+        self.id2idx = {}
+        self.names = []
+        self.namespaces = []
+        self.obsolete = []
+        self.alt_ids = []
+        self.data = []
+        self.relation2parents = {}
+
+    def term(self, term_id, name=None, namespace=None, obsolete=False, alt_ids=(), data=None):
+        idx = self.id2idx.get(term_id)
+        if idx is None:
+            idx = len(self.ids)
+            self.id2idx[term_id] = idx
+            self.ids.append(term_id)
+            self.names.append(None)
+            self.namespaces.append(None)
+            self.obsolete.append(False)
+            self.alt_ids.append(())
+            self.data.append(None)
+        if name is not None:
+            self.names[idx] = name
+            self.namespaces[idx] = namespace
+            self.obsolete[idx] = obsolete
+            self.alt_ids[idx] = tuple(alt_ids)
+            self.data[idx] = data
+        return idx
+
+    def parent(self, term_idx, relation, parent_id):
+        parents = self.relation2parents.setdefault(relation, {})
+        parents.setdefault(term_idx, []).append(self.term(parent_id))
+
+    def build(self, keep_data):
+        num_terms = len(self.ids)
+        relation2parents = {relation: [parents.get(idx, []) for idx in range(num_terms)]
+                            for relation, parents in self.relation2parents.items()}
+        return Ontology(self.ids, self.names, self.namespaces, self.obsolete, self.alt_ids, relation2parents,
+                        data=self.data if keep_data else None)
+
+
+def _parse_go(obo_path):
+    from goatools import obo_parser
+
+    go_dag = obo_parser.GODag(obo_path, ['relationship'])
+    builder = _OntologyBuilder()
+    seen = set()
+    # the dag is keyed by primary and alt ids, visit every term once in file order
+    for goterm in go_dag.values():
+        if goterm.id in seen:
+            continue
+        seen.add(goterm.id)
+        idx = builder.term(goterm.id, name=goterm.name, namespace=goterm.namespace, obsolete=goterm.is_obsolete,
+                           alt_ids=sorted(goterm.alt_ids))
+        for parent in sorted(goterm._parents):
+            builder.parent(idx, 'is_a', parent)
+        for relation in sorted(goterm.relationship):
+            for term in sorted(goterm.relationship[relation], key=lambda t: t.id):
+                builder.parent(idx, relation, term.id)
+    return builder.build(keep_data=False)
+
+
+def _parse_chemont(obo_path):
+    import obonet
+
+    graph = obonet.read_obo(obo_path)
+    builder = _OntologyBuilder()
+    for node, data in graph.nodes(data=True):
+        builder.term(node, name=data['name'], namespace=data.get('namespace'),
+                     obsolete=data.get('is_obsolete') == 'true', alt_ids=data.get('alt_id', []), data=data)
+    # obonet edges point from a term to its parents, keyed by the relation type
+    for node, parent, relation in graph.edges(keys=True):
+        builder.parent(builder.term(node), relation, parent)
+    return builder.build(keep_data=True)
+
+
+PARSERS = {
+    'go': _parse_go,
+    'chemont': _parse_chemont,
+}
+
+
+def load_ontology(obo_path, kind):
+    """
+    Parse the OBO file `obo_path` (`kind` is 'go' or 'chemont') into an `Ontology`. The result is cached in a binary
+    file next to the OBO, keyed on the OBO size and mtime, so the ontology is only parsed again when it changes.
+    """
+    cache_path = obo_path + CACHE_SUFFIX
+    identity = _file_identity(obo_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] == CACHE_VERSION and cached['identity'] == identity and cached['kind'] == kind:
+            return cached['ontology']
+
+    ontology = PARSERS[kind](obo_path)
+
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': CACHE_VERSION, 'identity': identity, 'kind': kind, 'ontology': ontology}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return ontology
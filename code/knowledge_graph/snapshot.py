@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from collections.abc import Mapping
+from typing import NamedTuple
+
+from .compact_kg import CompactBioKG
+from .kg import UnionFind
+from .mapped_kg import MappedBioKG, save_mapped_kg
+from .mesh_closure import MeshClosure
+
+SNAPSHOT_VERSION = 5
+MANIFEST_FILE = 'manifest.json'
+MESH_CLOSURE_FILE = 'mesh_closure.pkl'
+
+
+class KGSnapshot(NamedTuple):
+    biokg: MappedBioKG
+    mesh_closure: MeshClosure
+    entity2root: Mapping
+    manifest: dict
+
+
+def fingerprint_files(paths):
+    """Cheap identity (size, mtime) of the source files a snapshot was built from, used to detect stale snapshots."""
+    fingerprint = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        fingerprint[path] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def external_sources(ext_basepath):
+    return [
+        os.path.join(ext_basepath, 'classyfire', 'ChemOnt_2_1.obo'),
+        os.path.join(ext_basepath, 'go', 'go-basic.obo'),
+        os.path.join(ext_basepath, 'protein-function.tsv'),
+        os.path.join(ext_basepath, 'drug-phenotype.tsv'),
+        os.path.join(ext_basepath, 'drug-protein.tsv'),
+        os.path.join(ext_basepath, 'multiscale-interactome', 'protein_to_protein.tsv'),
+        os.path.join(ext_basepath, 'disgenet', 'curated_gene_disease_associations.tsv'),
+        os.path.join(ext_basepath, 'disgenet', 'disease_mappings.tsv'),
+    ]
+
+
+def _merge_roots(biokg):
+    uf = UnionFind()
+    uf.merge_all(biokg.mappings())
+    return uf.root_map()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_snapshot(builder, snapshot_dir, sources=()):
+    """
+    Persist the external networks of `builder` (after `build_external_networks`) so they can be reused across
+    processes without re-reading the raw TSV/OBO sources. The KG is written as the arrays of a MappedBioKG.
+    `sources` are the other files the build read (MeSH, DrugBank, UMLS, ...), fingerprinted with the TSV/OBO ones.
+    """
+    if not hasattr(builder, 'mesh_closure'):
+        builder._mesh_children()
+    if isinstance(builder.biokg, CompactBioKG):
+        builder.biokg.compact()
+    # written next to its final location and swapped in, so readers never see a partial snapshot
+    tmp_dir = snapshot_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    layout = save_mapped_kg(builder.biokg, _merge_roots(builder.biokg), tmp_dir)
+    with open(os.path.join(tmp_dir, MESH_CLOSURE_FILE), 'wb') as f:
+        pickle.dump(builder.mesh_closure, f, protocol=pickle.HIGHEST_PROTOCOL)
+    filenames = list(layout['files'].values()) + [MESH_CLOSURE_FILE]
+
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'sha256': {filename: _sha256(os.path.join(tmp_dir, filename)) for filename in filenames},
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'engine': type(builder.biokg).__name__,
+        'num_nodes': builder.biokg.number_of_nodes(),
+        'num_edges': builder.biokg.number_of_edges(),
+        'umls_graph_clip_threshold': builder.umls_graph_clip_threshold,
+        'build_ae': builder.build_ae,
+        'sources': fingerprint_files(external_sources(builder.ext_basepath) + list(sources)),
+        'layout': layout,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # processes that still map the old snapshot keep its files until they exit
+    old_dir = snapshot_dir + '.old'
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.exists(snapshot_dir):
+        os.replace(snapshot_dir, old_dir)
+    os.replace(tmp_dir, snapshot_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    return manifest
+
+
+def read_manifest(snapshot_dir):
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def is_stale(snapshot_dir, ext_basepath, sources=(), params=None):
+    """
+    Whether the snapshot is missing or was built from other source files (see save_snapshot) or with other build
+    `params`, e.g. {'umls_graph_clip_threshold': 10, 'build_ae': False}.
+    """
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None or manifest['version'] != SNAPSHOT_VERSION:
+        return True
+    if manifest['sources'] != fingerprint_files(external_sources(ext_basepath) + list(sources)):
+        return True
+    return any(manifest.get(name) != value for name, value in (params or {}).items())
+
+
+def load_snapshot(snapshot_dir, verify=False):
+    """
+    Open a snapshot written by `save_snapshot`. The KG arrays are memory-mapped, not read, and the returned KG is
+    read-only. With `verify` the files are first checked against the hashes recorded at save time (reads them all).
+    """
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        raise RuntimeError(f"No KG snapshot found in {snapshot_dir}")
+    if manifest['version'] != SNAPSHOT_VERSION:
+        raise RuntimeError(f"KG snapshot version {manifest['version']} is not supported (expected {SNAPSHOT_VERSION})")
+    if verify:
+        for filename, sha256 in manifest['sha256'].items():
+            if _sha256(os.path.join(snapshot_dir, filename)) != sha256:
+                raise RuntimeError(f"KG snapshot in {snapshot_dir} is corrupted (content hash mismatch of {filename})")
+
+    biokg = MappedBioKG(snapshot_dir, manifest['layout'])
+    with open(os.path.join(snapshot_dir, MESH_CLOSURE_FILE), 'rb') as f:
+        mesh_closure = pickle.load(f)
+    return KGSnapshot(biokg=biokg, mesh_closure=mesh_closure, entity2root=biokg.root_map(), manifest=manifest)
@@ -1,7 +1,42 @@
 
 import requests 
 
+from study_store import StudyFetcher, StudyStore
+
+# optional StudyStore (see open_study_store), studies are read from it before ClinicalTrials.gov is asked
+STUDY_STORE = None
+# optional StudyFetcher (see start_study_fetcher), pooled and rate limited requests for studies missing from the store
+STUDY_FETCHER = None
+# with a study store, fail on studies missing from it instead of requesting them
+OFFLINE = False
+
+
+def open_study_store(path):
+    global STUDY_STORE
+    STUDY_STORE = StudyStore(path)
+    return STUDY_STORE
+
+
+def start_study_fetcher(**kwargs):
+    """Fetch missing studies through a StudyFetcher, adding them to the study store if one is open."""
+    global STUDY_FETCHER
+    STUDY_FETCHER = StudyFetcher(STUDY_STORE, **kwargs)
+    return STUDY_FETCHER
+
+
 def get_clinical_trial_data(nctid):
+    if STUDY_STORE is not None:
+        trial_data = STUDY_STORE.get(nctid)
+        if trial_data is not None:
+            return trial_data
+        if OFFLINE:
+            return {"error": "{} is not in the study store {}".format(nctid, STUDY_STORE.path)}
+    if STUDY_FETCHER is not None:
+        try:
+            return STUDY_FETCHER.fetch(nctid)
+        except RuntimeError as e:
+            return {"error": str(e)}
+
     # Base URL of the ClinicalTrials.gov API with the specified version
     base_url = "https://clinicaltrials.gov/api/v2/studies"
 
@@ -32,6 +67,11 @@ def parse(nctid: str):
     if "error" in trial_data:
         raise RuntimeError("Error fetching data: {}".format(trial_data['error']))
 
+    return parse_study(trial_data)
+
+
+def parse_study(trial_data):
+    """The parsing attributes of one ClinicalTrials.gov v2 study JSON."""
     attributes = {
         "nct_id": "protocolSection.identificationModule.nctId",
         "arm_group": "protocolSection.armsInterventionsModule.armGroups",
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import socketserver
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import parse
+import parse_trial
+
+
+class ParseService:
+    """
+    Keeps the `parse_trial.load_tools` ParserContext (matchers, UMLS, KG snapshot, outcome and population models)
+    loaded and parses trials against it. The context is only read by the parsing code, so requests share it;
+    `max_concurrent` bounds how many trials (each running MedEx and criteria2query JVMs) are parsed at the same time.
+    """
+
+    def __init__(self, max_concurrent=2):
+        self.context = None
+        self.error = None
+        self.ready = threading.Event()
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='parse')
+
+    def load(self):
+        try:
+            self.context = parse_trial.load_tools()
+        except Exception:
+            self.error = traceback.format_exc()
+            print(self.error)
+        finally:
+            self.ready.set()
+
+    def start_loading(self):
+        threading.Thread(target=self.load, name='load_tools', daemon=True).start()
+
+    @property
+    def is_ready(self):
+        return self.ready.is_set() and self.context is not None
+
+    def _parse_one(self, nct_id):
+        try:
+            return {'nct_id': nct_id, 'trial_data': parse_trial.parse_trial(nct_id, self.context)}
+        except Exception as e:
+            traceback.print_exc()
+            return {'nct_id': nct_id, 'error': str(e)}
+
+    def parse(self, nct_id):
+        return self.pool.submit(self._parse_one, nct_id).result()
+
+    def parse_batch(self, nct_ids):
+        futures = [self.pool.submit(self._parse_one, nct_id) for nct_id in nct_ids]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.context is not None:
+            self.context.close()
+
+
+class ParseRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /healthz                                  process is up
+    GET  /readyz                                   200 once load_tools finished, 503 before (or if it failed)
+    GET  /cache                                    per stage hit rates of the result cache (--cache-dir)
+    POST /parse        {"nct_id": "NCT..."}         parse one trial
+    POST /parse/batch  {"nct_ids": ["NCT...", ...]} parse several trials concurrently, results in request order
+    """
+    service = None  # set by make_server
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, default=parse_trial.json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        service = self.service
+        if self.path == '/healthz':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/readyz':
+            if service.is_ready:
+                self._send(200, {'status': 'ready'})
+            elif service.error is not None:
+                self._send(503, {'status': 'failed', 'error': service.error})
+            else:
+                self._send(503, {'status': 'loading'})
+        elif self.path == '/cache':
+            if parse_trial.RESULT_CACHE is None:
+                self._send(404, {'error': 'no result cache configured'})
+            else:
+                self._send(200, parse_trial.RESULT_CACHE.stats())
+        else:
+            self._send(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        service = self.service
+        if self.path not in ('/parse', '/parse/batch'):
+            self._send(404, {'error': f'unknown path {self.path}'})
+            return
+        if not service.is_ready:
+            self._send(503, {'error': 'service is not ready'})
+            return
+        request = self._read_json()
+        if self.path == '/parse':
+            if not isinstance(request, dict) or not isinstance(request.get('nct_id'), str):
+                self._send(400, {'error': 'expected {"nct_id": "<NCT id>"}'})
+                return
+            result = service.parse(request['nct_id'])
+            self._send(200 if 'error' not in result else 500, result)
+        else:
+            nct_ids = request.get('nct_ids') if isinstance(request, dict) else None
+            if not isinstance(nct_ids, list) or not all(isinstance(nct_id, str) for nct_id in nct_ids):
+                self._send(400, {'error': 'expected {"nct_ids": ["<NCT id>", ...]}'})
+                return
+            self._send(200, {'results': service.parse_batch(nct_ids)})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    handler = type('BoundParseRequestHandler', (ParseRequestHandler,), {'service': service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve parse_trial with the parsing state loaded once.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', type=str, default=None, help='listen on this unix socket instead of host:port')
+    parser.add_argument('--max-concurrent', type=int, default=2, help='trials parsed at the same time')
+    parser.add_argument('--medex-workers', type=int, default=0, help='warm MedEx JVMs (0 runs java per trial)')
+    parser.add_argument('--crit2query-workers', type=int, default=0,
+                        help='warm criteria2query JVMs (0 runs java per trial)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='cache stage results (MedEx, criteria2query, '
+                        'UMLS concepts, drug matching) in this directory')
+    parser.add_argument('--cache-size-mb', type=int, default=2048)
+    parser.add_argument('--study-store', type=str, default=None,
+                        help='read studies from this store (see study_store.py) before requesting them')
+    parser.add_argument('--offline', action='store_true', help='only read studies from --study-store')
+    parser.add_argument('--requests-per-second', type=float, default=10, help='ClinicalTrials.gov request rate')
+    parser.add_argument('--data-dir', type=str, default=None)
+    parser.add_argument('--base-dir', type=str, default=None)
+    args = parser.parse_args()
+    if args.offline and args.study_store is None:
+        parser.error('--offline needs --study-store')
+
+    if args.data_dir is not None:
+        parse_trial.DATA_DIR = args.data_dir
+    if args.base_dir is not None:
+        parse_trial.BASE_DIR = args.base_dir
+
+    if args.medex_workers > 0:
+        parse_trial.start_medex_pool(num_workers=args.medex_workers)
+    if args.crit2query_workers > 0:
+        parse_trial.start_crit2query_pool(num_workers=args.crit2query_workers)
+    if args.cache_dir is not None:
+        parse_trial.open_result_cache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 ** 2)
+    if args.study_store is not None:
+        parse.open_study_store(args.study_store)
+    if args.offline:
+        parse.OFFLINE = True
+    else:
+        parse.start_study_fetcher(max_per_second=args.requests_per_second, pool_size=8)
+    service = ParseService(max_concurrent=args.max_concurrent)
+    service.start_loading()
+    server = make_server(service, host=args.host, port=args.port, socket_path=args.socket)
+    print(f"Serving on {args.socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -1,17 +1,21 @@
 import argparse
+import functools
 
 import requests
 import os
 import pickle
 import math
+from enum import Enum
 import numpy as np
 
 from data_parsers.external_tools.medex import medex_input
 from data_parsers.external_tools import medex
+from data_parsers.external_tools import criteria2query
 import tempfile
 import json
 import subprocess
 import shlex
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from parse import parse
 
 from data_parsers import DiseaseExtract
@@ -22,14 +26,25 @@ from data_parsers import UMLSConceptSearcher
 
 from data_parsers import UMLSTFIDFMatcher
 from data_parsers.umls_utils import UMLSUtils
+from data_parsers.result_cache import ResultCache
+from data_parsers import reference_data
+from data_parsers.reference_data import ReferenceData, ReferenceWriter
 
 from knowledge_graph import KnowledgeGraphBuilder
-from knowledge_graph.kg import UnionFind
 from knowledge_graph.build_graph import TrialGraphBuilder
+from knowledge_graph import snapshot as kg_snapshot
 from knowledge_graph.node_features import TrialAttributeFeatures
 
 DATA_DIR = "/data/parsing_package/data"
 BASE_DIR = "/data/parsing_package"
+# optional medex.MedexPool (see start_medex_pool), MedEx then runs in warm JVMs instead of one `java` per trial
+MEDEX_POOL = None
+# optional criteria2query.Crit2QueryPool (see start_crit2query_pool), same for criteria2query
+CRIT2QUERY_POOL = None
+# optional ResultCache (see open_result_cache) consulted before MedEx, criteria2query, UMLS concepts and drug matching
+RESULT_CACHE = None
+# bump when a cached stage's code changes its results
+CACHE_VERSION = 1
 
 def set_data_dir(path):
     DATA_DIR = f"{path}/parsing_package/data"
@@ -37,19 +52,94 @@ def set_data_dir(path):
 def set_base_dir(path):
     BASE_DIR = f"/{path}/parsing_package"
 
-def run_medex_and_parse_output(parsed_trial):
-    result = {}
+def medex_dir():
+    return f'{BASE_DIR}/resources/medex/Medex_UIMA_1.3.8'
+
+
+def medex_classpath():
+    return f'{BASE_DIR}/resources/medex/Medex_UIMA_1.3.8/bin:resources/medex/Medex_UIMA_1.3.8/lib/*'
+
+
+def start_medex_pool(num_workers=2, **kwargs):
+    global MEDEX_POOL
+    MEDEX_POOL = medex.MedexPool(medex_classpath(), num_workers=num_workers, **kwargs)
+    return MEDEX_POOL
+
+
+def crit2query_jar():
+    return f'{BASE_DIR}/resources/criteria2query.jar'
+
+
+def start_crit2query_pool(num_workers=2, **kwargs):
+    global CRIT2QUERY_POOL
+    CRIT2QUERY_POOL = criteria2query.Crit2QueryPool(crit2query_jar(), num_workers=num_workers, **kwargs)
+    return CRIT2QUERY_POOL
+
+
+def stage_version(*paths):
+    """
+    Tool/data version of a cached stage: CACHE_VERSION plus size and mtime of the files the stage depends on. A
+    directory stands for all files below it, as its own mtime does not change when one of them is edited.
+    """
+    identities = [str(CACHE_VERSION)]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names))
+        else:
+            files.append(path)
+    for path in files:
+        try:
+            stat = os.stat(path)
+            identities.append(f'{path}:{stat.st_size}:{int(stat.st_mtime)}')
+        except OSError:
+            identities.append(f'{path}:missing')
+    return '|'.join(identities)
+
+
+@functools.lru_cache(maxsize=None)
+def medex_stage_version():
+    """
+    stage_version of MedEx: its classes, lib/*.jar and lexicons. Taken once per process, the MedEx JVMs of the pool
+    also load them only once.
+    """
+    return stage_version(medex_dir())
+
+
+@functools.lru_cache(maxsize=None)
+def population_stage_version(umls_dir, search_cache_dir):
+    """
+    stage_version of the population stage: criteria2query, the UMLS tables (MRCONSO/MRREL or the compiled reference
+    data), the TF-IDF matcher, cuid2term and the UMLS concept-search cache. Taken once per process, like the tools.
+    """
+    return stage_version(crit2query_jar(), f'{umls_dir}/META/MRCONSO.RRF', f'{umls_dir}/META/MRREL.RRF',
+                         os.path.join(reference_dir(), reference_data.MANIFEST_FILE),
+                         f'{DATA_DIR}/population_data/tfidf_matcher_state.pkl', cuid2term_path(), search_cache_dir)
 
-    classpath = f'{BASE_DIR}/resources/medex/Medex_UIMA_1.3.8/bin:resources/medex/Medex_UIMA_1.3.8/lib/*'
+
+def open_result_cache(cache_dir, max_bytes=2 * 1024 ** 3):
+    global RESULT_CACHE
+    RESULT_CACHE = ResultCache(cache_dir, max_bytes=max_bytes)
+    return RESULT_CACHE
+
+
+def run_medex(inputs):
+    """MedEx outputs {key: output text} for the inputs {key: text}."""
+    if MEDEX_POOL is not None:
+        return MEDEX_POOL.run(inputs)
+    return run_medex_subprocess(inputs)
+
+
+def run_medex_subprocess(inputs):
+    classpath = medex_classpath()
     args_template = "java -Xmx1024m -cp {0} org.apache.medex.Main -i {1} -o {2} -b n -f y -d y -t n"
 
     with tempfile.TemporaryDirectory() as basedir:
         # create medex input
-        medex_input._generate_medex_inputs(parsed_trial, result)
         input_dir = os.path.join(basedir, 'inputs')
         os.makedirs(input_dir)
         with open(os.path.join(input_dir, 'medex_input.json'), 'w') as f:
-            json.dump(result, f)
+            json.dump(inputs, f)
 
         # Run medex
         output_path = os.path.join(basedir, "outputs")
@@ -63,27 +153,56 @@ def run_medex_and_parse_output(parsed_trial):
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"Medex execution failed with error: {e}")
 
-        medex_output_parser = medex.MedexOutputParser(base_paths=[output_path])
+        return medex.MedexOutputParser._read_output([output_path])
 
-        medex_output_parser.fill_medex_info(parsed_trial)
 
+def run_medex_and_parse_output(parsed_trial):
+    result = {}
+    medex_input._generate_medex_inputs(parsed_trial, result)
+
+    # MedEx handles every input text on its own, so outputs are cached per text
+    outputs = {}
+    version = medex_stage_version()
+    if RESULT_CACHE is not None:
+        for key, text in result.items():
+            output = RESULT_CACHE.get('medex', version, text)
+            if output is not None:
+                outputs[key] = output
+    missing = {key: text for key, text in result.items() if key not in outputs}
+    if missing:
+        new_outputs = run_medex(missing)
+        outputs.update(new_outputs)
+        if RESULT_CACHE is not None:
+            for key, text in missing.items():
+                if key in new_outputs:
+                    RESULT_CACHE.put('medex', version, text, new_outputs[key])
+
+    medex_output_parser = medex.MedexOutputParser(outputs=outputs)
+    medex_output_parser.fill_medex_info(parsed_trial)
     return parsed_trial
 
 
-def parse_eligiility_criteria(parsed_trial):
-    args_template = f"java -Xmx4096m -jar /{BASE_DIR}/resources/criteria2query.jar  --input {0} --outputDir {1}"
+def run_crit2query(criteria_text):
+    """Raw criteria2query output (the loaded output.json) for one eligibility criteria text."""
+    if CRIT2QUERY_POOL is not None:
+        return CRIT2QUERY_POOL.run_json(criteria_text)
+    return run_crit2query_subprocess(criteria_text)
+
+
+def run_crit2query_subprocess(criteria_text):
+    args_template = "java -Xmx4096m -jar {0} --input {1} --outputDir {2}"
 
     with tempfile.TemporaryDirectory() as basedir:
         # create input
         input_dir = os.path.join(basedir, 'inputs')
         os.makedirs(input_dir)
         with open(os.path.join(input_dir, 'crit_input.txt'), 'w') as f:
-            f.write(parsed_trial['eligibility_criteria'])
+            f.write(criteria_text)
 
         # Run crit2query
         output_path = os.path.join(basedir, "outputs")
         os.makedirs(os.path.join(output_path, "data"))
-        args = args_template.format(os.path.join(input_dir, 'crit_input.txt'),
+        args = args_template.format(crit2query_jar(), os.path.join(input_dir, 'crit_input.txt'),
                                     os.path.join(output_path, "data"))
         print(args)
         # args = args_template
@@ -92,33 +211,50 @@ def parse_eligiility_criteria(parsed_trial):
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"Crit2Query execution failed with error: {e}")
 
-        parsed_trial['ec_umls'] = CriteriaOutputParser.parse_crit_output_from_file(
-            os.path.join(output_path, "data", "output.json"))
+        with open(os.path.join(output_path, "data", "output.json")) as f:
+            return json.load(f)
+
+
+def parse_eligiility_criteria(parsed_trial):
+    criteria_text = parsed_trial['eligibility_criteria']
+    if RESULT_CACHE is not None:
+        output = RESULT_CACHE.cached('crit2query', stage_version(crit2query_jar()), criteria_text,
+                                     lambda: run_crit2query(criteria_text))
+    else:
+        output = run_crit2query(criteria_text)
+    parsed_trial['ec_umls'] = CriteriaOutputParser.parse_crit_output(output)
     return parsed_trial
 
 
-def extract_outcomes(parsed_trial):
-    outcome_extractor = OutcomeMeasureExtract(
-        f'{DATA_DIR}/outcome_data/clusters-outcome-measures.txt')
+def extract_outcomes(context, parsed_trial):
+    context.outcome_extractor.populate_cids(parsed_trial)
+    return parsed_trial
 
-    outcome_extractor.load_phrase_models(f'{DATA_DIR}/outcome_data')
-    outcome_extractor.populate_cids(parsed_trial)
 
+def population_extraction(context, parsed_trial):
+    if RESULT_CACHE is None:
+        return _population_extraction(context, parsed_trial)
+    # the concepts only depend on the criteria2query output, i.e. on the eligibility criteria text
+    version = population_stage_version(context.umls_utils.umls_dir, context.concept_searcher.cache_dir)
+    payload = parsed_trial['eligibility_criteria']
+    ec_umls = RESULT_CACHE.get('population', version, payload)
+    if ec_umls is not None:
+        parsed_trial['ec_umls'] = ec_umls
+        return parsed_trial
+    parsed_trial = _population_extraction(context, parsed_trial)
+    RESULT_CACHE.put('population', version, payload, parsed_trial['ec_umls'])
     return parsed_trial
 
 
-def population_extraction(umls_utils, parsed_trial):
-    umls_concept_searcher = UMLSConceptSearcher(
-        api_key='', version='2020AB', cache_dir=f'{DATA_DIR}/population_data/umls_search_cache')
-    umls_concept_searcher.set_umls_search(False)
+def _population_extraction(context, parsed_trial):
+    umls_utils = context.umls_utils
 
     criteria_all = parsed_trial['ec_umls']
     for category in criteria_all:
         for inclusion in criteria_all[category]:
             for criterion in criteria_all[category][inclusion]:
-                criterion.map_concept(umls_concept_searcher)
+                criterion.map_concept(context.concept_searcher)
 
-    umls_utils.cuid2parents = {}
     criteria_all = parsed_trial['ec_umls']
     for category in criteria_all:
         for inclusion in criteria_all[category]:
@@ -126,9 +262,7 @@ def population_extraction(umls_utils, parsed_trial):
                 if criterion.concept is not None:
                     criterion.parents = umls_utils.parents(criterion.concept['ui'])
 
-    tfidf_matcher = UMLSTFIDFMatcher(umls_utils.cuid2concept, f'{DATA_DIR}/population_data', None)
-
-    tfidf_matcher.populate_result_single(parsed_trial['ec_umls'])
+    context.tfidf_matcher.populate_result_single(parsed_trial['ec_umls'])
 
     return parsed_trial
 
@@ -251,31 +385,50 @@ def get_arm_text(row):
     return arm2text, nct2text
 
 
-def build_trial_arms(disease_matcher, drug_matcher, umls_utils, cuid2term, parsed_trial):
+def load_kg_base(disease_matcher, drug_matcher, umls_utils, cuid2term):
+    """
+    Load the external KG snapshot (building and saving it first if missing or stale) and the entity to KG concept
+    id map. Done once per process, trial arms are then added on an overlay in `build_trial_arms`.
+    """
+    ext_basepath = f'{DATA_DIR}/kg_data/external_data'
+    snapshot_dir = f'{DATA_DIR}/kg_data/external_snapshot'
+    params = {'umls_graph_clip_threshold': 10, 'build_ae': False}
+    if kg_snapshot.is_stale(snapshot_dir, ext_basepath, kg_snapshot_sources(), params):
+        builder = KnowledgeGraphBuilder(disease_matcher.mesh_dis_data, drug_matcher.drug_data, ext_basepath,
+                                        cuid2term, umls_utils, **params)
+        builder.build_external_networks()
+        builder._mesh_children()
+        kg_snapshot.save_snapshot(builder, snapshot_dir, kg_snapshot_sources())
+
+    snapshot = kg_snapshot.load_snapshot(snapshot_dir)
+    # trial arms only read the snapshot, so the MeSH and DrugBank tables stay unparsed
+    builder = KnowledgeGraphBuilder(None, None, ext_basepath, cuid2term, umls_utils, load_external=False, **params)
+    builder.attach_snapshot(snapshot)
+
     entity2cid_path = f'{DATA_DIR}/kg_data/kg-entity2cid-31_7_21.pkl'
     with open(entity2cid_path, 'rb') as f:
         entity2cid = pickle.load(f)
 
-    ext_basepath = f'{DATA_DIR}/kg_data/external_data'
-    builder = KnowledgeGraphBuilder(disease_matcher.mesh_dis_data, drug_matcher.drug_data, ext_basepath,
-                                    cuid2term, umls_utils, umls_graph_clip_threshold=10,
-                                    build_ae=False)
+    # entity2cid is keyed by the representative entity that was picked when the KG was merged, re-key it by the
+    # representatives of the snapshot so that lookups do not depend on which member the union-find chose
+    entity2root = snapshot.entity2root
+    root2cid = dict(entity2cid)
+    for entity, root in entity2root.items():
+        if entity in entity2cid:
+            root2cid[root] = entity2cid[entity]
+
+    return builder, entity2root, root2cid
 
-    builder.build_external_networks()
-    builder._mesh_children()
+
+def build_trial_arms(context, parsed_trial):
+    base_builder, entity2root, entity2cid = context.kg_base
+    builder = base_builder.trial_overlay()
 
     parsed_trial['has_results'] = False
 
     trial_builder = TrialGraphBuilder(builder, parsed_trial)
     trial_builder.build(use_population=True)
 
-    uf = UnionFind()
-    cnt = 0
-    for u, v, data in builder.biokg.graph.edges(data=True):
-        if data['relation'] == 'KG-MERGE-SAME':
-            cnt += 1
-            uf.union(u, v)
-
     trial_attribute_featurizer = TrialAttributeFeatures(attributes=('age', 'gender', 'enrollment', 'phase'))
     trial_attribute_feats = extract_trial_features(trial_attribute_featurizer, parsed_trial)
 
@@ -284,9 +437,8 @@ def build_trial_arms(disease_matcher, drug_matcher, umls_utils, cuid2term, parse
     for arm_label, arm_idx in trial_builder.arm_labels.items():
         trial_arm_data = []
         for u, v, k, data in builder.biokg.graph.edges(nbunch=[trial_builder.arm_key(arm_idx)], data=True, keys=True):
-            #         print(u, v, k, data['relation'], entity2cid[uf.find_parent(v)])
             trial_arm_data.append({
-                'kg_id': entity2cid[uf.find_parent(v)],
+                'kg_id': entity2cid[entity2root.get(v, v)],
                 'relation': data['relation'],
                 'key': k,
                 'data': data
@@ -302,48 +454,273 @@ def build_trial_arms(disease_matcher, drug_matcher, umls_utils, cuid2term, parse
 
     return trial_data
 
+def cuid2term_path():
+    return f'{DATA_DIR}/population_data/umls_graph_clipper_output.pkl'
+
+
 def load_cuid2term():
-    basedir = f'{DATA_DIR}/population_data'
-    filepath = os.path.join(basedir, "umls_graph_clipper_output.pkl")
-    with open(filepath, "rb") as f:
+    with open(cuid2term_path(), "rb") as f:
         g_clipper_state = pickle.load(f)
         cuid2term = g_clipper_state['cuid2term']
     return cuid2term
 
 
-def load_tools():
-    drug_matcher = DrugMatcher(data_paths={
+def load_outcome_extractor():
+    outcome_extractor = OutcomeMeasureExtract(f'{DATA_DIR}/outcome_data/clusters-outcome-measures.txt')
+    outcome_extractor.load_phrase_models(f'{DATA_DIR}/outcome_data')
+    return outcome_extractor
+
+
+def load_concept_searcher():
+    # cache only: trials are never looked up online while parsing
+    concept_searcher = UMLSConceptSearcher(
+        api_key='', version='2020AB', cache_dir=f'{DATA_DIR}/population_data/umls_search_cache')
+    concept_searcher.set_umls_search(False)
+    return concept_searcher
+
+
+def load_tfidf_matcher(umls_utils):
+    return UMLSTFIDFMatcher(umls_utils.cuid2concept, f'{DATA_DIR}/population_data', None)
+
+
+class ParserContext:
+    """
+    The warm parsing state every stage of `parse_trial` is given: drug/disease matchers, UMLS, the KG snapshot and the
+    outcome phrase models, UMLS concept cache and TF-IDF matcher. Created once by `load_tools` and only read by the
+    stages afterwards, so concurrent trials (threads of the service, forked batch workers) share one context.
+    `close` releases it, after which it cannot be used for parsing any more.
+    """
+
+    def __init__(self, drug_matcher, disease_matcher, umls_utils, cuid2term, kg_base, outcome_extractor,
+                 concept_searcher, tfidf_matcher):
+        self.drug_matcher = drug_matcher
+        self.disease_matcher = disease_matcher
+        self.umls_utils = umls_utils
+        self.cuid2term = cuid2term
+        self.kg_base = kg_base
+        self.outcome_extractor = outcome_extractor
+        self.concept_searcher = concept_searcher
+        self.tfidf_matcher = tfidf_matcher
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        if self.concept_searcher.new_cache:
+            # only filled when online UMLS search was switched on
+            self.concept_searcher._save_cache(force=True)
+        self.drug_matcher = self.disease_matcher = self.umls_utils = self.cuid2term = self.kg_base = None
+        self.outcome_extractor = self.concept_searcher = self.tfidf_matcher = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def drug_data_paths():
+    return {
         'drug_data': f'{DATA_DIR}/drug_data/drugs_all_03_04_21.pkl',
         'pubchem_synonyms': f'{DATA_DIR}/drug_data/pubchem-drugbankid-synonyms.json',
         'rxnorm2drugbank-umls': f'{DATA_DIR}/drug_data/rxnorm2drugbank-umls.pkl',
         'RXNCONSO': f'{DATA_DIR}/drug_data/RXNCONSO.RRF'
-    })
+    }
+
+
+def umls_dir():
+    return f'{DATA_DIR}/population_data/umls-install/2020AB'
+
+
+def reference_dir():
+    return f'{DATA_DIR}/reference_data'
+
+
+def reference_sources():
+    return (list(drug_data_paths().values()) + DiseaseExtract.mesh_sources(f'{DATA_DIR}/disease_data/2021', 2021)
+            + [f'{umls_dir()}/META/MRCONSO.RRF', f'{umls_dir()}/META/MRREL.RRF'])
+
+
+def kg_snapshot_sources():
+    """Inputs of the external KG snapshot besides its TSV/OBO files: MeSH, DrugBank, cuid2term and UMLS."""
+    return (DiseaseExtract.mesh_sources(f'{DATA_DIR}/disease_data/2021', 2021)
+            + [drug_data_paths()['drug_data'], cuid2term_path(), f'{umls_dir()}/META/MRCONSO.RRF',
+               f'{umls_dir()}/META/MRREL.RRF'])
+
+
+def compile_reference_data(out_dir=None):
+    """
+    Parse the raw drug, MeSH and UMLS sources once and write their lookup tables to a reference data directory
+    (see data_parsers.reference_data) that `load_tools` memory-maps instead of parsing the sources again.
+    """
+    out_dir = out_dir or reference_dir()
+    drug_matcher = DrugMatcher(data_paths=drug_data_paths())
     disease_matcher = DiseaseExtract(data_dir=DATA_DIR, data_year=2021)
-    umls_utils = UMLSUtils(f'{DATA_DIR}/population_data/umls-install/2020AB')
+    umls_utils = UMLSUtils(umls_dir())
+    umls_utils.load_relations()
+
+    writer = ReferenceWriter(out_dir)
+    for component in (drug_matcher, disease_matcher, umls_utils):
+        for name, table in component.reference_tables().items():
+            writer.add(name, table)
+    return writer.finish(reference_sources())
+
+
+def load_tools():
+    # reference data is compiled first if missing or stale, the same way load_kg_base handles the KG snapshot
+    if reference_data.is_stale(reference_dir(), reference_sources()):
+        compile_reference_data()
+    reference = ReferenceData(reference_dir())
+
+    drug_matcher = DrugMatcher(data_paths=drug_data_paths(), reference=reference)
+    disease_matcher = DiseaseExtract(data_dir=DATA_DIR, data_year=2021, reference=reference)
+    umls_utils = UMLSUtils(umls_dir(), reference=reference)
     umls_utils.load_relations()
     cuid2term = load_cuid2term()
+    kg_base = load_kg_base(disease_matcher, drug_matcher, umls_utils, cuid2term)
+
+    return ParserContext(drug_matcher, disease_matcher, umls_utils, cuid2term, kg_base,
+                         outcome_extractor=load_outcome_extractor(), concept_searcher=load_concept_searcher(),
+                         tfidf_matcher=load_tfidf_matcher(umls_utils))
+
+
+def fetch_trial(nct_id):
+    return parse(nct_id)
+
+
+def run_stages(stages):
+    """
+    Run {name: (fn, deps)}: every stage starts in its own thread as soon as the stages named in `deps` finished.
+    Returns {name: fn()}. After a failure no further stage is started and, once the running ones returned, the first
+    error is raised.
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=len(stages) or 1, thread_name_prefix='stage') as executor:
+        while pending or running:
+            if error is None:
+                for name, (fn, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        running[executor.submit(fn)] = name
+                        del pending[name]
+            if not running:
+                if error is None:
+                    raise RuntimeError(f"Stages {sorted(pending)} depend on unknown or cyclic stages")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return results
+
+
+def run_jvm_tools(trial):
+    """MedEx and criteria2query, the JVM-bound part of parsing a trial (run concurrently)."""
+    run_stages({
+        'medex': (lambda: run_medex_and_parse_output(trial), ()),
+        'crit2query': (lambda: parse_eligiility_criteria(trial), ()),
+    })
+    return trial
+
+
+def map_diseases(context, trial):
+    trial['mesh_ids'] = context.disease_matcher.get_disease_ids(trial)
+    return trial
+
+
+# intervention fields read by get_intervention_drug_ids
+DRUG_MATCH_INPUTS = ('intervention_type', 'intervention_name', 'other_name', 'medex_out', 'medex_othernames')
+
+
+def drug_match_payload(intervention, trial):
+    """
+    Result cache payload of matching `intervention`: its DRUG_MATCH_INPUTS plus the entries of the trial-wide
+    `medex_processed` that get_intervention_drug_ids looks up, i.e. those of its MedEx drug names.
+    """
+    payload = {key: intervention.get(key) for key in DRUG_MATCH_INPUTS}
+    medex_processed = trial.get('medex_processed', {})
+    names = set(intervention.get('medex_out') or {}) | set(intervention.get('medex_othernames') or {})
+    payload['medex_processed'] = {name: medex_processed[name] for name in names if name in medex_processed}
+    return payload
+
+
+def map_drugs(context, trial):
+    # needs MedEx output
+    drug_matcher = context.drug_matcher
+    version = stage_version(*sorted(drug_matcher.data_paths.values())) if RESULT_CACHE is not None else None
+    for intervention in trial['intervention']:
+        if RESULT_CACHE is None:
+            get_intervention_drug_ids(drug_matcher, intervention, trial)
+            continue
+        payload = drug_match_payload(intervention, trial)
+        updates = RESULT_CACHE.get('drugs', version, payload)
+        if updates is None:
+            before = dict(intervention)
+            get_intervention_drug_ids(drug_matcher, intervention, trial)
+            updates = {key: value for key, value in intervention.items() if key not in before or before[key] != value}
+            RESULT_CACHE.put('drugs', version, payload, updates)
+        intervention.update(updates)
+    return trial
+
+
+def trial_stages(trial, context):
+    """
+    The stages of parsing a fetched trial for `run_stages`. They fill disjoint parts of `trial`, so the four branches
+    (MedEx -> drugs, criteria2query -> population, diseases, outcomes) run concurrently and only the KG arms wait for
+    all of them.
+    """
+    return {
+        'medex': (lambda: run_medex_and_parse_output(trial), ()),
+        'crit2query': (lambda: parse_eligiility_criteria(trial), ()),
+        'diseases': (lambda: map_diseases(context, trial), ()),
+        'outcomes': (lambda: extract_outcomes(context, trial), ()),
+        'drugs': (lambda: map_drugs(context, trial), ('medex',)),
+        'population': (lambda: population_extraction(context, trial), ('crit2query',)),
+        'arms': (lambda: build_trial_arms(context, trial), ('diseases', 'outcomes', 'drugs', 'population')),
+    }
 
-    return drug_matcher, disease_matcher, umls_utils, cuid2term
 
+def match_trial(trial, context):
+    """Disease, drug, outcome and population matching and the KG arms, the CPU-bound part of parsing a trial."""
+    trial = map_diseases(context, trial)
+    trial = map_drugs(context, trial)
+    trial = extract_outcomes(context, trial)
+    trial = population_extraction(context, trial)
 
-def parse_trial(nct_id, state):
-    drug_matcher, disease_matcher, umls_utils, cuid2term = state
+    trial_data = build_trial_arms(context, trial)
 
-    trial = parse(nct_id)
-    trial = run_medex_and_parse_output(trial)
-    trial = parse_eligiility_criteria(trial)
-    trial['mesh_ids'] = disease_matcher.get_disease_ids(trial)
+    return trial_data
 
-    interventions = trial['intervention']
-    for intervention in interventions:
-        get_intervention_drug_ids(drug_matcher, intervention, trial)
 
-    trial = extract_outcomes(trial)
-    trial = population_extraction(umls_utils, trial)
+def parse_trial_data(trial, context):
+    """KG arms of a trial given in the `parse.parse` format, e.g. the trial data of a submission."""
+    return run_stages(trial_stages(trial, context))['arms']
 
-    trial_data = build_trial_arms(disease_matcher, drug_matcher, umls_utils, cuid2term, trial)
 
-    return trial_data
+def parse_trial(nct_id, context):
+    return parse_trial_data(fetch_trial(nct_id), context)
+
+
+def json_default(obj):
+    """`json.dumps` fallback for parse results (enums, sets and numpy values)."""
+    if isinstance(obj, Enum):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
 
 
 if __name__ == '__main__':
@@ -351,6 +728,5 @@ if __name__ == '__main__':
     parser.add_argument('nctid', type=str, help='NCT ID of the clinical trial', default='NCT02370680')
     args = parser.parse_args()
 
-    state = load_tools()
-
-    print(parse_trial(args.nctid, state))
+    with load_tools() as context:
+        print(parse_trial(args.nctid, context))
@@ -0,0 +1,255 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+CTGOV_STUDIES_URL = "https://clinicaltrials.gov/api/v2/studies"
+
+
+def study_nct_id(study):
+    return study['protocolSection']['identificationModule']['nctId']
+
+
+def study_last_update(study):
+    status = study.get('protocolSection', {}).get('statusModule', {})
+    return status.get('lastUpdatePostDateStruct', {}).get('date')
+
+
+def read_bulk_export(path):
+    """
+    Yield the studies of a ClinicalTrials.gov bulk JSON export: the downloaded zip (one NCTxxxxxxxx.json per study), a
+    directory of such files, or one JSON file with a list of studies or an API page ({"studies": [...]}).
+    """
+    if os.path.isdir(path):
+        for filename in sorted(glob.glob(os.path.join(path, '**', '*.json'), recursive=True)):
+            with open(filename) as f:
+                yield json.load(f)
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as bulk:
+            for name in bulk.namelist():
+                if name.endswith('.json'):
+                    yield json.loads(bulk.read(name))
+    else:
+        with open(path) as f:
+            studies = json.load(f)
+        if isinstance(studies, dict):
+            studies = studies['studies']
+        yield from studies
+
+
+class StudyStore:
+    """
+    Local copy of ClinicalTrials.gov studies (the v2 API JSON of a study), keyed by NCT id in one SQLite file. Each
+    study is kept as zlib compressed JSON, so the whole registry fits in a few GB and a lookup is one indexed read.
+    Filled from the bulk export by `import_bulk` and by StudyFetcher for the studies it had to download. Safe to
+    share between threads and processes.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        with self.lock:
+            self._connection()
+
+    def _connection(self):
+        # a connection must not cross a fork, children open their own
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS studies '
+                         '(nct_id TEXT PRIMARY KEY, last_update TEXT, stored REAL, data BLOB)')
+            # HTTP validators of the last download, stores created before they were kept lack the columns
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(studies)')}
+            for column in ('etag', 'last_modified'):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE studies ADD COLUMN {column} TEXT')
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, nct_id):
+        """The study JSON of `nct_id`, or None if it is not in the store."""
+        with self.lock:
+            row = self._connection().execute('SELECT data FROM studies WHERE nct_id = ?', (nct_id,)).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]))
+
+    def validators(self, nct_id):
+        """(ETag, Last-Modified) of the stored download of `nct_id`, None for unknown ones."""
+        with self.lock:
+            row = self._connection().execute('SELECT etag, last_modified FROM studies WHERE nct_id = ?',
+                                             (nct_id,)).fetchone()
+        return (None, None) if row is None else row
+
+    def stored_ids(self, nct_ids):
+        """The ones of `nct_ids` that are in the store."""
+        nct_ids = list(nct_ids)
+        stored = set()
+        with self.lock:
+            conn = self._connection()
+            for start in range(0, len(nct_ids), 500):
+                chunk = nct_ids[start:start + 500]
+                query = f"SELECT nct_id FROM studies WHERE nct_id IN ({','.join('?' * len(chunk))})"
+                stored.update(row[0] for row in conn.execute(query, chunk))
+        return stored
+
+    def __contains__(self, nct_id):
+        with self.lock:
+            row = self._connection().execute('SELECT 1 FROM studies WHERE nct_id = ?', (nct_id,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self._connection().execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+
+    @staticmethod
+    def _row(study, etag=None, last_modified=None):
+        data = zlib.compress(json.dumps(study, separators=(',', ':')).encode('utf-8'))
+        return study_nct_id(study), study_last_update(study), time.time(), data, etag, last_modified
+
+    def put_many(self, studies, validators=None):
+        """Add or replace `studies`, `validators` are their (ETag, Last-Modified) headers if downloaded one by one."""
+        validators = validators or [(None, None)] * len(studies)
+        rows = [self._row(study, *study_validators) for study, study_validators in zip(studies, validators)]
+        with self.lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO studies (nct_id, last_update, stored, data, etag, '
+                                 'last_modified) VALUES (?, ?, ?, ?, ?, ?)', rows)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def put(self, study, etag=None, last_modified=None):
+        self.put_many([study], [(etag, last_modified)])
+
+    def import_bulk(self, path, batch_size=1000):
+        """Add (or replace) all studies of a bulk export (see read_bulk_export), returns the number imported."""
+        count = 0
+        batch = []
+        for study in tqdm(read_bulk_export(path)):
+            batch.append(study)
+            if len(batch) == batch_size:
+                self.put_many(batch)
+                count += len(batch)
+                batch = []
+        self.put_many(batch)
+        return count + len(batch)
+
+
+class RateLimiter:
+    """Spaces calls of `wait` from any number of threads at least 1 / `max_per_second` seconds apart."""
+
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class StudyFetcher:
+    """
+    Downloads studies from the ClinicalTrials.gov API over one pooled keep-alive session. Requests from all threads
+    together stay under `max_per_second`, time out after `timeout` seconds and are retried with exponential backoff
+    on connection errors, 429 (honouring Retry-After) and 5xx. Fetched studies are added to `store` if one is given.
+    `base_url` can point to a local stand-in server.
+    """
+
+    def __init__(self, store=None, base_url=CTGOV_STUDIES_URL, max_per_second=5, pool_size=8, timeout=30,
+                 retries=3):
+        self.store = store
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(max_per_second)
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, nct_id):
+        """The study JSON of `nct_id`, raises RuntimeError if it could not be fetched."""
+        self.rate_limiter.wait()
+        try:
+            response = self.session.get(f'{self.base_url}/{nct_id}', timeout=self.timeout)
+        except requests.RequestException as e:
+            raise RuntimeError(f"Failed to fetch {nct_id}: {e}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to fetch {nct_id}. Status code: {response.status_code}, "
+                               f"Message: {response.text}")
+        study = response.json()
+        if self.store is not None:
+            self.store.put(study, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return study
+
+    def fetch_missing(self, nct_ids, num_workers=8):
+        """Fetch the studies of `nct_ids` that are not in the store yet, returns {nct_id: error} of the failed ones."""
+        nct_ids = list(dict.fromkeys(nct_ids))
+        stored = self.store.stored_ids(nct_ids)
+        missing = [nct_id for nct_id in nct_ids if nct_id not in stored]
+        errors = {}
+
+        def fetch_one(nct_id):
+            try:
+                self.fetch(nct_id)
+            except RuntimeError as e:
+                errors[nct_id] = str(e)
+
+        with ThreadPoolExecutor(num_workers) as pool:
+            list(tqdm(pool.map(fetch_one, missing), total=len(missing)))
+        return errors
+
+    def close(self):
+        self.session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a local store of ClinicalTrials.gov studies for parse.py.')
+    parser.add_argument('store', type=str, help='SQLite study store (created if missing)')
+    parser.add_argument('--import', dest='bulk', type=str, default=None,
+                        help='bulk JSON export (zip, directory of study files or JSON list) to import')
+    parser.add_argument('--fetch', type=str, default=None,
+                        help='file with one NCT ID per line, the ones missing from the store are downloaded')
+    parser.add_argument('--base-url', type=str, default=CTGOV_STUDIES_URL)
+    parser.add_argument('--requests-per-second', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    store = StudyStore(args.store)
+    if args.bulk is not None:
+        print(f"Imported {store.import_bulk(args.bulk)} studies from {args.bulk}")
+    if args.fetch is not None:
+        with open(args.fetch) as f:
+            nct_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        fetcher = StudyFetcher(store, base_url=args.base_url, max_per_second=args.requests_per_second,
+                               pool_size=args.workers)
+        errors = fetcher.fetch_missing(nct_ids, num_workers=args.workers)
+        fetcher.close()
+        for nct_id, error in errors.items():
+            print(error)
+        print(f"{len(errors)} of {len(nct_ids)} studies could not be fetched")
+    print(f"{len(store)} studies in {args.store}")
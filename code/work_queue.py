@@ -0,0 +1,296 @@
+import argparse
+import glob
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import parse_trial
+from batch_parse import BatchParser, add_pipeline_arguments, read_nct_ids, setup_pipeline
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    """
+    Persistent queue of NCT ids to parse, one SQLite file. Each item records its status (pending, leased, done or
+    failed), the stage it failed in, the number of attempts and the last error. Workers lease items for
+    `lease_seconds`; an item whose lease runs out (its worker died) is handed out again, until `max_attempts` leases
+    were used up. Everything a run did is committed per trial, so a restarted run continues where the last one
+    stopped. Safe to share between threads and processes.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        with self.lock:
+            self._connection()
+
+    def _connection(self):
+        # a connection must not cross a fork, children open their own
+        if self.conn is None or self.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS items (nct_id TEXT PRIMARY KEY, status TEXT, stage TEXT, '
+                         'attempts INTEGER, error TEXT, owner TEXT, lease_expires REAL, added REAL, finished REAL, '
+                         'shard TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS items_status ON items (status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS items_finished ON items (finished)')
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def _transaction(self, fn):
+        with self.lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(conn)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def add(self, nct_ids):
+        """Queue `nct_ids`, ids already in the queue keep their state. Returns the number of new items."""
+        now = time.time()
+        rows = [(nct_id, PENDING, None, 0, None, None, None, now, None, None) for nct_id in nct_ids]
+
+        def add_rows(conn):
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            return conn.total_changes - before
+
+        return self._transaction(add_rows)
+
+    def lease(self, owner, limit, lease_seconds=1800, max_attempts=3):
+        """Lease up to `limit` pending items (or items of expired leases) to `owner`, returns their NCT ids."""
+        now = time.time()
+
+        def lease_items(conn):
+            # the worker of an expired lease died with the item, after max_attempts of those it counts as failed
+            conn.execute("UPDATE items SET status = ?, error = 'lease expired', owner = NULL, finished = ? "
+                         "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                         (FAILED, now, LEASED, now, max_attempts))
+            nct_ids = [row[0] for row in conn.execute(
+                'SELECT nct_id FROM items WHERE status = ? OR (status = ? AND lease_expires < ?) '
+                'ORDER BY attempts, rowid LIMIT ?', (PENDING, LEASED, now, limit))]
+            conn.executemany('UPDATE items SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 '
+                             'WHERE nct_id = ?', [(LEASED, owner, now + lease_seconds, nct_id) for nct_id in nct_ids])
+            return nct_ids
+
+        return self._transaction(lease_items)
+
+    def renew(self, owner, lease_seconds=1800):
+        """Extend the leases of all items `owner` still holds."""
+        self._transaction(lambda conn: conn.execute('UPDATE items SET lease_expires = ? WHERE status = ? AND owner = ?',
+                                                    (time.time() + lease_seconds, LEASED, owner)))
+
+    def release(self, owner):
+        """Give the items `owner` still holds back to the queue, without counting the attempt (e.g. on shutdown)."""
+        return self._transaction(lambda conn: conn.execute(
+            'UPDATE items SET status = ?, owner = NULL, lease_expires = NULL, attempts = attempts - 1 '
+            'WHERE status = ? AND owner = ?', (PENDING, LEASED, owner)).rowcount)
+
+    def complete(self, nct_id, shard):
+        self._transaction(lambda conn: conn.execute(
+            'UPDATE items SET status = ?, stage = ?, error = NULL, owner = NULL, finished = ?, shard = ? '
+            'WHERE nct_id = ?', (DONE, DONE, time.time(), shard, nct_id)))
+
+    def fail(self, nct_id, stage, error, max_attempts=3):
+        """Record a failed attempt in `stage`, the item goes back to the queue until it used up `max_attempts`."""
+        self._transaction(lambda conn: conn.execute(
+            'UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, stage = ?, error = ?, owner = NULL, '
+            'lease_expires = NULL, finished = ? WHERE nct_id = ?',
+            (max_attempts, FAILED, PENDING, stage, error, time.time(), nct_id)))
+
+    def requeue(self, stage=None, leased=False):
+        """
+        Put failed items (only the ones that failed in `stage` if given) back to pending with fresh attempts. With
+        `leased`, also the leased ones, for leases of workers that are known to be gone. Returns the number requeued.
+        """
+        statuses = (FAILED, LEASED) if leased else (FAILED,)
+        query = (f"UPDATE items SET status = ?, attempts = 0, owner = NULL, lease_expires = NULL "
+                 f"WHERE status IN ({','.join('?' * len(statuses))})")
+        params = [PENDING, *statuses]
+        if stage is not None:
+            query += ' AND stage = ?'
+            params.append(stage)
+        return self._transaction(lambda conn: conn.execute(query, params).rowcount)
+
+    def progress(self, window=600):
+        """Item counts per status and failed stage, and the throughput (trials per hour) over the last `window`s."""
+        now = time.time()
+        with self.lock:
+            conn = self._connection()
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status').fetchall())
+            failed_stages = dict(conn.execute('SELECT stage, COUNT(*) FROM items WHERE status = ? GROUP BY stage',
+                                              (FAILED,)).fetchall())
+            recent = conn.execute('SELECT COUNT(*) FROM items WHERE status = ? AND finished >= ?',
+                                  (DONE, now - window)).fetchone()[0]
+            first, last = conn.execute('SELECT MIN(finished), MAX(finished) FROM items WHERE status = ?',
+                                       (DONE,)).fetchone()
+        progress = {'counts': {status: counts.get(status, 0) for status in (PENDING, LEASED, DONE, FAILED)},
+                    'failed_stages': failed_stages, 'recent_per_hour': recent * 3600 / window, 'overall_per_hour': None,
+                    'eta_hours': None}
+        if first is not None and last > first:
+            progress['overall_per_hour'] = (counts.get(DONE, 0) - 1) * 3600 / (last - first)
+        remaining = progress['counts'][PENDING] + progress['counts'][LEASED]
+        if progress['recent_per_hour'] > 0:
+            progress['eta_hours'] = remaining / progress['recent_per_hour']
+        return progress
+
+    def errors(self, limit=10):
+        """The most frequent (stage, error, count) of the failed items."""
+        with self.lock:
+            return self._connection().execute(
+                'SELECT stage, error, COUNT(*) AS count FROM items WHERE status = ? GROUP BY stage, error '
+                'ORDER BY count DESC LIMIT ?', (FAILED, limit)).fetchall()
+
+
+def format_progress(progress):
+    counts = progress['counts']
+    total = sum(counts.values())
+    lines = [f"{counts[DONE]}/{total} done, {counts[FAILED]} failed, {counts[PENDING]} pending, "
+             f"{counts[LEASED]} in progress"]
+    if progress['failed_stages']:
+        lines.append('failed in: ' + ', '.join(f'{stage} {count}' for stage, count in
+                                                sorted(progress['failed_stages'].items(), key=lambda item: -item[1])))
+    overall = progress['overall_per_hour']
+    lines.append(f"throughput: {progress['recent_per_hour']:.0f} trials/h recently"
+                 + (f", {overall:.0f} trials/h overall" if overall is not None else ''))
+    if progress['eta_hours'] is not None:
+        lines.append(f"remaining: {progress['eta_hours']:.1f} h at the recent rate")
+    return '\n'.join(lines)
+
+
+class ShardWriter:
+    """
+    Appends results as JSON lines to `out_dir/results-<owner>-<n>.jsonl`, starting a new shard every `shard_size`
+    results. Each line is flushed to disk before `write` returns, so a trial marked done in the queue is never lost.
+    """
+
+    def __init__(self, out_dir, owner, shard_size=1000):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.owner = owner
+        self.shard_size = shard_size
+        self.shard_idx = 0
+        self.count = 0
+        self.file = None
+        self.shard = None
+
+    def write(self, result):
+        """Write one result, returns the name of the shard it went to."""
+        if self.file is None or self.count == self.shard_size:
+            self.close()
+            self.shard = f'results-{self.owner}-{self.shard_idx:05d}.jsonl'
+            self.file = open(os.path.join(self.out_dir, self.shard), 'a')
+            self.shard_idx += 1
+            self.count = 0
+        self.file.write(json.dumps(result, default=parse_trial.json_default) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += 1
+        return self.shard
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_results(out_dir):
+    """Yield the results in the shards of `out_dir`, a trial parsed more than once (after a crash) only once."""
+    seen = set()
+    for path in sorted(glob.glob(os.path.join(out_dir, 'results-*.jsonl')), key=os.path.getmtime, reverse=True):
+        with open(path) as f:
+            lines = f.readlines()
+        for line in reversed(lines):
+            result = json.loads(line)
+            if result['nct_id'] not in seen:
+                seen.add(result['nct_id'])
+                yield result
+
+
+def run_worker(work_queue, batch_parser, writer, owner, batch_size=200, lease_seconds=1800, max_attempts=3):
+    """Lease and parse batches of the queue until it is empty, returns the number of trials processed."""
+    processed = 0
+    try:
+        while True:
+            nct_ids = work_queue.lease(owner, batch_size, lease_seconds=lease_seconds, max_attempts=max_attempts)
+            if not nct_ids:
+                return processed
+            for result in batch_parser.parse(nct_ids):
+                if 'error' in result:
+                    work_queue.fail(result['nct_id'], result.get('stage', 'parse'), result['error'],
+                                    max_attempts=max_attempts)
+                else:
+                    work_queue.complete(result['nct_id'], writer.write(result))
+                # the lease covers the whole batch, keep it alive while the batch is being worked on
+                work_queue.renew(owner, lease_seconds)
+                processed += 1
+    finally:
+        # e.g. on KeyboardInterrupt, the unfinished items are picked up again by the next run
+        work_queue.release(owner)
+        writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resumable corpus-scale parsing of NCT ids from a persistent queue.')
+    parser.add_argument('queue', type=str, help='SQLite work queue (created if missing)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help='queue NCT ids')
+    add_parser.add_argument('nctids', type=str, nargs='*')
+    add_parser.add_argument('--file', type=str, default=None, help='file with one NCT ID per line')
+
+    run_parser = commands.add_parser('run', help='parse queued trials until the queue is empty')
+    run_parser.add_argument('--output-dir', type=str, required=True, help='directory of the result shards')
+    run_parser.add_argument('--batch-size', type=int, default=200, help='trials leased (and pipelined) at a time')
+    run_parser.add_argument('--lease-seconds', type=int, default=1800)
+    run_parser.add_argument('--max-attempts', type=int, default=3)
+    run_parser.add_argument('--shard-size', type=int, default=1000)
+    add_pipeline_arguments(run_parser)
+
+    status_parser = commands.add_parser('status', help='progress, throughput and the most frequent errors')
+    status_parser.add_argument('--window', type=int, default=600, help='seconds the recent throughput is taken over')
+    status_parser.add_argument('--errors', type=int, default=5, help='most frequent errors to list')
+
+    requeue_parser = commands.add_parser('requeue', help='put failed items back to pending')
+    requeue_parser.add_argument('--stage', type=str, default=None, help='only the ones failed in this stage')
+    requeue_parser.add_argument('--leased', action='store_true', help='also leased items (their workers are gone)')
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue)
+    if args.command == 'add':
+        nct_ids = read_nct_ids(args.nctids, args.file)
+        print(f"Queued {work_queue.add(nct_ids)} new of {len(nct_ids)} NCT ids")
+    elif args.command == 'run':
+        context = setup_pipeline(run_parser, args)
+        batch_parser = BatchParser(context, fetch_workers=args.fetch_workers, jvm_workers=args.jvm_workers,
+                                   match_workers=args.match_workers)
+        owner = f'{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+        writer = ShardWriter(args.output_dir, owner, shard_size=args.shard_size)
+        start = time.time()
+        processed = run_worker(work_queue, batch_parser, writer, owner, batch_size=args.batch_size,
+                               lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+        context.close()
+        print(f"Processed {processed} trials in {(time.time() - start) / 3600:.1f} h")
+        print(format_progress(work_queue.progress()))
+    elif args.command == 'status':
+        print(format_progress(work_queue.progress(window=args.window)))
+        for stage, error, count in work_queue.errors(limit=args.errors):
+            print(f"{count:>8}  {stage}: {error}")
+    elif args.command == 'requeue':
+        print(f"Requeued {work_queue.requeue(stage=args.stage, leased=args.leased)} items")